@@ -15,25 +15,100 @@ for installing and configuring Valhalla are included in the README file.
 
 """ 
 
-from shape_generation import map_matching, shape_matching
+import partridge as ptg
+import pandas as pd
+from shape_generation import map_matching, shape_matching, map_matching_batches, shape_matching_batches
+from shape_generation import segment_columns, geometry_columns
 from edge_decomposition import edge_decomposition
 from compare_edges import compare_edges
+from vector_tiles import export_tiles
+from instrumentation import get_report
+from request_policy import RequestPolicy
+from valhalla_transport import ActorTransport, PoolTransport
+from segment_stream import SegmentStream
 
 # This function starts the decomposition process from scratch using a GTFS feed and a road network file
+# Pass a transport from valhalla_transport to record or replay the Valhalla requests of a run
+# A JSON run report (and optionally a Prometheus text file) is written if a path is given
+# All Valhalla requests in the run share one request policy (retries, backoff and circuit breaker)
+# With batch_patterns, edges are matched with one Valhalla request per pattern rather than per segment
+# With streaming, edges are matched as each pattern's segments are generated, with at most stream_buffer
+# patterns waiting in between
+# With window_breaks, long patterns are map matched in overlapping windows of at most that many stops, in parallel
+# With tile_size, edges are decomposed and compared in square tiles of that size (degrees), tile_workers at a time
+# With service_dates, each feed is scoped to the trips running on a date ('YYYYMMDD'), its busiest date ('busiest'),
+# or its busiest 'weekday', 'saturday' or 'sunday'
+# With region (a polygon or a (min_lon, min_lat, max_lon, max_lat) bounding box), work outside it is skipped at every stage
+# With periods (with metrics), the trips in each period of the day are compared as well ('default', 'hourly' or a
+# dictionary of (start hour, end hour) by name; see service_periods.py)
+# With tiles_path (an '.mbtiles' file or a directory), the outputs are also exported as vector tiles from min_zoom to max_zoom
 def busdecomp_gtfs(base_path, comp_path, road_path, gtfs_shapes = False,
-                    compare = True, metrics = False, port = 8002, route_ids = [None, None]):
+                    compare = True, metrics = False, port = 8002, route_ids = [None, None],
+                    transport = None, report_path = None, prometheus_path = None, policy = None,
+                    speculative_radii = 1, batch_patterns = False, valhalla_config = None, endpoints = None,
+                    streaming = False, stream_buffer = 4, window_breaks = None, tile_size = None, tile_workers = 4,
+                    service_dates = [None, None], region = None, tiles_path = None, min_zoom = 10, max_zoom = 16,
+                    periods = None):
     
-    # Generate the initial shapes defining the path of the bus routes.
-    if gtfs_shapes:
-        base_segments = shape_matching(base_path, route_ids = route_ids[0])
-        comp_segments = shape_matching(comp_path, route_ids = route_ids[1])
-    else: 
-        base_segments = map_matching(base_path, route_ids = route_ids[0])
-        comp_segments = map_matching(comp_path, route_ids = route_ids[1])
+    report = get_report()
+    report.reset()
+    if policy is None:
+        policy = RequestPolicy()
     
-    # Decompose the shapes into edge-length segments and save them to file with same root filename as input gtfs feeds.
-    edge_decomposition(base_segments, road_path, base_path[:-4], port = port)
-    edge_decomposition(comp_segments, road_path, comp_path[:-4], port = port)
+    # With a Valhalla config file, requests are handled in-process instead of by a server on the given port
+    if transport is None and valhalla_config != None:
+        transport = ActorTransport(valhalla_config)
+    
+    # With a list of endpoints ('host:port'), requests are spread over several Valhalla servers
+    if transport is None and endpoints != None:
+        transport = PoolTransport(endpoints)
+    
+    # Generate the segments of each feed in a background thread and decompose them as they arrive.
+    # Outputs are saved with the same root filename as the input gtfs feeds.
+    if streaming:
+        for gtfs_path, feed_route_ids, service_date in [(base_path, route_ids[0], service_dates[0]),
+                                                        (comp_path, route_ids[1], service_dates[1])]:
+            if gtfs_shapes:
+                produce = lambda gtfs_path = gtfs_path, feed_route_ids = feed_route_ids, service_date = service_date: shape_matching_batches(
+                    gtfs_path, route_ids = feed_route_ids, service_date = service_date, region = region)
+            else:
+                produce = lambda gtfs_path = gtfs_path, feed_route_ids = feed_route_ids, service_date = service_date: map_matching_batches(
+                    gtfs_path, route_ids = feed_route_ids, port = port, transport = transport, policy = policy,
+                    speculative_radii = speculative_radii, window_breaks = window_breaks, service_date = service_date,
+                    region = region)
+            segments = SegmentStream(produce, maxsize = stream_buffer, stage = 'shape_generation')
+            try:
+                with report.stage('edge_decomposition'):
+                    edge_decomposition(segments, road_path, gtfs_path[:-4], port = port, transport = transport, policy = policy,
+                                       speculative_radii = speculative_radii, batch_patterns = batch_patterns,
+                                       tile_size = tile_size, tile_workers = tile_workers, region = region)
+            finally:
+                segments.close()
+    
+    else:
+        # Generate the initial shapes defining the path of the bus routes.
+        with report.stage('shape_generation'):
+            if gtfs_shapes:
+                base_segments = shape_matching(base_path, route_ids = route_ids[0], service_date = service_dates[0],
+                                               region = region)
+                comp_segments = shape_matching(comp_path, route_ids = route_ids[1], service_date = service_dates[1],
+                                               region = region)
+            else: 
+                base_segments = map_matching(base_path, route_ids = route_ids[0], port = port, transport = transport, policy = policy,
+                                             speculative_radii = speculative_radii, window_breaks = window_breaks,
+                                             service_date = service_dates[0], region = region)
+                comp_segments = map_matching(comp_path, route_ids = route_ids[1], port = port, transport = transport, policy = policy,
+                                             speculative_radii = speculative_radii, window_breaks = window_breaks,
+                                             service_date = service_dates[1], region = region)
+    
+        # Decompose the shapes into edge-length segments and save them to file with same root filename as input gtfs feeds.
+        with report.stage('edge_decomposition'):
+            edge_decomposition(base_segments, road_path, base_path[:-4], port = port, transport = transport, policy = policy,
+                               speculative_radii = speculative_radii, batch_patterns = batch_patterns,
+                               tile_size = tile_size, tile_workers = tile_workers, region = region)
+            edge_decomposition(comp_segments, road_path, comp_path[:-4], port = port, transport = transport, policy = policy,
+                               speculative_radii = speculative_radii, batch_patterns = batch_patterns,
+                               tile_size = tile_size, tile_workers = tile_workers, region = region)
 
     # Compare the two segments (metrics optional) and save them to file.
     if compare:
@@ -41,13 +116,90 @@ def busdecomp_gtfs(base_path, comp_path, road_path, gtfs_shapes = False,
         # Get the output path from edge_decomposition by removing the '.zip' file extension
         base_shapes = base_path[:-4] + '.geojson'
         comp_shapes = comp_path[:-4] + '.geojson'
-        compare_edges(base_path, comp_path, base_shapes, comp_shapes, metrics = metrics)
+        with report.stage('compare_edges'):
+            compare_edges(base_path, comp_path, base_shapes, comp_shapes, metrics = metrics,
+                          tile_size = tile_size, tile_workers = tile_workers, service_dates = service_dates,
+                          region = region, periods = periods)
+    
+    # Export the decomposed edges of both feeds, and their comparison, as a vector tile pyramid
+    if tiles_path != None:
+        layers = {}
+        if compare:
+            layers['comparison'] = ('../output/' + base_path.split('/')[-1][:-4] + '_vs_' +
+                                    comp_path.split('/')[-1][:-4] + '.geojson')
+        layers['base'] = base_path[:-4] + '.geojson'
+        layers['comp'] = comp_path[:-4] + '.geojson'
+        export_tiles(tiles_path, layers, min_zoom = min_zoom, max_zoom = max_zoom, workers = tile_workers)
+    
+    # Write the timing and request-latency report for the run
+    if report_path != None:
+        report.write_json(report_path)
+    if prometheus_path != None:
+        report.write_prometheus(prometheus_path)
+
+# This function updates the outputs of an earlier run for some routes only, e.g. when an agency changes a few routes.
+# route_ids are the routes to update in each feed (None = no change). Their pieces are replaced in the output of each
+# feed, and the comparison is updated for the edges that changed. A route that is no longer in a feed is given by
+# its route_id in the output (the route_short_name).
+def busdecomp_routes(base_path, comp_path, road_path, route_ids = [None, None], gtfs_shapes = False, compare = True,
+                     metrics = False, port = 8002, transport = None, report_path = None, prometheus_path = None,
+                     policy = None, speculative_radii = 1, batch_patterns = False, service_dates = [None, None],
+                     periods = None):
+    
+    report = get_report()
+    report.reset()
+    if policy is None:
+        policy = RequestPolicy()
+    
+    update_edges = {}
+    for gtfs_path, feed_route_ids, service_date in [(base_path, route_ids[0], service_dates[0]),
+                                                    (comp_path, route_ids[1], service_dates[1])]:
+        if feed_route_ids == None:
+            continue
+        
+        # Routes are named by route_short_name in the output
+        feed_routes = ptg.load_feed(gtfs_path).routes
+        route_dict = dict(zip(feed_routes['route_id'], feed_routes['route_short_name']))
+        output_route_ids = [route_dict.get(route, route) for route in feed_route_ids]
+        feed_route_ids = [route for route in feed_route_ids if route in route_dict]
+        
+        with report.stage('shape_generation'):
+            if len(feed_route_ids) == 0:
+                segments = pd.DataFrame([], columns = geometry_columns if gtfs_shapes else segment_columns)
+            elif gtfs_shapes:
+                segments = shape_matching(gtfs_path, route_ids = feed_route_ids, service_date = service_date)
+            else:
+                segments = map_matching(gtfs_path, route_ids = feed_route_ids, port = port, transport = transport, policy = policy,
+                                        speculative_radii = speculative_radii, service_date = service_date)
+        
+        with report.stage('edge_decomposition'):
+            updated_lines = edge_decomposition(segments, road_path, gtfs_path[:-4], port = port, transport = transport, policy = policy,
+                                               speculative_radii = speculative_radii, batch_patterns = batch_patterns,
+                                               update_routes = output_route_ids)
+        for edge, lines in updated_lines.items():
+            update_edges.setdefault(edge, []).extend(lines)
+    
+    # Compare the pieces near the updated edges again
+    if compare:
+        base_shapes = base_path[:-4] + '.geojson'
+        comp_shapes = comp_path[:-4] + '.geojson'
+        with report.stage('compare_edges'):
+            compare_edges(base_path, comp_path, base_shapes, comp_shapes, metrics = metrics,
+                          service_dates = service_dates, update_edges = update_edges, periods = periods)
+    
+    if report_path != None:
+        report.write_json(report_path)
+    if prometheus_path != None:
+        report.write_prometheus(prometheus_path)
 
 # This function runs the comparison only if shapes have already been generated
-def busdecomp_edges(base_gtfs, comp_gtfs, base_shapes, comp_shapes, metrics = False):
+def busdecomp_edges(base_gtfs, comp_gtfs, base_shapes, comp_shapes, metrics = False, tile_size = None, tile_workers = 4,
+                    service_dates = [None, None], region = None, periods = None):
     
     # Compare the two segments (metrics optional) and save them to file.
-    compare_edges(base_gtfs, comp_gtfs, base_shapes, comp_shapes, metrics = metrics)
+    compare_edges(base_gtfs, comp_gtfs, base_shapes, comp_shapes, metrics = metrics,
+                  tile_size = tile_size, tile_workers = tile_workers, service_dates = service_dates, region = region,
+                  periods = periods)
 
 # base_path = 'data/MBTA_JAN2011_reduced.zip'
 # comp_path = 'data/MBTA_JAN2021_reduced.zip'
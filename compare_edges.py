@@ -11,15 +11,37 @@ performance metric between the baseline period and the comparison period.
 
 """
 
-from shapely.geometry import MultiLineString
+from shapely.geometry import MultiLineString, box
 import partridge as ptg
 import pandas as pd
 import geopandas as gpd
+import numpy as np
 import time
+import logging
+import tiling
+import service_periods
+import gtfs_io
+import region_filter
+from instrumentation import get_report
+from incidence import Incidence
 
-def compare_edges(base_gtfs_path, comp_gtfs_path, base_shapes_path, comp_shapes_path, metrics = False):
+logger = logging.getLogger(__name__)
+
+# tile_size: compare the networks in square tiles of this size (degrees), with tile_workers tiles at a time
+# service_dates: count the trips of each feed on this date, 'busiest' or day type (None = every trip in the feed)
+# region: only compare the pieces that intersect this polygon or bounding box (see region_filter.py)
+# periods: with metrics, also compare the trips in each period of the day, as a 'metric_<period>' column for each
+# period. A dictionary of (start hour, end hour) by name, or 'default' or 'hourly' (see service_periods.py).
+# Where the periods cover every departure, the period columns of each piece add up to its metric.
+# update_edges: only compare the pieces near these edges again, keeping the rest of the existing output. A dictionary
+# of the lines (old and new) of each edge that changed in either network, as returned by edge_decomposition.
+def compare_edges(base_gtfs_path, comp_gtfs_path, base_shapes_path, comp_shapes_path, metrics = False,
+                  tile_size = None, tile_workers = 4, service_dates = [None, None], region = None, update_edges = None,
+                  periods = None):
     
     origin_time = time.time()
+    report = get_report()
+    span = report.start_stage('metrics')
     
     # Maximum distance between two lines for them to be considered the same line (in feet)
     distance_threshold = 15
@@ -38,32 +60,35 @@ def compare_edges(base_gtfs_path, comp_gtfs_path, base_shapes_path, comp_shapes_
         return df
     
     # Function to find average daily trips for each segment using GTFS
-    def average_daily_trips(inpath, base_indicator):
+    def average_daily_trips(inpath, base_indicator, service_date = None):
         
-        # Import GTFS feed and filter down to normal bus routes only
+        # Import GTFS feed and filter down to normal bus routes only (running on the service date, if given)
         route_type = ['3']
         view = {'routes.txt': {'route_type': route_type}}
+        if service_date != None:
+            view['trips.txt'] = {'service_id': gtfs_io.service_ids(inpath, service_date)}
         feed = ptg.load_feed(inpath, view)
-        feed_stop_events = feed.stop_times[['trip_id', 'stop_id', 'stop_sequence']]
         
         feed_trips = feed.trips[['route_id','trip_id']]
         feed_trips = convert_route_ids(feed_trips, feed)
-        all_stops = pd.merge(feed_trips, feed_stop_events, on='trip_id', how='inner')
-        all_stops = all_stops.sort_values(by=['trip_id', 'stop_sequence'])
+        feed_stops = gtfs_io.read_table(inpath, 'stops.txt', ['stop_id'])
+        stop_times = gtfs_io.read_stop_times(inpath, trip_ids = feed_trips['trip_id'], stop_ids = feed_stops['stop_id'])
+        route_dict = dict(zip(feed_trips['trip_id'], feed_trips['route_id']))
+        trip_routes = [route_dict[trip] for trip in stop_times.trip_ids]
         
         arrivals_dict = {}
         
-        stop_events = all_stops.values.tolist()
-        for index, stop_event in enumerate(stop_events[:-1]):
-            sequence = stop_event[3]
-            if sequence == 1:
-                continue
-            
+        # Stop events are sorted by trip_id and stop_sequence, with trips and stops as codes
+        trip_codes = stop_times.trip_codes.tolist()
+        stop_codes = stop_times.stop_codes.tolist()
+        
+        # The same pairs of stop events are counted by period in service_periods.trips_by_period
+        for index in service_periods.counted_pairs(stop_times).tolist():
             next_stop = index + 1
             
-            stop_id = stop_event[2]
-            next_stop_id = stop_events[next_stop][2]
-            route = stop_event[0]
+            stop_id = stop_times.stop_ids[stop_codes[index]]
+            next_stop_id = stop_times.stop_ids[stop_codes[next_stop]]
+            route = trip_routes[trip_codes[index]]
             
             segment = str(route) + '-' + str(stop_id) + '-' + str(next_stop_id)
             
@@ -74,19 +99,165 @@ def compare_edges(base_gtfs_path, comp_gtfs_path, base_shapes_path, comp_shapes_
         
         return arrivals_dict 
     
+    # Function to compare base pieces with the candidate comparison pieces. Returns the output rows for
+    # each base piece, and the indices of the comparison pieces that were matched.
+    def compare_pieces(base_pieces, candidates):
+        piece_rows = []
+        comp_matched = []
+        
+        for piece in base_pieces:
+            rows = []
+            keep_base = True
+            match = False
+            indicator = 0
+            base_total = 0
+            comp_total = 0
+            comp_segments = None
+        
+            edge = piece[edge_index]
+            base_segments = piece[seg_index]
+            base_polyline = piece[poly_index]
+            base_line = piece[geom_index]
+    
+            if metrics:
+                base_total = piece[total_index]
+        
+            # Check potential matches using edge numbers
+            potential_matches = candidates[candidates['edge'] == edge].values.tolist()
+        
+            # Check if this is a split (i.e. edge in the base is two edges in the comp)
+            if len(potential_matches) > 1:
+            
+                # Are there strictly more edges with this way ID in the comp network than the base?
+                if base_edge_counts[edge] < len(potential_matches):
+                
+                    # Is there a minimal distance between the large line and the two (or more) smaller lines?
+                    combined_line = MultiLineString([i[geom_index] for i in potential_matches])
+                    if base_line.hausdorff_distance(combined_line) < distance_threshold:
+                    
+                        # Add the two smaller lines to the match dict and drop the larger line
+                        match = True
+                        keep_base = False
+                        indicator = 2
+                        for match in potential_matches:
+                            comp_matched.append(match[index_index])
+                            comp_segments = match[seg_index]
+    
+            # Check for matches using the edge ID
+            if not match:
+                for potential_match in potential_matches:
+                    comp_line = potential_match[geom_index]
+                    if base_line.hausdorff_distance(comp_line) < distance_threshold:
+                        match = True
+                        indicator = 2
+                        comp_matched.append(potential_match[index_index])
+                        if metrics: 
+                            comp_segments = potential_match[seg_index]
+                            comp_total = potential_match[total_index]
+                        break
+        
+            # If edge match is unsuccessful, try matching using polylines
+            if not match:
+                potential_matches = candidates[candidates['polyline'] == base_polyline].values.tolist()
+    
+                for potential_match in potential_matches:
+                    comp_line = potential_match[geom_index]
+                    if base_line.hausdorff_distance(comp_line) < distance_threshold:
+                        match = True
+                    
+                        logger.debug('Matched edge %s to %s by polyline', edge, potential_match[edge_index])
+                    
+                        indicator = 2
+                        comp_matched.append(potential_match[index_index])
+                        if metrics:
+                            comp_segments = potential_match[seg_index]
+                            comp_total = potential_match[total_index]
+                        break
+    
+            # If both are unsuccessful, try matching using spatial intersection
+            if not match: 
+                # Any lines that overlap
+                inter = candidates.intersects(base_line)
+                potential_matches = candidates[inter].values.tolist()
+            
+                for potential_match in potential_matches:
+                    comp_line = potential_match[geom_index]
+                    if base_line.hausdorff_distance(comp_line) < distance_threshold:
+                        match = True
+                        indicator = 2
+                        comp_matched.append(potential_match[index_index])
+                        if metrics:
+                            comp_segments = potential_match[seg_index]
+                            comp_total = potential_match[total_index]
+                        break
+        
+            # If this is a conventional match
+            if keep_base:
+                output_segments = {}
+                output_segments['base'] = base_segments
+                output_segments['comp'] = comp_segments
+                rows.append((base_line, base_polyline, edge, indicator, output_segments, comp_total - base_total))
+        
+            else: # If it is a split match, keep the smaller comparison segments
+                for potential_match in potential_matches:
+                    output_segments = {}
+                    output_segments['base'] = base_segments
+                    output_segments['comp'] = comp_segments
+                    rows.append((potential_match[geom_index], potential_match[poly_index], potential_match[edge_index],
+                                 indicator, output_segments, comp_total - base_total))
+            piece_rows.append(rows)
+        
+        return piece_rows, comp_matched
+    
     if metrics:
-        base_metrics = average_daily_trips(base_gtfs_path, True)
-        comp_metrics = average_daily_trips(comp_gtfs_path, False)
+        base_metrics = average_daily_trips(base_gtfs_path, True, service_dates[0])
+        comp_metrics = average_daily_trips(comp_gtfs_path, False, service_dates[1])
+        if periods == 'default':
+            periods = service_periods.default_periods
+        elif periods == 'hourly':
+            periods = service_periods.hourly_periods()
+        if periods is not None:
+            base_profiles = service_periods.trips_by_period(base_gtfs_path, periods, service_dates[0])
+            comp_profiles = service_periods.trips_by_period(comp_gtfs_path, periods, service_dates[1])
       
-    base_shapes = gpd.read_file(base_shapes_path, crs='EPSG:4326').to_crs('EPSG:2249')
-    comp_shapes = gpd.read_file(comp_shapes_path, crs='EPSG:4326').to_crs('EPSG:2249')
+    report.end_stage(span)
+    span = report.start_stage('match_pieces')
+    region = region_filter.as_region(region)
+    if region is None:
+        base_shapes = gpd.read_file(base_shapes_path, crs='EPSG:4326')
+        comp_shapes = gpd.read_file(comp_shapes_path, crs='EPSG:4326')
+    else: # Only read the pieces in the region of interest
+        base_shapes = gpd.read_file(base_shapes_path, crs='EPSG:4326', mask = region.geometry)
+        comp_shapes = gpd.read_file(comp_shapes_path, crs='EPSG:4326', mask = region.geometry)
+    if tile_size is not None: # Tiles are in degrees, so find the first point of each piece before projecting
+        base_points = [line.coords[0] for line in base_shapes.geometry]
+        comp_points = [line.coords[0] for line in comp_shapes.geometry]
+    base_shapes = base_shapes.to_crs('EPSG:2249')
+    comp_shapes = comp_shapes.to_crs('EPSG:2249')
+    
+    # Roll the trips of each segment up to the pieces that it uses, with one sparse product per network.
+    # With periods, the total of each piece is an array of its daily trips followed by its trips in each period.
+    # The matrices saved by edge_decomposition are used unless only the pieces in a region were read.
+    if metrics:
+        for shapes, shapes_path, feed_metrics, profiles in [
+                (base_shapes, base_shapes_path, base_metrics, base_profiles if periods is not None else None),
+                (comp_shapes, comp_shapes_path, comp_metrics, comp_profiles if periods is not None else None)]:
+            pieces = Incidence.from_pieces(shapes) if region is not None else Incidence.for_output(shapes_path, shapes)
+            totals = pieces.rollup(feed_metrics)
+            if periods is None:
+                shapes['total'] = totals.tolist()
+            else:
+                shapes['total'] = list(np.column_stack([totals, pieces.rollup(pieces.segment_values(*profiles))]))
+    else:
+        base_shapes['total'] = 0
+        comp_shapes['total'] = 0
     comp_shapes['index'] = range(len(comp_shapes))
     
-    # Cycle through base shapes first, find matches and append metrics
     geom_index = base_shapes.columns.get_loc("geometry")
     seg_index = base_shapes.columns.get_loc("indices")
     edge_index = base_shapes.columns.get_loc("edge")
     poly_index = base_shapes.columns.get_loc("polyline")
+    total_index = base_shapes.columns.get_loc("total")
     index_index = comp_shapes.columns.get_loc("index")
     
     segment_list = []
@@ -96,136 +267,85 @@ def compare_edges(base_gtfs_path, comp_gtfs_path, base_shapes_path, comp_shapes_
     edge_list = []
     indicator_list = [] # 0 = dropped service; 1 = new service; 2 = maintained service
     comp_matched = []
+    base_pieces = base_shapes.values.tolist()
+    base_edge_counts = base_shapes['edge'].value_counts().to_dict()
     
-    for piece in base_shapes.values.tolist():
-        keep_base = True
-        match = False
-        indicator = 0
-        base_total = 0
-        comp_total = 0
-        comp_segments = None
-        
-        edge = piece[edge_index]
-        base_segments = piece[seg_index]
-        base_polyline = piece[poly_index]
-        base_line = piece[geom_index]
+    basefilename = base_gtfs_path.split('/')[-1]
+    compfilename = comp_gtfs_path.split('/')[-1]
+    outpath = '../output/' + basefilename[:-4] + "_vs_" + compfilename[:-4] + ".geojson"
     
-        if metrics:
-            for segment in base_segments:
-                segment_key = base_segments[segment]
-                try:
-                    base_total += base_metrics[segment_key]
-                except KeyError:
-                    continue
+    # When some edges were updated, compare the pieces on any edge that comes within distance_threshold of their
+    # old or new lines (or their rows in the existing output) again, since pieces only match other pieces that
+    # close. Comparison pieces are only left over if no base piece matches them, so the matches of the base
+    # pieces near them are found as well. The rows for every other edge are kept as they are.
+    if update_edges is not None:
+        old_output = gpd.read_file(outpath)
+        changed_lines = gpd.GeoSeries([line for lines in update_edges.values() for line in lines], crs = 'EPSG:4326')
+        changed_lines = list(changed_lines.to_crs('EPSG:2249')) + list(old_output[old_output['edge'].isin(update_edges)].to_crs('EPSG:2249').geometry)
+        def nearby(shapes, lines):
+            positions = set()
+            for line in lines:
+                min_x, min_y, max_x, max_y = line.bounds
+                positions.update(shapes.sindex.query(box(min_x - distance_threshold, min_y - distance_threshold,
+                                                         max_x + distance_threshold, max_y + distance_threshold)).tolist())
+            return positions
         
-        # Check potential matches using edge numbers
-        potential_matches = comp_shapes[comp_shapes['edge'] == edge].values.tolist()
+        compared_edges = set(update_edges)
+        for shapes in [base_shapes, comp_shapes]:
+            compared_edges.update(shapes['edge'].iloc[sorted(nearby(shapes, changed_lines))])
+        compared = [position for position, edge in enumerate(base_shapes['edge']) if edge in compared_edges]
+        leftover_lines = comp_shapes[comp_shapes['edge'].isin(compared_edges)].geometry
+        context = sorted(nearby(base_shapes, leftover_lines) - set(compared))
+        report.increment('compared_edges', len(compared_edges))
         
-        # Check if this is a split (i.e. edge in the base is two edges in the comp)
-        if len(potential_matches) > 1:
-            
-            # Are there strictly more edges with this way ID in the comp network than the base?
-            if len(base_shapes[base_shapes['edge'] == edge]) < len(potential_matches):
-                
-                # Is there a minimal distance between the large line and the two (or more) smaller lines?
-                combined_line = MultiLineString([i[geom_index] for i in potential_matches])
-                if base_line.hausdorff_distance(combined_line) < distance_threshold:
-                    
-                    # Add the two smaller lines to the match dict and drop the larger line
-                    match = True
-                    keep_base = False
-                    indicator = 2
-                    for match in potential_matches:
-                        comp_matched.append(match[index_index])
-                        comp_segments = match[seg_index]
+        piece_rows, comp_matched = compare_pieces([base_pieces[position] for position in compared], comp_shapes)
+        comp_matched.extend(compare_pieces([base_pieces[position] for position in context], comp_shapes)[1])
     
-        # Check for matches using the edge ID
-        if not match:
-            for potential_match in potential_matches:
-                comp_line = potential_match[geom_index]
-                if base_line.hausdorff_distance(comp_line) < distance_threshold:
-                    match = True
-                    indicator = 2
-                    comp_matched.append(potential_match[index_index])
-                    if metrics: 
-                        comp_segments = potential_match[seg_index]
-                        for segment in comp_segments:
-                            segment_key = comp_segments[segment]
-                            try:
-                                comp_total += comp_metrics[segment_key]
-                            except KeyError:
-                                continue
-                    break
-        
-        # If edge match is unsuccessful, try matching using polylines
-        if not match:
-            potential_matches = comp_shapes[comp_shapes['polyline'] == base_polyline].values.tolist()
-    
-            for potential_match in potential_matches:
-                comp_line = potential_match[geom_index]
-                if base_line.hausdorff_distance(comp_line) < distance_threshold:
-                    match = True
-                    
-                    print(edge, potential_match[edge_index])
-                    
-                    indicator = 2
-                    comp_matched.append(potential_match[index_index])
-                    if metrics:
-                        comp_segments = potential_match[seg_index]
-                        for segment in comp_segments:
-                            segment_key = comp_segments[segment]
-                            try:
-                                comp_total += comp_metrics[segment_key]
-                            except KeyError:
-                                continue
-                    break
+    # Cycle through base shapes first, find matches and append metrics
+    elif tile_size is None:
+        piece_rows, comp_matched = compare_pieces(base_pieces, comp_shapes)
     
-        # If both are unsuccessful, try matching using spatial intersection
-        if not match: 
-            # Any lines that overlap
-            inter = comp_shapes.intersects(base_line)
-            potential_matches = comp_shapes[inter].values.tolist()
-            
-            for potential_match in potential_matches:
-                comp_line = potential_match[geom_index]
-                if base_line.hausdorff_distance(comp_line) < distance_threshold:
-                    match = True
-                    indicator = 2
-                    comp_matched.append(potential_match[index_index])
-                    if metrics:
-                        comp_segments = potential_match[seg_index]
-                        for segment in comp_segments:
-                            segment_key = comp_segments[segment]
-                            try:
-                                comp_total += comp_metrics[segment_key]
-                            except KeyError:
-                                continue
-                    break
+    # Compare the pieces of each tile in parallel. The pieces of an edge (in both networks) belong to the tile
+    # of its first piece. Each tile also compares against any comparison pieces close enough to its base
+    # pieces to match them, so the results are the same as comparing everything at once. Both networks have
+    # already been read whole, so the tiles share them rather than bounding memory (see tiling.py).
+    else:
+        edge_tiles = {}
+        for edge, key in zip(list(base_shapes['edge']) + list(comp_shapes['edge']), tiling.tile_keys(base_points + comp_points, tile_size)):
+            edge_tiles.setdefault(edge, key)
+        tiles = tiling.group_by_tile([edge_tiles[edge] for edge in base_shapes['edge']])
+        comp_tiles = tiling.group_by_tile([edge_tiles[edge] for edge in comp_shapes['edge']])
+        report.increment('compare_tiles', len(tiles))
+        base_bounds = base_shapes.bounds.values
+        comp_index = comp_shapes.sindex # Built before the tiles share it
         
-        # If this is a conventional match
-        if keep_base:
-            geometry_list.append(base_line)
-            polyline_list.append(base_polyline)
+        def compare_tile(positions):
+            min_x, min_y = base_bounds[positions, 0].min(), base_bounds[positions, 1].min()
+            max_x, max_y = base_bounds[positions, 2].max(), base_bounds[positions, 3].max()
+            nearby = comp_index.query(box(min_x - distance_threshold, min_y - distance_threshold,
+                                                  max_x + distance_threshold, max_y + distance_threshold))
+            key = edge_tiles[base_shapes['edge'].iloc[positions[0]]]
+            candidates = comp_shapes.iloc[sorted(set(nearby.tolist()) | set(comp_tiles.get(key, [])))]
+            return compare_pieces([base_pieces[position] for position in positions], candidates)
+        
+        piece_rows = [None] * len(base_pieces)
+        tile_results = tiling.map_tiles(compare_tile, tiles, tile_workers)
+        for key in tiles:
+            tile_rows, tile_matched = tile_results[key]
+            for position, rows in zip(tiles[key], tile_rows):
+                piece_rows[position] = rows
+            comp_matched.extend(tile_matched)
+    
+    for rows in piece_rows:
+        for line, polyline, edge, indicator, output_segments, metric in rows:
+            geometry_list.append(line)
+            polyline_list.append(polyline)
             edge_list.append(edge)
             indicator_list.append(indicator)
-            output_segments = {}
-            output_segments['base'] = base_segments
-            output_segments['comp'] = comp_segments
             segment_list.append(output_segments)
-            metric_list.append(comp_total - base_total)
-        
-        else: # If it is a split match, keep the smaller comparison segments
-            for potential_match in potential_matches:
-                geometry_list.append(potential_match[geom_index])
-                polyline_list.append(potential_match[poly_index])
-                edge_list.append(potential_match[edge_index])
-                indicator_list.append(indicator)
-                output_segments = {}
-                output_segments['base'] = base_segments
-                output_segments['comp'] = comp_segments
-                segment_list.append(output_segments)
-                metric_list.append(comp_total - base_total)
-        
+            metric_list.append(metric)
+    comp_matched = set(comp_matched)
+    
     # Add metrics to any leftover comparison shapes and add to combined dict
     for piece in comp_shapes.values.tolist():
         comp_polyline = piece[poly_index]
@@ -235,15 +355,12 @@ def compare_edges(base_gtfs_path, comp_gtfs_path, base_shapes_path, comp_shapes_
     
         if index in comp_matched: # if the polyline has been matched within given tolerance, ignore
             continue
+        if update_edges is not None and edge not in compared_edges:
+            continue
         
+        comp_segments = piece[seg_index]
         if metrics:
-            comp_segments = piece[seg_index]
-            for segment in comp_segments:
-                segment_key = comp_segments[segment]
-                try:
-                    comp_total += comp_metrics[segment_key]
-                except KeyError:
-                    continue
+            comp_total = piece[total_index]
         
         geometry_list.append(piece[geom_index])
         polyline_list.append(comp_polyline)
@@ -255,21 +372,30 @@ def compare_edges(base_gtfs_path, comp_gtfs_path, base_shapes_path, comp_shapes_
         segment_list.append(output_segments)
         metric_list.append(comp_total)
     
+    report.end_stage(span)
+    span = report.start_stage('export')
     gdf = gpd.GeoDataFrame(geometry = geometry_list)
     gdf['polyline'] = polyline_list
     gdf['segments'] = segment_list
-    gdf['metric'] = metric_list
+    if metrics and periods is not None:
+        metric_list = np.array(metric_list, dtype = np.int64).reshape(-1, len(periods) + 1)
+        gdf['metric'] = metric_list[:, 0].tolist()
+        for column, period in enumerate(periods, 1):
+            gdf['metric_' + period] = metric_list[:, column].tolist()
+    else:
+        gdf['metric'] = metric_list
     gdf['edge'] = edge_list
     gdf['service_indicator'] = indicator_list
     
     gdf = gdf.sort_values(by = ['edge'])
     gdf = gdf.set_crs('EPSG:2249')
     gdf = gdf.to_crs('EPSG:4326')
+    if update_edges is not None:
+        gdf = pd.concat([gdf, old_output[~old_output['edge'].isin(compared_edges)].to_crs('EPSG:4326')], ignore_index = True)
+        gdf = gdf.sort_values(by = ['edge'])
     
-    basefilename = base_gtfs_path.split('/')[-1]
-    compfilename = comp_gtfs_path.split('/')[-1]
-    outpath = '../output/' + basefilename[:-4] + "_vs_" + compfilename[:-4] + ".geojson"
     gdf.to_file(outpath, driver='GeoJSON')         
+    report.end_stage(span)
     
     total_time = time.time() - origin_time
-    print("Total elapsed time:", round(total_time,0))
+    logger.info("Total elapsed time: %d", round(total_time,0))
@@ -0,0 +1,2 @@
+# test_examples.py is an example script that needs the MBTA feeds and a Valhalla server, not a test module
+collect_ignore = ['test_examples.py']
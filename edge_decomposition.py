@@ -31,19 +31,260 @@ Author: Nick Caros, September 2020
 
 """
 
-import polyline
-import requests
-import json
+import ast
+import polyline_codec
+import linear_referencing
+import road_store
+import region_filter
+import tiling
+import numpy as np
 import time
-from shapely.geometry import LineString, Point
+import logging
+from valhalla_transport import HttpTransport
+from request_policy import RequestPolicy, PermanentValhallaError, escalate_radius
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import get_report
+from incidence import Incidence, incidence_path
+from shapely.geometry import LineString
 from pyproj import Geod
 import geopandas as gpd
+import pandas as pd
 
-def edge_decomposition(segments, road_inpath, outpath, port = 8002):
+logger = logging.getLogger(__name__)
+
+# Extra attributes requested for pattern batches, which locate each input point on the matched edges
+batch_attributes = ['matched.point',
+                    'matched.type',
+                    'matched.edge_index',
+                    'matched.distance_along_edge',
+                    'matched.begin_route_discontinuity',
+                    'matched.end_route_discontinuity']
+
+# Find the segments from position onwards that can be matched with a single request: consecutive
+# segments of one pattern whose shapes join end to end and whose stop pairs are not yet matched.
+# Returns the positions of the segments, the concatenated shape and the index of each segment boundary.
+def find_pattern_batch(segments, position, matched_pairs, max_points):
+    
+    pattern = segments['pattern'].iloc[position]
+    positions = []
+    stop_pairs = set()
+    batch_coords = []
+    boundaries = [0]
+    
+    while position < len(segments) and segments['pattern'].iloc[position] == pattern:
+        stop_pair = tuple(segments['stop_pair'].iloc[position][:2])
+        if stop_pair in matched_pairs or stop_pair in stop_pairs:
+            break
+        
+        seg_coords = polyline_codec.decode(segments['geometry'].iloc[position], precision = 6)
+        if len(positions) > 0:
+            if seg_coords[0] != batch_coords[-1] or len(batch_coords) + len(seg_coords) - 1 > max_points:
+                break
+            seg_coords = seg_coords[1:]
+        
+        positions.append(position)
+        stop_pairs.add(stop_pair)
+        batch_coords += seg_coords
+        boundaries.append(len(batch_coords) - 1)
+        position += 1
+    
+    return positions, batch_coords, boundaries
+
+# Get the points of one matched edge between two fractions of its length (0 to 1), replacing the 
+# end points with the matched input points where the segment starts or ends part way along the edge
+def clip_edge(edge_coords, start_fraction, end_fraction, start_point = None, end_point = None):
+    
+    lengths = [0]
+    for (lat1, lon1), (lat2, lon2) in zip(edge_coords[:-1], edge_coords[1:]):
+        lengths.append(lengths[-1] + ((lat2 - lat1) ** 2 + (lon2 - lon1) ** 2) ** 0.5)
+    total = lengths[-1] if lengths[-1] > 0 else 1
+    
+    clipped = [edge_coords[0] if start_point is None else start_point]
+    for point, length in zip(edge_coords[1:-1], lengths[1:-1]):
+        if start_fraction < length / total < end_fraction:
+            clipped.append(point)
+    clipped.append(edge_coords[-1] if end_point is None else end_point)
+    
+    return clipped
+
+# Split the result of a pattern batch into one result per segment, in the same form as a 
+# single-segment trace_attributes response. Segments whose boundaries could not be placed
+# unambiguously on the matched edges are returned as None, to be matched on their own.
+def split_pattern_batch(result, boundaries):
+    
+    matched_points = result.get('matched_points', [])
+    edges = result['edges']
+    batch_shape = polyline_codec.decode(result['shape'], precision = 6)
+    if len(matched_points) <= boundaries[-1]:
+        return [None] * (len(boundaries) - 1)
+    
+    seg_results = []
+    for first_index, last_index in zip(boundaries[:-1], boundaries[1:]):
+        start = matched_points[first_index]
+        end = matched_points[last_index]
+        
+        # Points that were not matched, or breaks in the matched route, make the split ambiguous
+        points = matched_points[first_index : last_index + 1]
+        if any(point.get('type') == 'unmatched' or 'edge_index' not in point for point in (start, end)) or \
+           any(point.get('begin_route_discontinuity') or point.get('end_route_discontinuity') for point in points):
+            seg_results.append(None)
+            continue
+        
+        first_edge = start['edge_index']
+        last_edge = end['edge_index']
+        start_fraction = start.get('distance_along_edge', 0)
+        end_fraction = end.get('distance_along_edge', 1)
+        
+        # A boundary at an intersection belongs to the edge on the segment's side of it
+        if start_fraction >= 1 and first_edge < last_edge:
+            first_edge += 1
+            start_fraction = 0
+        if end_fraction <= 0 and last_edge > first_edge:
+            last_edge -= 1
+            end_fraction = 1
+        if first_edge > last_edge or last_edge >= len(edges) or \
+           (first_edge == last_edge and start_fraction > end_fraction):
+            seg_results.append(None)
+            continue
+        
+        start_point = (round(start['lat'], 6), round(start['lon'], 6))
+        end_point = (round(end['lat'], 6), round(end['lon'], 6))
+        
+        # Rebuild the segment shape and the shape indices of its edges
+        seg_coords = []
+        seg_edges = []
+        for edge_index in range(first_edge, last_edge + 1):
+            edge = edges[edge_index]
+            edge_coords = batch_shape[edge['begin_shape_index'] : edge['end_shape_index'] + 1]
+            edge_coords = clip_edge(edge_coords,
+                                    start_fraction if edge_index == first_edge else 0,
+                                    end_fraction if edge_index == last_edge else 1,
+                                    start_point if edge_index == first_edge else None,
+                                    end_point if edge_index == last_edge else None)
+            
+            begin_shape_index = max(len(seg_coords) - 1, 0)
+            seg_coords += edge_coords if len(seg_coords) == 0 else edge_coords[1:]
+            seg_edges.append({'id': edge['id'],
+                              'way_id': edge['way_id'],
+                              'begin_shape_index': begin_shape_index,
+                              'end_shape_index': len(seg_coords) - 1})
+        
+        seg_results.append({'edges': seg_edges, 'shape': seg_coords})
+    
+    # Encode the segment shapes together
+    split_results = [seg_result for seg_result in seg_results if seg_result is not None]
+    seg_shapes = polyline_codec.encode_many([seg_result['shape'] for seg_result in split_results], precision = 6)
+    for seg_result, seg_shape in zip(split_results, seg_shapes):
+        seg_result['shape'] = seg_shape
+    
+    return seg_results
+
+class WayGeometry: # An OSM way, with the coordinates and lengths used to split it into pieces
+    def __init__(self, coords, length_ft, line = None):
+        self.coords = coords
+        self.cumulative = linear_referencing.cumulative_lengths(coords)
+        self.length_ft = length_ft
+        self.shape = line
+    
+    @property
+    def line(self): # Shapely line, only built when it is needed
+        if self.shape is None:
+            self.shape = LineString(self.coords)
+        return self.shape
+
+# Read the pieces of an existing output file. Each piece has its edge, line, polyline and a list of
+# (route, segment, index) for the segments that use it, in the order they were added.
+def read_pieces(inpath):
+    
+    # Dictionaries may have been written as JSON objects or as strings, depending on the GeoJSON driver
+    def parse(value):
+        if isinstance(value, str):
+            value = ast.literal_eval(value)
+        return [value[key] for key in sorted(value, key = int)]
+    
+    gdf = gpd.read_file(inpath)
+    pieces = []
+    for edge, line, polyline, routes, segments, indices in zip(gdf['edge'], gdf['geometry'], gdf['polyline'],
+                                                               gdf['route_id'], gdf['segments'], gdf['indices']):
+        pieces.append({'edge': int(edge), 'line': line, 'polyline': polyline,
+                       'segments': list(zip(parse(routes), parse(segments), parse(indices)))})
+    return pieces
+
+# Join the pieces of an edge end to end wherever two neighbouring pieces are used by the same segments,
+# e.g. once the segment that split them has been removed. Pieces that are not used are left out.
+def merge_pieces(pieces):
+    
+    pieces = [piece for piece in pieces if len(piece['segments']) > 0]
+    by_start = {piece['line'].coords[0]: piece for piece in pieces}
+    by_end = {piece['line'].coords[-1]: piece for piece in pieces}
+    
+    # Start from the pieces that don't continue one with the same segments
+    def continues(piece, previous):
+        return previous is not None and previous is not piece and set(previous['segments']) == set(piece['segments'])
+    heads = [piece for piece in pieces if not continues(piece, by_end.get(piece['line'].coords[0]))]
+    
+    merged = []
+    used = set()
+    for piece in heads + pieces: # Pieces in a closed loop have no head
+        if id(piece) in used:
+            continue
+        used.add(id(piece))
+        coords = list(piece['line'].coords)
+        following = by_start.get(coords[-1])
+        while following is not None and id(following) not in used and continues(following, piece):
+            used.add(id(following))
+            coords.extend(list(following['line'].coords)[1:])
+            following = by_start.get(coords[-1])
+        if len(coords) == len(piece['line'].coords):
+            merged.append(piece)
+        else:
+            merged.append(dict(piece, line = LineString(coords), polyline = None))
+    return merged
+
+# Get the geometry of each of the given ways from a dictionary of way shapes or a road store.
+# The geodesic lengths of all of the ways are calculated with one call on their concatenated coordinates.
+def load_way_geometries(way_dict, way_ids, geod):
+    
+    way_ids = [way_id for way_id in dict.fromkeys(way_ids) if way_id in way_dict]
+    if len(way_ids) == 0:
+        return {}
+    lines = [way_dict[way_id] for way_id in way_ids]
+    coord_list = [np.asarray(getattr(line, 'coords', line))[:, :2] for line in lines]
+    counts = np.array([len(coords) for coords in coord_list])
+    starts = np.cumsum(counts) - counts
+    coords = np.concatenate(coord_list)
+    
+    # Steps from the last point of one way to the first point of the next are not part of either way
+    _, _, steps = geod.inv(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1])
+    steps = np.append(steps, 0)
+    steps[starts[1:] - 1] = 0
+    lengths_ft = np.add.reduceat(steps, starts) * 3.28084 # meters to ft
+    
+    return {way_id: WayGeometry(coords, length_ft, None if isinstance(line, np.ndarray) else line)
+            for way_id, line, coords, length_ft in zip(way_ids, lines, coord_list, lengths_ft)}
+
+# speculative_radii: number of search radii to request at once when Valhalla finds no match (1 = one at a time)
+# batch_patterns: match each pattern's consecutive segments with one request, splitting the result by segment
+# tile_size: match and split the network in square tiles of this size (degrees), with tile_workers tiles at a time
+# region: only match the segments that intersect this polygon or bounding box (see region_filter.py)
+# update_routes: replace only these routes (route_id as in the output) in an existing output file with the given
+# segments, re-splitting the edges that they used or now use. Returns the old and new lines of those edges by edge.
+def edge_decomposition(segments, road_inpath, outpath, port = 8002, transport = None, policy = None,
+                       speculative_radii = 1, batch_patterns = False, tile_size = None, tile_workers = 4, region = None,
+                       update_routes = None):
     
+    # Requests go to the Valhalla server on the given port unless another transport is provided
+    if transport is None:
+        transport = HttpTransport(port = port)
+    if policy is None:
+        policy = RequestPolicy()
+
     turn_penalty_factor = 100 # Penalizes turns in Valhalla routes. Range 0 - 100,000.
     maneuver_penalty = 60 # Penalty when a route includes a change from one road to another (seconds). Range 0 - 43,200. 
     search_radius = 15 # Radius for searching in the map matching
+    max_search_radius = 100 # Largest radius to widen the search to when Valhalla finds no match
+    radius_step = 5 # Increase in search radius for each new attempt
+    max_batch_points = 5000 # Largest number of shape points sent in one pattern batch
     
     midblock_tolerance = 0 # Maximum distance from center of intersection for a bus stop to be considered "mid-block"
     
@@ -88,7 +329,7 @@ def edge_decomposition(segments, road_inpath, outpath, port = 8002):
         return_dict = {}
         
         # Get coordinates from the polyline shape
-        seg_shape_coords = polyline.decode(result['shape'], geojson = True, precision = 6)
+        seg_shape_coords = polyline_codec.decode(result['shape'], geojson = True, precision = 6)
         for edge in result['edges']:
     
             edge_start = edge['begin_shape_index']
@@ -118,261 +359,390 @@ def edge_decomposition(segments, road_inpath, outpath, port = 8002):
         
         return edge_dict
     
-    # Function for cutting a line at a point
-    def cut(line, stop):
-        distance = line.project(stop)
+    # Function to match a pattern's unmatched segments from position onwards in a segment table with a single
+    # request. Returns the per-segment results by position, with None for segments that must be matched alone.
+    def match_pattern_batch(batch, position, matched):
+        
+        positions, batch_coords, boundaries = find_pattern_batch(batch, position, matched, max_batch_points)
+        if len(positions) < 2:
+            return {}
+        
+        request_data = request_parameters.copy()
+        request_data['encoded_polyline'] = polyline_codec.encode(batch_coords, precision = 6)
+        request_data['filters'] = dict(request_parameters['filters'],
+                                       attributes = request_parameters['filters']['attributes'] + batch_attributes)
+        request_data['trace_options'] = dict(request_parameters['trace_options'], search_radius = search_radius)
+        
+        # If the whole pattern cannot be matched, every segment falls back to its own request
+        report.increment('pattern_batches')
+        try:
+            result = policy.send(transport, 'trace_attributes', request_data, timeout = 30)
+        except PermanentValhallaError:
+            result = None
+        
+        seg_results = [None] * len(positions) if result is None else split_pattern_batch(result, boundaries)
+        report.increment('pattern_batch_fallbacks', seg_results.count(None))
+        return dict(zip(positions, seg_results))
+    
+    # Function to split edges into "pieces" at any mid-block bus stops
+    def split_edges(edge_ids, way_geometries):
+        
+        piece_dict = {}
+        for edge in edge_ids:
+        
+            # Keep only unique break points
+            break_points = edge_dict[edge].break_points
+            unique_breaks = list(set(break_points))
+        
+            # If all break points are the same, the edge is a point and we can skip
+            if len(unique_breaks) == 1:
+                logger.warning('Edge is a point: %s', edge)
+                continue
+        
+            way_id = str(edge_dict[edge].way)
+            try:
+                way = way_geometries[way_id]
+            except KeyError:
+                logger.warning('Error, No way available for %s', way_id)
+                continue
         
-        # Cuts a line in two at a distance from its starting point
-        if distance <= 0.0 or distance >= line.length:
-            return [LineString(line), None]
-        coords = list(line.coords)
-        last_pd = 0
-        for i, p in enumerate(coords):
-            pd = line.project(Point(p))
+            way_coords = way.coords
+            cumulative = way.cumulative
+            line_length = cumulative[-1]
+            line_length_ft = way.length_ft
+            if line_length == 0:
+                logger.warning('Way is a point: %s', way_id)
+                continue
+        
+            # Project the break points and the ends of every traversal onto the way in one call
+            bounds = edge_dict[edge].bounds
+            segments = edge_dict[edge].segments
+            routes = edge_dict[edge].routes
+            projected = linear_referencing.project(way_coords, unique_breaks + [point for bound in bounds for point in bound], cumulative)
+            break_lengths = projected[:len(unique_breaks)]
+            break_distances = break_lengths / line_length
+            bound_distances = projected[len(unique_breaks):] / line_length
+        
+            # Discard break points that are at the ends of the line
+            at_start = break_distances * line_length_ft <= midblock_tolerance
+            at_end = ~at_start & ((1 - break_distances) * line_length_ft < midblock_tolerance)
+            line_start = at_start.any()
+            line_end = at_end.any()
+        
+            # Sort the remaining break points, keeping one of any that project to the same place
+            distances, first_breaks = np.unique(break_distances[~at_start & ~at_end], return_index = True)
+            lengths = break_lengths[~at_start & ~at_end][first_breaks]
     
-            if pd < last_pd: # Error handling for circular segments
-                pd = last_pd + pd
+            # If there are no break points, create the piece and continue
+            if len(distances) == 0:
+                if line_start and line_end:
+                
+                    piece_dict[(edge, 0)] = Piece(edge, way.line) # The only case that needs the Shapely line
+                
+                    for seg_index, segment in enumerate(bounds):
+                        piece_dict[(edge, 0)].segments.append(segments[seg_index])
+                        piece_dict[(edge, 0)].routes.append(routes[seg_index])
+                
+                    continue
+            
+                # Otherwise the edge is within the tolerance, and we don't need it
+                else:
+                    logger.warning('Mismatch for: %s', edge)
+                    continue
+        
+            # Cut the way at all of the break points at once. The section before the first break point
+            # is ignored unless the edge starts at the start of the way, and likewise for the end.
+            if line_start:
+                distances = np.concatenate([[0], distances])
+                lengths = np.concatenate([[0], lengths])
+            if line_end:
+                distances = np.concatenate([distances, [1]])
+                lengths = np.concatenate([lengths, [line_length]])
+            if len(distances) < 2:
+                continue
+        
+            for piece_count, piece_coords in enumerate(linear_referencing.split(way_coords, lengths, cumulative)):
+                piece_dict[(edge, piece_count)] = Piece(edge, LineString(piece_coords))
+        
+            # Associate each unique segment with the pieces between the ends of its traversal
+            start_distances = bound_distances[0::2]
+            end_distances = bound_distances[1::2]
+            piece_ranges = linear_referencing.assign_pieces(distances[1:-1], start_distances, end_distances)
+            for seg_index, piece_range in enumerate(piece_ranges):
+                stops = segments[seg_index]
+                route = routes[seg_index]
             
-            if pd == distance:
-                return [
-                    LineString(coords[:i+1]),
-                    LineString(coords[i:])]
-            if pd > distance:
-                cp = line.interpolate(distance)
-                return [
-                    LineString(coords[:i] + [(cp.x, cp.y)]),
-                    LineString([(cp.x, cp.y)] + coords[i:])]
-            last_pd = pd
-    
-        return [LineString(line), None]
+                for piece_index in piece_range:
+                    piece_dict[(edge, piece_index)].segments.append(stops)
+                    piece_dict[(edge, piece_index)].routes.append(route)
+        
+        return piece_dict
+    
+    # Function to match a segment to edges, or with batch_patterns the rest of its pattern at the same time.
+    # Returns the Valhalla result, or None if no match is found.
+    def match_segment(batch, position, segment, batch_results, matched):
+        
+        # Match the rest of the pattern in one request, then use the per-segment results as they come up
+        if batch_patterns and position not in batch_results:
+            batch_results.update(match_pattern_batch(batch, position, matched))
+        result = batch_results.pop(position, None)
+        if result is not None:
+            return result
+        
+        # Use Valhalla map matching engine to snap shapes to the road network
+        def send(radius, seg_polyline = segment['geometry']):
+            request_data = request_parameters.copy()
+            request_data['encoded_polyline'] = seg_polyline
+            request_data['trace_options'] = dict(request_parameters['trace_options'], search_radius = radius)
+            return policy.send(transport, 'trace_attributes', request_data, timeout = 30)
+        
+        # If Valhalla does not find a match, add to search radius. Retries and timeouts are handled 
+        # by the request policy, which raises ValhallaUnavailable if Valhalla stops responding
+        radius, result = escalate_radius(send, search_radii, speculative_radii, executor)
+        return result
+    
+    # Function to add the edges of a matched segment to the edge dictionary
+    def add_edges(result, stop_pair, route):
+        
+        edge_shapes = extract_edge_shapes(result)
+        for edge in result['edges']:
+            edge_id = edge['id']
+            try:
+                new_coords = edge_shapes[edge_id]
+            except:
+                break
+            
+            if edge_id not in edge_dict: # If we already saw this edge, just add new info
+                edge_dict[edge_id] = Edge(edge['way_id'])
+            
+            update_edge(edge_dict, edge_id, new_coords, stop_pair, route)
+    
+    def log_progress(count):
+        if count % 100 == 0: 
+            elapsed_time = time.time() - start_time
+            if total is None:
+                logger.info('Edges matched for %d segments. Elapsed time: %d', count, round(elapsed_time,0))
+            else:
+                logger.info('Edges matched for %d of %d patterns. Elapsed time: %d', count, total, round(elapsed_time,0))
     
     """ Main Program """
     
     origin_time = time.time()
+    report = get_report()
+    span = report.start_stage('match_edges')
     
     # Use Valhalla to find the set of edges that comprise each stop-to-stop segment
     edge_dict = {}
     mm_dict = {}
     start_time = time.time()
-    error_count = 0
-    for count, segment in segments.iterrows():
-        
-        stop_pair = tuple([segment['stop_pair'][0], segment['stop_pair'][1]])
-        
-        # If already processed this stop pair, continue
-        if stop_pair in mm_dict: 
-            elapsed_time = time.time() - start_time
-            if count % 100 == 0: print('Edges matched for', count, 'of', len(segments), 'patterns', "Elapsed time:", round(elapsed_time,0))
-            continue
-        
+    search_radii = list(range(search_radius, max_search_radius + 1, radius_step))
+    executor = ThreadPoolExecutor(max_workers = speculative_radii) if speculative_radii > 1 else None
+    
+    try:
+        # Skip the segments outside the region of interest, keeping any that cross its border whole
+        region = region_filter.as_region(region)
+        def in_region(batch):
+            mask = region.segment_mask(batch)
+            report.increment('region_skipped_segments', int((~mask).sum()))
+            return batch[mask].reset_index(drop = True)
+        if region is not None:
+            segments = in_region(segments) if isinstance(segments, pd.DataFrame) else map(in_region, segments)
+    
+        # When updating routes, the pieces of the other routes are kept. Stop pairs that those routes already
+        # use are not matched again, since each stop pair is only matched once.
+        if update_routes is not None:
+            update_routes = set(update_routes)
+            old_pieces = read_pieces(outpath + '.geojson')
+            kept_pairs = {segment for piece in old_pieces for route, segment, index in piece['segments'] if route not in update_routes}
+            def not_kept(batch):
+                mask = np.array([str(stop_pair[0]) + '-' + str(stop_pair[1]) not in kept_pairs for stop_pair in batch['stop_pair']], dtype = bool)
+                return batch[mask].reset_index(drop = True)
+            segments = not_kept(segments) if isinstance(segments, pd.DataFrame) else map(not_kept, segments)
+    
+        # Segments come either as one table or as a stream of tables (e.g. one per pattern), which are
+        # matched as they arrive
+        if isinstance(segments, pd.DataFrame):
+            batches = [segments]
+            total = len(segments)
         else:
+            batches = segments
+            total = None
+        if tile_size is None:
+            count = -1
+            for batch in batches:
+                batch_results = {}
+                for position, (index, segment) in enumerate(batch.iterrows()):
+                    count += 1
             
-            error_binary = False
-            radius = search_radius 
-            
-            # Get segment info
-            seg_polyline = segment['geometry']
-            route = segment['route_id']
+                    stop_pair = tuple([segment['stop_pair'][0], segment['stop_pair'][1]])
             
-            # If request times out, try twice more and then raise an error
-            to_count = 1
-            while to_count < 6:
-                try:
-                    # Use Valhalla map matching engine to snap shapes to the road network
-                    request_data = request_parameters.copy()
-                    request_data['encoded_polyline'] = seg_polyline
-                    request_data['trace_options']['search_radius'] = radius
-                    req = requests.post('http://localhost:'+str(port)+'/trace_attributes',
-                                        data = json.dumps(request_data),
-                                        timeout = 30)
-                    
-                    # Extract encoded polyline from Valhalla response
-                    result = req.json()
-                    
-                    # Error handling for unexpected Valhalla responses - add to search radius
-                    if len(result) > 4:
-                        print("Valhalla did not find shape for", str(stop_pair), ", Count = ", str(count))
-                        radius += 5
-                        if radius > 100: 
-                            error_count += 1
-                            error_binary = True
-                            break
-                        else:
-                            continue
-                        #raise Exception("Valhalla error: Check error messages or restart matching.")
-                        
+                    # If already processed this stop pair, continue
+                    if stop_pair in mm_dict: 
+                        report.cache_hit('edge_matching_stop_pairs')
+                        log_progress(count)
+                        continue
+                    report.cache_miss('edge_matching_stop_pairs')
+                
+                    result = match_segment(batch, position, segment, batch_results, mm_dict)
+                    if result is None:
+                        logger.info("Valhalla did not find shape for %s, Count = %d", str(stop_pair), count)
+                        report.increment('edge_matching_errors')
+                        continue
+                
                     mm_dict[stop_pair] = result
-                    to_count = 10
-                    
-                except:
-                    print("Timeout #", to_count)
-                    to_count += 1
-                    
-                if to_count == 5:
-                    raise Exception("Valhalla timeout: Check error messages or restart matching.")
-        
-        if error_binary:
-            continue
+                    add_edges(result, stop_pair, segment['route_id'])
+                    log_progress(count)
+    
+        # Match the stop pairs of each tile in parallel. All rows with a stop pair go to the tile of its first row,
+        # so that each stop pair is matched once (by the first row that Valhalla finds a match for), as above.
         else:
-                       
-            edge_shapes = extract_edge_shapes(result)
-        
-            # Add the resulting pieces to the piece dictionary
-            for edge in result['edges']:
-                edge_id = edge['id']
-                try:
-                    new_coords = edge_shapes[edge_id]
-                except:
-                    break
+            if not isinstance(segments, pd.DataFrame):
+                segments = pd.concat(list(segments), ignore_index = True)
+            stop_pairs = [tuple([stop_pair[0], stop_pair[1]]) for stop_pair in segments['stop_pair']]
+            coords, offsets = polyline_codec.decode_many(segments['geometry'].tolist(), precision = 6, geojson = True)
+            first_points = coords[np.minimum(offsets[:-1], max(len(coords) - 1, 0))] if len(coords) > 0 else np.zeros((len(segments), 2))
+            pair_tiles = {}
+            for stop_pair, key in zip(stop_pairs, tiling.tile_keys(first_points, tile_size)):
+                pair_tiles.setdefault(stop_pair, key)
+            tiles = tiling.group_by_tile([pair_tiles[stop_pair] for stop_pair in stop_pairs])
+            report.increment('edge_tiles', len(tiles))
+        
+            def match_tile(rows):
+                tile_segments = segments.iloc[rows]
+                matched = {}
+                batch_results = {}
+                for position, (index, segment) in enumerate(tile_segments.iterrows()):
+                    stop_pair = stop_pairs[rows[position]]
+                    if stop_pair in matched:
+                        report.cache_hit('edge_matching_stop_pairs')
+                        continue
+                    report.cache_miss('edge_matching_stop_pairs')
                 
-                if edge_id not in edge_dict: # If we already saw this edge, just add new info
-                    edge_dict[edge_id] = Edge(edge['way_id'])
-                    
-                edge_dict = update_edge(edge_dict, edge_id, new_coords, stop_pair, route)
-    
-        elapsed_time = time.time() - start_time
-        if count % 100 == 0: print('Edges matched for', count, 'of', len(segments), 'patterns', "Elapsed time:", round(elapsed_time,0))
+                    result = match_segment(tile_segments, position, segment, batch_results, matched)
+                    if result is None:
+                        logger.info("Valhalla did not find shape for %s, Count = %d", str(stop_pair), rows[position])
+                        report.increment('edge_matching_errors')
+                        continue
+                    matched[stop_pair] = (rows[position], result)
+                return matched
+        
+            for matched in tiling.map_tiles(match_tile, tiles, tile_workers).values():
+                mm_dict.update(matched)
+        
+            # Add the edges of each stop pair from the row that it was matched for, in the order of the table
+            for row, stop_pair in enumerate(stop_pairs):
+                if stop_pair in mm_dict and mm_dict[stop_pair][0] == row:
+                    add_edges(mm_dict[stop_pair][1], stop_pair, segments['route_id'].iloc[row])
+            segments = None
+            stop_pairs = None
+        
+        # The Valhalla results are not needed once their edges are added
+        mm_dict = None
     
+        # When updating routes, only the edges that the routes used before or use now are split again. The
+        # other routes' segments are added back to the edges that have new segments, from the ends of the pieces
+        # they used; edges that only lost segments have their pieces joined where the removed segments split them.
+        if update_routes is not None:
+            updated_edges = set(edge_dict) | {piece['edge'] for piece in old_pieces
+                                              if any(route in update_routes for route, segment, index in piece['segments'])}
+            updated_lines = {}
+            kept_pieces = []
+            merged_pieces = []
+            edge_pieces = {}
+            for piece in old_pieces:
+                if piece['edge'] in updated_edges:
+                    updated_lines.setdefault(piece['edge'], []).append(piece['line'])
+                    kept_segments = [membership for membership in piece['segments'] if membership[0] not in update_routes]
+                    edge_pieces.setdefault(piece['edge'], []).append(dict(piece, segments = kept_segments))
+                else:
+                    kept_pieces.append(piece)
+        
+            for edge, pieces in edge_pieces.items():
+                if edge not in edge_dict:
+                    merged_pieces.extend(merge_pieces(pieces))
+                    continue
+                traversals = {}
+                for piece in pieces:
+                    for membership in piece['segments']:
+                        traversals.setdefault(membership, []).append(piece['line'])
+                for (route, segment, index), lines in traversals.items():
+                    # The saved 'stop-stop' key is kept as it is, since stop IDs can contain '-' themselves
+                    for line in merge_pieces([{'line': line, 'segments': [segment]} for line in lines]):
+                        update_edge(edge_dict, edge, list(line['line'].coords), segment, route)
+            report.increment('updated_edges', len(updated_edges))
+    finally: # The speculative requests are shut down however matching ends
+        if executor is not None:
+            executor.shutdown(wait = False)
     
     # Get dictionary of way shapes from OSM
-    shapefile = gpd.read_file(road_inpath, crs='EPSG:4326')
-    way_dict = dict(zip(shapefile['osm_id'], shapefile['geometry']))
-    shapefile = None
+    report.end_stage(span)
+    span = report.start_stage('load_ways')
+    if road_store.is_road_store(road_inpath): # Memory-mapped store built by road_store.build_road_store
+        way_dict = road_store.RoadStore(road_inpath)
+    elif tile_size is not None: # Each tile reads the ways around its own edges from the shapefile
+        way_dict = None
+    elif (region is not None or update_routes is not None) and len(edge_dict) == 0:
+        way_dict = {}
+    else:
+        # With a region, or when updating routes, only the ways around the matched edges are read
+        bbox = None
+        if region is not None or update_routes is not None:
+            bbox = region_filter.points_bbox([point for edge in edge_dict.values() for point in edge.break_points])
+        shapefile = gpd.read_file(road_inpath, crs='EPSG:4326', bbox = bbox)
+        way_dict = road_store.way_lines(shapefile) # Multi-part ways merged, as in a road store
+        shapefile = None
 
-    # Set up function to calculate line lengths in feet
+    # Look up the ways used by the edges, and calculate their lengths in feet all at once
     geod = Geod(ellps="WGS84")
+    if tile_size is None:
+        way_geometries = load_way_geometries(way_dict, [str(edge_dict[edge].way) for edge in edge_dict], geod)
+        way_dict = None
     
     # Now split edges into "pieces" at any mid-block bus stops
-    piece_dict = {}
-    for edge in edge_dict:
-        
-        # Keep only unique break points
-        break_points = edge_dict[edge].break_points
-        unique_breaks = list(set(break_points))
-        
-        # If all break points are the same, the edge is a point and we can skip
-        if len(unique_breaks) == 1:
-            print('Edge is a point: ', edge)
-            continue
-        
-        way_id = str(edge_dict[edge].way)
-        try:
-            full_line = way_dict[way_id]
-            line_length_ft = geod.geometry_length(full_line) * 3.28084 # meters to ft
-        except KeyError:
-            print('Error, No way available for ', way_id)
-            continue
-        
-        # Discard break points that are at the ends of the line
-        int_points = []
-        distances = []
-        line_start = False
-        line_end = False
-        for point in unique_breaks:
-            point_geom = Point(point)
-            distance = full_line.project(point_geom, normalized = True)
-            
-            if distance * line_length_ft <= midblock_tolerance:
-                line_start = True
-            elif (1 - distance) * line_length_ft < midblock_tolerance:
-                line_end = True
-            else:
-                int_points.append(point_geom)
-                distances.append(distance)
+    report.end_stage(span)
+    span = report.start_stage('split_pieces')
+    if tile_size is None:
+        piece_dict = split_edges(list(edge_dict), way_geometries)
     
-        # If there are no break points, create the piece and continue
-        if len(distances) == 0:
-            if line_start and line_end:
-                
-                bounds = edge_dict[edge].bounds
-                segments = edge_dict[edge].segments
-                routes = edge_dict[edge].routes
-                
-                piece_dict[(edge, 0)] = Piece(edge, full_line)
-                
-                for seg_index, segment in enumerate(bounds):
-                    stops = segments[seg_index]
-                    route = routes[seg_index]
-                    piece_dict[(edge, 0)].segments.append(stops)
-                    piece_dict[(edge, 0)].routes.append(route)
-                
-                continue
-            
-            # Otherwise the edge is within the tolerance, and we don't need it
-            else:
-                print('Mismatch for: ', edge)
-                continue
-            
-        sorted_points = [x for _,x in sorted(zip(distances, int_points), key=lambda distance: distance[0])]
-        sorted_distances = sorted(distances)
-        piece_count = 0
-        
-        # If edge starts at first line in the way, then just split it normally
-        if line_start:
-            remainder = full_line
-            for point in sorted_points:
-                piece_geom, remainder = cut(remainder, point)
-                piece_dict[(edge, piece_count)] = Piece(edge, piece_geom)
-                piece_count += 1
-                if remainder == None:
-                    break
-        
-        # Otherwise, ignore the section before the first break point
-        else:
-            sorted_distances = sorted_distances[1:]
-            _, remainder = cut(full_line, sorted_points[0])
-            if remainder != None: 
-                for index, point in enumerate(sorted_points[1:]):
-                    piece_geom, remainder = cut(remainder, point)
-                    piece_dict[(edge, piece_count)] = Piece(edge, piece_geom)
-                    piece_count += 1
-                    if remainder == None:
-                        break
-            else:
-                continue
-    
-        # If edge continues to the end of the way, then add the remainder as a new piece
-        if line_end:
-            piece_dict[(edge, piece_count)] = Piece(edge, remainder)
-        else:
-            sorted_distances = sorted_distances[:-1]
-        
-        # Associate each unique segment with one or more pieces using bounds
-        bounds = edge_dict[edge].bounds
-        segments = edge_dict[edge].segments
-        routes = edge_dict[edge].routes
+    # Split the edges of each tile in parallel, loading only the ways that the tile uses. Each edge
+    # belongs to the tile of its first break point and has the break points from every tile. Without a
+    # road store, each tile reads the ways around its edges from the shapefile, and drops them once split.
+    else:
+        edge_ids = list(edge_dict)
+        tiles = tiling.group_by_tile(tiling.tile_keys([edge_dict[edge].break_points[0] for edge in edge_ids], tile_size))
         
-        for seg_index, segment in enumerate(bounds):
-            stops = segments[seg_index]
-            route = routes[seg_index]
-            
-            if len(sorted_distances) == 0:
-                piece_dict[(edge, 0)].segments.append(stops)
-                piece_dict[(edge, 0)].routes.append(route)
+        def split_tile(positions):
+            tile_edges = [edge_ids[position] for position in positions]
+            tile_way_ids = [str(edge_dict[edge].way) for edge in tile_edges]
+            if way_dict is None:
+                bbox = region_filter.points_bbox([point for edge in tile_edges for point in edge_dict[edge].break_points])
+                tile_ways = load_way_geometries(road_store.way_lines(gpd.read_file(road_inpath, crs='EPSG:4326', bbox = bbox)),
+                                                tile_way_ids, geod)
             else:
-                start = full_line.project(Point(segment[0]), normalized=True)
-                end = full_line.project(Point(segment[1]), normalized=True)
-                
-                if start > end: # Switch directions
-                    start, end = [end, start]
-                
-                for index, piece_dist in enumerate(sorted_distances):
-                    if start < piece_dist and end >= piece_dist:
-                        piece_dict[(edge, index)].segments.append(stops)
-                        piece_dict[(edge, index)].routes.append(route)
-                
-                if end > piece_dist:
-                    piece_dict[(edge, index + 1)].segments.append(stops)
-                    piece_dict[(edge, index + 1)].routes.append(route)
-                
+                tile_ways = load_way_geometries(way_dict, tile_way_ids, geod)
+            return split_edges(tile_edges, tile_ways)
+        
+        # Merge the pieces of every tile, in the order of the edges
+        edge_pieces = {}
+        for tile_pieces in tiling.map_tiles(split_tile, tiles, tile_workers).values():
+            for piece in tile_pieces:
+                edge_pieces.setdefault(piece[0], []).append((piece, tile_pieces[piece]))
+        piece_dict = {}
+        for edge in edge_ids:
+            for piece, piece_object in edge_pieces.get(edge, []):
+                piece_dict[piece] = piece_object
+        way_dict = None
+    edge_dict = None # The matched edges are not needed once they are split into pieces
+    
     # Save pieces as a geoJSON with relevant properties
+    report.end_stage(span)
+    span = report.start_stage('export')
     edge_list = []
     route_list = []
     segment_list = []
     index_list = []
     start_list = []
     end_list = []
-    polyline_list = []
     geom_list = []
     tup_list = []
     
@@ -389,21 +759,20 @@ def edge_decomposition(segments, road_inpath, outpath, port = 8002):
         shape = piece_object.shape
         start = shape.coords[0]
         end = shape.coords[-1]
-        piece_polyline = polyline.encode(shape.coords, precision = 6)
                     
         seg_indices = {}
         stop_indices = {}
         route_dict = {}
         seg_index_list = []
         for index, seg in enumerate(segments):
-            start_stop = seg[0]
-            end_stop = seg[1]
+            # Segments are stop pairs, or the saved 'stop-stop' keys of the segments kept by an update
+            segment_key = seg if isinstance(seg, str) else seg[0] + '-' + seg[1]
             route = routes[index]
             
             route_dict[index] = route
-            stop_indices[index] = route + '-' + start_stop + '-' + end_stop
-            seg_indices[index] = start_stop + '-' + end_stop
-            seg_index_list.append(route + '-' + start_stop + '-' + end_stop)
+            stop_indices[index] = route + '-' + segment_key
+            seg_indices[index] = segment_key
+            seg_index_list.append(route + '-' + segment_key)
             
         tup_list.append(tuple(seg_index_list))
                 
@@ -413,8 +782,23 @@ def edge_decomposition(segments, road_inpath, outpath, port = 8002):
         index_list.append(stop_indices)
         start_list.append(str(start))
         end_list.append(str(end))
-        polyline_list.append(piece_polyline)
         geom_list.append(shape)
+    
+    # Encode the piece shapes together
+    polyline_list = polyline_codec.encode_many([shape.coords for shape in geom_list], precision = 6)
+    
+    # When updating routes, add the pieces of the edges that were not split again, as they were
+    if update_routes is not None:
+        for piece in merged_pieces + kept_pieces:
+            edge_list.append(piece['edge'])
+            route_list.append({index: membership[0] for index, membership in enumerate(piece['segments'])})
+            segment_list.append({index: membership[1] for index, membership in enumerate(piece['segments'])})
+            index_list.append({index: membership[2] for index, membership in enumerate(piece['segments'])})
+            geom_list.append(piece['line'])
+            if piece['polyline'] is None:
+                polyline_list.append(polyline_codec.encode(piece['line'].coords, precision = 6))
+            else:
+                polyline_list.append(piece['polyline'])
          
     # Build geodataframe for each piece       
     piece_gdf = gpd.GeoDataFrame(geometry = geom_list)
@@ -434,5 +818,16 @@ def edge_decomposition(segments, road_inpath, outpath, port = 8002):
     # Export to file
     gdf = gdf.sort_values(by = ['edge'])
     gdf.to_file(outpath + ".geojson", driver='GeoJSON')         
+    
+    # Save the pieces x segments incidence matrix, with rows in the same order as the output file
+    Incidence.from_pieces(gdf).save(incidence_path(outpath + ".geojson"))
+    report.end_stage(span)
     total_time = time.time() - origin_time
-    print("Total elapsed time:", round(total_time,0))
\ No newline at end of file
+    logger.info("Total elapsed time: %d", round(total_time,0))
+    
+    # Return the old and new lines of the updated edges
+    if update_routes is not None:
+        for edge, line in zip(edge_list, geom_list):
+            if edge in updated_edges:
+                updated_lines.setdefault(edge, []).append(line)
+        return updated_lines
\ No newline at end of file
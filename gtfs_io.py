@@ -0,0 +1,271 @@
+"""
+
+This program reads the large tables of a GTFS feed without loading them
+whole. stop_times.txt can have tens of millions of rows, so instead of
+reading it through partridge (which keeps every column as Python strings),
+it is read straight from the feed in chunks:
+
+1) Only the trip_id, stop_id, stop_sequence (and optionally checkpoint_id
+   and the stop times) columns are read
+2) Rows for trips or stops outside the feed view are dropped from each chunk
+3) trip_id and stop_id are stored as integer codes into tables of the unique
+   IDs, stop_sequence as a 32-bit integer, checkpoint_id as a flag and
+   departure_time as seconds after the start of the service day (which can
+   be past 24:00:00 for trips running after midnight)
+4) Each chunk is sorted by trip and stop_sequence, and the sorted chunks are
+   combined with a k-way merge
+
+The result has the same stop events in the same order as sorting the full
+table by trip_id and stop_sequence. The peak memory (RSS) of the read is
+recorded in the run report as the 'read_stop_times' stage.
+
+It also finds the service_ids running on a given service date, so that a
+run can be scoped to one day of service rather than every trip in the feed.
+The date can be given directly, or chosen as the date with the most bus trips
+overall ('busiest') or of a day type ('weekday', 'saturday' or 'sunday').
+
+Feeds can be zip files or directories, as with partridge.
+
+"""
+
+import os
+import zipfile
+import logging
+import datetime
+import partridge as ptg
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+from instrumentation import get_report, peak_rss_mb
+
+logger = logging.getLogger(__name__)
+
+# Open a file from a GTFS feed (a zip file or a directory), or return None if the feed doesn't have it
+@contextmanager
+def open_member(inpath, filename):
+    if os.path.isdir(inpath):
+        for root, dirs, files in os.walk(inpath):
+            if filename in files:
+                with open(os.path.join(root, filename), 'rb') as member:
+                    yield member
+                return
+        yield None
+        return
+
+    with zipfile.ZipFile(inpath) as feed_zip:
+        for name in feed_zip.namelist():
+            if name.split('/')[-1] == filename:
+                with feed_zip.open(name) as member:
+                    yield member
+                return
+    yield None
+
+# Read a small GTFS table as strings, with whitespace stripped as partridge does
+def read_table(inpath, filename, columns):
+    with open_member(inpath, filename) as member:
+        if member is None:
+            return pd.DataFrame([], columns = columns)
+        df = pd.read_csv(member, dtype = str, encoding = 'utf-8-sig', index_col = False,
+                         usecols = lambda column: column.strip() in columns)
+    df.columns = [column.strip() for column in df.columns]
+    for column in df.columns:
+        df[column] = df[column].str.strip()
+    return df
+
+# Convert a column of IDs into integer codes into a shared table of unique IDs, adding any new IDs to the table.
+# Returns the codes, with -1 for empty or excluded IDs.
+def encode_ids(values, id_codes, id_list, allowed = None):
+    local_codes, uniques = pd.factorize(values)
+    uniques = [str(value).strip() for value in uniques]
+    unique_codes = np.full(len(uniques) + 1, -1, dtype = np.int32) # The last entry is for empty values (code -1)
+    for index, value in enumerate(uniques):
+        if allowed is not None and value not in allowed:
+            continue
+        if value not in id_codes:
+            id_codes[value] = len(id_list)
+            id_list.append(value)
+        unique_codes[index] = id_codes[value]
+    return unique_codes[local_codes]
+
+# Sort key for a stop event: the trip code in the high 32 bits and stop_sequence in the low 32 bits
+def event_keys(trip_codes, stop_sequence):
+    return (trip_codes.astype(np.int64) << 32) | stop_sequence.astype(np.int64)
+
+# Merge two runs of stop events that are each sorted by key
+def merge_two(first, second):
+    second_positions = np.searchsorted(first['key'], second['key'], side = 'right') + np.arange(len(second['key']))
+    from_second = np.zeros(len(first['key']) + len(second['key']), dtype = bool)
+    from_second[second_positions] = True
+    merged = {}
+    for column in first:
+        merged[column] = np.empty(len(from_second), dtype = first[column].dtype)
+        merged[column][from_second] = second[column]
+        merged[column][~from_second] = first[column]
+    return merged
+
+# Merge any number of sorted runs, two at a time, in log2(runs) rounds
+def merge_runs(runs):
+    while len(runs) > 1:
+        merged = [merge_two(runs[index], runs[index + 1]) for index in range(0, len(runs) - 1, 2)]
+        if len(runs) % 2 == 1:
+            merged.append(runs[-1])
+        runs = merged
+    return runs[0]
+
+# Convert GTFS times ('H:MM:SS' or 'HH:MM:SS', past 24:00:00 after midnight) into seconds after the start of the
+# service day, with -1 for empty times. Times repeat a lot, so only the distinct values are parsed.
+def parse_times(values):
+    codes, uniques = pd.factorize(values)
+    text = pd.Series(uniques, dtype = object).astype(str).str.strip()
+    seconds = np.full(len(uniques), -1, dtype = np.int32)
+    filled = (text != '').to_numpy()
+    if np.any(filled):
+        parts = text[filled].str.split(':', expand = True)
+        if parts.shape[1] != 3:
+            raise ValueError('Stop times must be in HH:MM:SS format')
+        seconds[filled] = (parts.astype(np.int32) * np.array([3600, 60, 1], dtype = np.int32)).sum(axis = 1).to_numpy()
+    return np.append(seconds, -1).astype(np.int32)[codes]
+
+class StopTimes: # Stop events sorted by trip_id and stop_sequence, with trips and stops as integer codes
+    def __init__(self, trip_codes, stop_codes, stop_sequence, checkpoints, trip_ids, stop_ids, times = None):
+        self.trip_codes = trip_codes
+        self.stop_codes = stop_codes
+        self.stop_sequence = stop_sequence
+        self.checkpoints = checkpoints # None if the feed has no checkpoint_id column
+        self.times = times # Departure times in seconds, or None if they were not read
+        self.trip_ids = trip_ids
+        self.stop_ids = stop_ids
+
+        # Index of the first stop event of each trip, plus the number of stop events at the end
+        changes = np.flatnonzero(np.diff(trip_codes)) + 1
+        self.trip_starts = np.concatenate([[0], changes, [len(trip_codes)]]) if len(trip_codes) > 0 else np.zeros(1, dtype = np.int64)
+
+    def __len__(self):
+        return len(self.trip_codes)
+
+    # Split an array of values for every stop event into a dictionary of lists by trip_id
+    def by_trip(self, values):
+        starts = self.trip_starts
+        return {self.trip_ids[self.trip_codes[start]]: values[start : end]
+                for start, end in zip(starts[:-1].tolist(), starts[1:].tolist())}
+
+    # The stop_ids of each trip, in order
+    def stops_by_trip(self):
+        stop_ids = np.array(self.stop_ids, dtype = object)
+        return {trip: list(stops) for trip, stops in self.by_trip(stop_ids[self.stop_codes]).items()}
+
+    # The number of timepoints reached so far at each stop of each trip
+    def timepoints_by_trip(self):
+        counts = np.cumsum(self.checkpoints, dtype = np.int64)
+        before = np.concatenate([[0], counts])[self.trip_starts[:-1]]
+        counts = counts - np.repeat(before, np.diff(self.trip_starts))
+        return self.by_trip(counts.tolist())
+
+# Read the stop events of a GTFS feed in chunks. Only rows for the given trips and stops are kept
+# (all of them if None); with checkpoints = True, checkpoint_id is read as a flag if the feed has it.
+# With times = True, departure_time is read as well (arrival_time where it is empty, -1 where both are).
+def read_stop_times(inpath, trip_ids = None, stop_ids = None, checkpoints = False, chunksize = 1000000, times = False):
+    report = get_report()
+    span = report.start_stage('read_stop_times')
+    columns = ['trip_id', 'stop_id', 'stop_sequence'] + (['checkpoint_id'] if checkpoints else [])
+    columns += ['arrival_time', 'departure_time'] if times else []
+    allowed_trips = None if trip_ids is None else set(trip_ids)
+    allowed_stops = None if stop_ids is None else set(stop_ids)
+    trip_codes, trip_list = {}, []
+    stop_codes, stop_list = {}, []
+    has_checkpoints = False
+    runs = []
+
+    with open_member(inpath, 'stop_times.txt') as member:
+        chunks = [] if member is None else pd.read_csv(member, dtype = str, encoding = 'utf-8-sig', index_col = False,
+                                                       usecols = lambda column: column.strip() in columns, chunksize = chunksize)
+        for chunk in chunks:
+            chunk.columns = [column.strip() for column in chunk.columns]
+            has_checkpoints = 'checkpoint_id' in chunk.columns
+
+            trips = encode_ids(chunk['trip_id'], trip_codes, trip_list, allowed_trips)
+            stops = encode_ids(chunk['stop_id'], stop_codes, stop_list, allowed_stops)
+            keep = (trips >= 0) & (stops >= 0)
+
+            # stop_sequence has few distinct values, so only those are parsed
+            sequence_codes, sequence_values = pd.factorize(chunk['stop_sequence'])
+            sequence_values = pd.to_numeric(pd.Series(sequence_values).str.strip()).to_numpy()
+            sequence = np.append(sequence_values, 0)[sequence_codes]
+            if np.any(sequence[keep] < 0) or np.any(sequence[keep] != np.floor(sequence[keep])):
+                raise ValueError('stop_sequence must be a non-negative integer')
+
+            run = {'trip': trips[keep],
+                   'stop': stops[keep],
+                   'sequence': sequence[keep].astype(np.int32)}
+            if has_checkpoints:
+                run['checkpoint'] = chunk['checkpoint_id'].notna().to_numpy()[keep]
+            if times:
+                departures = chunk['departure_time'] if 'departure_time' in chunk.columns else pd.Series(np.nan, index = chunk.index)
+                if 'arrival_time' in chunk.columns:
+                    departures = departures.fillna(chunk['arrival_time'])
+                run['time'] = parse_times(departures)[keep]
+            run['key'] = event_keys(run['trip'], run['sequence'])
+
+            # Sort each chunk as it is read, then merge the sorted chunks at the end
+            order = np.argsort(run['key'], kind = 'stable')
+            runs.append({column: values[order] for column, values in run.items()})
+            report.increment('stop_times_chunks')
+
+    if len(runs) == 0:
+        runs = [{'trip': np.zeros(0, dtype = np.int32), 'stop': np.zeros(0, dtype = np.int32),
+                 'sequence': np.zeros(0, dtype = np.int32), 'key': np.zeros(0, dtype = np.int64)}]
+        if times:
+            runs[0]['time'] = np.zeros(0, dtype = np.int32)
+    events = merge_runs(runs)
+    runs = None
+
+    # Trip codes are in the order the trips were first read; renumber them so that trips are in trip_id order,
+    # moving the (already sorted) stop events of each trip as a block
+    trip_order = sorted(range(len(trip_list)), key = lambda code: trip_list[code])
+    ranks = np.empty(len(trip_list), dtype = np.int32)
+    ranks[trip_order] = np.arange(len(trip_list), dtype = np.int32)
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(events['trip'])) + 1]) if len(events['trip']) > 0 else np.zeros(0, dtype = np.int64)
+    lengths = np.diff(np.append(starts, len(events['trip'])))
+    block_order = np.argsort(ranks[events['trip'][starts]])
+    new_starts = np.cumsum(lengths[block_order]) - lengths[block_order]
+    order = np.repeat(starts[block_order] - new_starts, lengths[block_order]) + np.arange(len(events['trip']))
+
+    stop_times = StopTimes(ranks[events['trip'][order]], events['stop'][order], events['sequence'][order],
+                           events['checkpoint'][order] if has_checkpoints else None,
+                           [trip_list[code] for code in trip_order], stop_list,
+                           events['time'][order] if times else None)
+    report.increment('stop_times_rows', len(stop_times))
+    elapsed = report.end_stage(span)
+    logger.info('Read %d stop events for %d trips in %d seconds (peak RSS %s MB)', len(stop_times), len(stop_times.trip_starts) - 1,
+                round(elapsed, 0), peak_rss_mb())
+    return stop_times
+
+# Days of the week (Monday = 0) included in each day type
+day_types = {'weekday': [0, 1, 2, 3, 4], 'saturday': [5], 'sunday': [6]}
+
+# Get the service_ids running on a service date: a datetime.date or 'YYYYMMDD' string, 'busiest' for the
+# date with the most bus trips, or a day type for the date of that type with the most bus trips
+def service_ids(inpath, service_date):
+    ids_by_date = ptg.read_service_ids_by_date(inpath)
+
+    if service_date == 'busiest' or service_date in day_types:
+        weekdays = day_types.get(service_date, range(7))
+        dates = sorted(date for date in ids_by_date if date.weekday() in weekdays)
+        if len(dates) == 0:
+            raise ValueError('No service on any ' + service_date + ' date in ' + str(inpath))
+
+        # Count the bus trips on each date, keeping the earliest of the busiest dates as partridge does
+        feed = ptg.load_feed(inpath, {'routes.txt': {'route_type': ['3']}})
+        trip_counts = feed.trips['service_id'].value_counts().to_dict()
+        counts = [sum(trip_counts.get(service_id, 0) for service_id in ids_by_date[date]) for date in dates]
+        date = dates[counts.index(max(counts))]
+    else:
+        if isinstance(service_date, str):
+            date = datetime.datetime.strptime(service_date, '%Y%m%d').date()
+        else:
+            date = service_date
+        if date not in ids_by_date:
+            raise ValueError('No service on ' + str(date) + ' in ' + str(inpath))
+
+    logger.info('Using %d service_ids running on %s for %s', len(ids_by_date[date]), date, inpath)
+    return ids_by_date[date]
@@ -0,0 +1,111 @@
+"""
+
+This program builds the incidence matrix between the pieces of a decomposed
+network and the segments (route-stop-stop keys, as in the 'indices' property
+of each piece) that use them. The matrix is a SciPy CSR matrix with a row for
+each piece, in the order of the output file, and a column for each segment,
+in sorted key order. Each entry is the number of times a segment uses a piece.
+
+Any metric given per segment, such as trips, scheduled minutes or seats, is
+rolled up to the pieces with a single sparse matrix-vector product:
+
+    pieces = Incidence.from_pieces(gdf)
+    trips_per_piece = pieces.rollup(average_daily_trips)
+
+edge_decomposition saves the matrix of each network next to its output, as
+'<output>_incidence.npz', which can be read back with Incidence.load.
+compare_edges uses the saved matrix (through Incidence.for_output) whenever
+its rows are the pieces it read, in the same order, and only builds the
+matrix from the pieces' 'indices' otherwise, e.g. when it only reads the
+pieces in a region.
+
+"""
+
+import os
+import ast
+import logging
+import numpy as np
+import scipy.sparse as sparse
+
+logger = logging.getLogger(__name__)
+
+# Get the path of the matrix saved next to a decomposition output ('<output>.geojson')
+def incidence_path(inpath):
+    return (inpath[:-len('.geojson')] if inpath.endswith('.geojson') else inpath) + '_incidence.npz'
+
+class Incidence: # Sparse pieces x segments incidence matrix, with the edge of each row and the key of each column
+    def __init__(self, matrix, edges, segment_keys):
+        self.matrix = matrix
+        self.edges = edges
+        self.segment_keys = segment_keys
+        self.columns = {key: column for column, key in enumerate(segment_keys)}
+
+    # Build the matrix from the pieces of a decomposition output (a GeoDataFrame with 'edge' and 'indices')
+    @classmethod
+    def from_pieces(cls, gdf):
+        rows = []
+        keys = []
+        for row, indices in enumerate(gdf['indices']):
+            if isinstance(indices, str): # Dictionaries may have been read as strings, depending on the GeoJSON driver
+                indices = ast.literal_eval(indices)
+            if indices is None:
+                continue
+            rows.extend([row] * len(indices))
+            keys.extend(indices.values())
+        segment_keys, columns = np.unique(np.array(keys, dtype = str), return_inverse = True)
+
+        # Duplicate entries (a segment using a piece more than once) are summed
+        matrix = sparse.csr_matrix((np.ones(len(rows), dtype = np.int64), (np.array(rows, dtype = np.int64), columns.reshape(-1))),
+                                   shape = (len(gdf), len(segment_keys)))
+        return cls(matrix, np.asarray(gdf['edge'], dtype = np.int64), segment_keys.tolist())
+
+    # Read a matrix saved with save
+    @classmethod
+    def load(cls, inpath):
+        with np.load(inpath, allow_pickle = False) as saved:
+            matrix = sparse.csr_matrix((saved['data'], saved['indices'], saved['indptr']), shape = tuple(saved['shape']))
+            return cls(matrix, saved['edges'], saved['segment_keys'].tolist())
+
+    # Get the matrix of the pieces of a decomposition output (a GeoDataFrame read from inpath, in file order): the
+    # saved matrix if it is no older than the output and has a row for each piece on the same edge, or else one
+    # built from the pieces
+    @classmethod
+    def for_output(cls, inpath, gdf):
+        saved_path = incidence_path(inpath)
+        if os.path.exists(saved_path) and os.path.getmtime(saved_path) >= os.path.getmtime(inpath):
+            saved = cls.load(saved_path)
+            if saved.matrix.shape[0] == len(gdf) and np.array_equal(saved.edges, np.asarray(gdf['edge'], dtype = np.int64)):
+                return saved
+            logger.warning('The incidence matrix in %s does not match the pieces of %s, so it is built again', saved_path, inpath)
+        return cls.from_pieces(gdf)
+
+    def save(self, outpath):
+        np.savez_compressed(outpath, data = self.matrix.data, indices = self.matrix.indices, indptr = self.matrix.indptr,
+                            shape = np.array(self.matrix.shape), edges = self.edges,
+                            segment_keys = np.array(self.segment_keys, dtype = str))
+
+    # Convert a dictionary of a metric by segment key into a vector over the columns (0 for missing segments)
+    def segment_vector(self, values, dtype = None):
+        if dtype is None:
+            dtype = np.result_type(*[np.asarray(value).dtype for value in values.values()]) if len(values) > 0 else np.int64
+        vector = np.zeros(len(self.segment_keys), dtype = dtype)
+        for key, value in values.items():
+            column = self.columns.get(key)
+            if column is not None:
+                vector[column] = value
+        return vector
+
+    # Align an array of values with a row for each of a list of segment keys to the columns (0 for missing segments)
+    def segment_values(self, keys, values):
+        values = np.asarray(values)
+        aligned = np.zeros((len(self.segment_keys),) + values.shape[1:], dtype = values.dtype)
+        rows = [row for row, key in enumerate(keys) if key in self.columns]
+        aligned[[self.columns[keys[row]] for row in rows]] = values[rows]
+        return aligned
+
+    # Roll a metric up from the segments to the pieces: a dictionary by segment key, or a vector over the columns.
+    # A vector with a column for each of several metrics (a matrix) is rolled up to a matrix.
+    def rollup(self, values):
+        if isinstance(values, dict):
+            values = self.segment_vector(values)
+        return self.matrix @ values
@@ -0,0 +1,287 @@
+"""
+
+This program collects timing and resource measurements for a busdecomp run
+and writes them out as a run report. A single report is shared by all of
+the pipeline stages and records:
+
+1) Stage spans: the number of times each stage ran, its total wall time and
+   the peak resident memory (RSS) reached while it was running
+2) Latency histograms for the requests sent to Valhalla, by action
+3) Counters, e.g. Valhalla retries, timeouts and search-radius escalations
+4) Cache hits and misses, from which hit rates are reported
+5) Requests, failures and throughput for each Valhalla endpoint in a pool
+
+The report is written as JSON and, optionally, as a Prometheus text file
+that can be picked up by the node_exporter textfile collector.
+
+Nested stages are reported with their full path, e.g.
+'edge_decomposition/match_edges'.
+
+Request latencies are kept as counts in fixed buckets, plus their count, sum
+and maximum, so the report takes the same memory however many requests are
+sent. The p50/p90/p99 latencies are estimated from the buckets.
+
+The peak RSS can only be reset for the whole process, so it is only reset
+when a stage starts while no other stage is running. The peak of a nested
+stage, or of a stage that overlaps another (e.g. the shape generation thread
+in streaming mode, or stages run in thread pools), is the peak since the
+outermost running stage started: an upper bound rather than the stage's own.
+
+"""
+
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+# Upper bounds (in seconds) for the request latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Read the peak RSS of this process (MB) from /proc, falling back to getrusage
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return None
+
+# Reset the peak RSS of the whole process, so that the next reading covers only what follows (Linux only)
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+class Histogram: # Request latencies for one Valhalla action, as counts in fixed buckets
+    def __init__(self):
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def observe(self, seconds):
+        self.bucket_counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    # Estimate the latency at a quantile by interpolating within its bucket, as Prometheus does.
+    # The last bucket has no upper bound, so the maximum is used for it.
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bucket, count in enumerate(self.bucket_counts):
+            if count > 0 and cumulative + count >= rank:
+                lower = LATENCY_BUCKETS[bucket - 1] if bucket > 0 else 0
+                upper = LATENCY_BUCKETS[bucket] if bucket < len(LATENCY_BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - cumulative) / count, self.max)
+            cumulative += count
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'total_seconds': self.total,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'max': self.max,
+                'buckets': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], self.bucket_counts))}
+
+class StageRecord: # Aggregated measurements for every run of one stage
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0
+        self.peak_rss_mb = None
+
+class EndpointRecord: # Requests sent to one Valhalla endpoint
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.busy_seconds = 0
+
+class RunReport: # Collects stage spans, request latencies, counters and cache statistics
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.time()
+            self.stages = {}
+            self.histograms = {}
+            self.counters = {}
+            self.cache_hits = {}
+            self.cache_misses = {}
+            self.endpoints = {}
+            self.open_spans = []
+            self.local = threading.local()
+
+    # Start timing a stage of the pipeline; returns a span to pass to end_stage
+    def start_stage(self, name):
+        parents = getattr(self.local, 'path', [])
+        span = {'path': '/'.join(parents + [name]), 'parents': parents, 'peak': None, 'start': time.time()}
+        self.local.path = parents + [name]
+
+        # Credit the memory used so far to any running stages. The peak is only reset if no other stage is
+        # running, since resetting it would lose the peak of the others.
+        with self.lock:
+            self.update_open_spans(peak_rss_mb())
+            if len(self.open_spans) == 0:
+                reset_peak_rss()
+            self.open_spans.append(span)
+        return span
+
+    # Stop timing a stage and record its wall time and the peak RSS reached during it
+    def end_stage(self, span):
+        elapsed = time.time() - span['start']
+        with self.lock:
+            self.update_open_spans(peak_rss_mb())
+            if span in self.open_spans:
+                self.open_spans.remove(span)
+            record = self.stages.setdefault(span['path'], StageRecord())
+            record.count += 1
+            record.seconds += elapsed
+            if span['peak'] is not None:
+                record.peak_rss_mb = max(record.peak_rss_mb or 0, span['peak'])
+        self.local.path = span['parents']
+        return elapsed
+
+    @contextmanager
+    def stage(self, name):
+        span = self.start_stage(name)
+        try:
+            yield span
+        finally:
+            self.end_stage(span)
+
+    def update_open_spans(self, rss):
+        if rss is None:
+            return
+        for span in self.open_spans:
+            span['peak'] = rss if span['peak'] is None else max(span['peak'], rss)
+
+    def observe_latency(self, action, seconds):
+        with self.lock:
+            self.histograms.setdefault(action, Histogram()).observe(seconds)
+
+    def observe_endpoint(self, endpoint, seconds, failed):
+        with self.lock:
+            record = self.endpoints.setdefault(endpoint, EndpointRecord())
+            record.requests += 1
+            record.failures += int(failed)
+            record.busy_seconds += seconds
+
+    def increment(self, counter, amount = 1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def cache_hit(self, cache, amount = 1):
+        with self.lock:
+            self.cache_hits[cache] = self.cache_hits.get(cache, 0) + amount
+
+    def cache_miss(self, cache, amount = 1):
+        with self.lock:
+            self.cache_misses[cache] = self.cache_misses.get(cache, 0) + amount
+
+    def to_dict(self):
+        with self.lock:
+            stages = {}
+            for path, record in self.stages.items():
+                stages[path] = {'count': record.count,
+                                'seconds': round(record.seconds, 3),
+                                'peak_rss_mb': None if record.peak_rss_mb is None else round(record.peak_rss_mb, 1)}
+
+            caches = {}
+            for cache in sorted(set(self.cache_hits) | set(self.cache_misses)):
+                hits = self.cache_hits.get(cache, 0)
+                misses = self.cache_misses.get(cache, 0)
+                caches[cache] = {'hits': hits,
+                                 'misses': misses,
+                                 'hit_rate': round(hits / (hits + misses), 4) if hits + misses > 0 else None}
+
+            # Throughput is averaged over the whole run so far
+            elapsed = time.time() - self.start_time
+            endpoints = {}
+            for endpoint, record in self.endpoints.items():
+                endpoints[endpoint] = {'requests': record.requests,
+                                       'failures': record.failures,
+                                       'busy_seconds': round(record.busy_seconds, 3),
+                                       'requests_per_second': round(record.requests / elapsed, 3) if elapsed > 0 else None}
+
+            return {'elapsed_seconds': round(elapsed, 3),
+                    'stages': stages,
+                    'valhalla_latency': {action: histogram.summary() for action, histogram in self.histograms.items()},
+                    'valhalla_endpoints': endpoints,
+                    'counters': dict(self.counters),
+                    'caches': caches}
+
+    def write_json(self, outpath):
+        with open(outpath, 'w') as outfile:
+            json.dump(self.to_dict(), outfile, indent = 2)
+
+    def write_prometheus(self, outpath):
+        report = self.to_dict()
+        lines = []
+
+        lines.append('# TYPE busdecomp_stage_seconds gauge')
+        for path, stage in report['stages'].items():
+            lines.append('busdecomp_stage_seconds{stage="%s"} %s' % (path, stage['seconds']))
+        lines.append('# TYPE busdecomp_stage_peak_rss_bytes gauge')
+        for path, stage in report['stages'].items():
+            if stage['peak_rss_mb'] is not None:
+                lines.append('busdecomp_stage_peak_rss_bytes{stage="%s"} %d' % (path, stage['peak_rss_mb'] * 1024 * 1024))
+
+        # Prometheus histogram buckets are cumulative
+        lines.append('# TYPE busdecomp_valhalla_request_seconds histogram')
+        for action, histogram in report['valhalla_latency'].items():
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append('busdecomp_valhalla_request_seconds_bucket{action="%s",le="%s"} %d' % (action, bound, cumulative))
+            lines.append('busdecomp_valhalla_request_seconds_sum{action="%s"} %s' % (action, histogram['total_seconds']))
+            lines.append('busdecomp_valhalla_request_seconds_count{action="%s"} %d' % (action, histogram['count']))
+
+        lines.append('# TYPE busdecomp_valhalla_endpoint_requests_total counter')
+        for endpoint, stats in report['valhalla_endpoints'].items():
+            lines.append('busdecomp_valhalla_endpoint_requests_total{endpoint="%s"} %d' % (endpoint, stats['requests']))
+        lines.append('# TYPE busdecomp_valhalla_endpoint_failures_total counter')
+        for endpoint, stats in report['valhalla_endpoints'].items():
+            lines.append('busdecomp_valhalla_endpoint_failures_total{endpoint="%s"} %d' % (endpoint, stats['failures']))
+        lines.append('# TYPE busdecomp_valhalla_endpoint_busy_seconds_total counter')
+        for endpoint, stats in report['valhalla_endpoints'].items():
+            lines.append('busdecomp_valhalla_endpoint_busy_seconds_total{endpoint="%s"} %s' % (endpoint, stats['busy_seconds']))
+
+        for counter, value in sorted(report['counters'].items()):
+            lines.append('# TYPE busdecomp_%s_total counter' % counter)
+            lines.append('busdecomp_%s_total %s' % (counter, value))
+
+        lines.append('# TYPE busdecomp_cache_hits_total counter')
+        for cache, stats in report['caches'].items():
+            lines.append('busdecomp_cache_hits_total{cache="%s"} %d' % (cache, stats['hits']))
+        lines.append('# TYPE busdecomp_cache_misses_total counter')
+        for cache, stats in report['caches'].items():
+            lines.append('busdecomp_cache_misses_total{cache="%s"} %d' % (cache, stats['misses']))
+
+        with open(outpath, 'w') as outfile:
+            outfile.write('\n'.join(lines) + '\n')
+
+# Report shared by all stages of the pipeline
+run_report = RunReport()
+
+def get_report():
+    return run_report
@@ -0,0 +1,100 @@
+"""
+
+This program provides the linear referencing used to split OSM ways into
+pieces. Lines are given as arrays of coordinates, and every function works on
+all of the points or distances for a line at once:
+
+1) Projecting points onto a line, to get their distance along it
+2) Splitting a line into pieces at a set of distances, in a single pass
+3) Finding the pieces that a traversal of the line covers
+
+Distances are planar (in the units of the coordinates) and are calculated in
+the same way as Shapely's project and interpolate, so results match those of
+the Shapely functions.
+
+"""
+
+import numpy as np
+
+# Get the length of each segment of a line
+def segment_lengths(coords):
+    steps = np.diff(coords, axis = 0)
+    return np.sqrt(steps[:, 0] * steps[:, 0] + steps[:, 1] * steps[:, 1])
+
+# Get the distance along a line at each of its coordinates
+def cumulative_lengths(coords):
+    return np.concatenate([[0], np.cumsum(segment_lengths(coords))])
+
+# Project points onto a line and return their distances along it, measured from the start of the line
+def project(coords, points, cumulative = None):
+    if cumulative is None:
+        cumulative = cumulative_lengths(coords)
+    points = np.asarray(points, dtype = np.float64).reshape(-1, 2)
+
+    # Position of the closest point on each line segment, as a fraction of the segment
+    seg_starts = coords[:-1]
+    seg_vectors = coords[1:] - seg_starts
+    seg_squares = (seg_vectors * seg_vectors).sum(axis = 1)
+    offsets = points[:, None, :] - seg_starts[None, :, :]
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        fractions = (offsets * seg_vectors[None, :, :]).sum(axis = 2) / seg_squares[None, :]
+    fractions = np.clip(np.nan_to_num(fractions, nan = 0.0), 0, 1)
+
+    # Use the closest segment (the first one on ties)
+    closest = seg_starts[None, :, :] + fractions[:, :, None] * seg_vectors[None, :, :]
+    squared_distances = ((points[:, None, :] - closest) ** 2).sum(axis = 2)
+    nearest = np.argmin(squared_distances, axis = 1)
+    nearest_fractions = fractions[np.arange(len(points)), nearest]
+
+    distances = cumulative[nearest] + nearest_fractions * segment_lengths(coords)[nearest]
+    distances[nearest_fractions <= 0] = cumulative[nearest][nearest_fractions <= 0]
+    return distances
+
+# Get the points at distances along a line
+def interpolate(coords, distances, cumulative = None):
+    if cumulative is None:
+        cumulative = cumulative_lengths(coords)
+    distances = np.asarray(distances, dtype = np.float64)
+
+    segments = np.clip(np.searchsorted(cumulative, distances, side = 'right') - 1, 0, len(coords) - 2)
+    seg_lengths = segment_lengths(coords)[segments]
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        fractions = np.where(seg_lengths > 0, (distances - cumulative[segments]) / seg_lengths, 0)
+
+    points = coords[segments] + fractions[:, None] * (coords[segments + 1] - coords[segments])
+    points[distances <= 0] = coords[0]
+    points[distances >= cumulative[-1]] = coords[-1]
+    return points
+
+# Split a line at a sorted list of distances; returns the coordinates of the piece
+# between each pair of consecutive distances
+def split(coords, distances, cumulative = None):
+    if cumulative is None:
+        cumulative = cumulative_lengths(coords)
+    distances = np.asarray(distances, dtype = np.float64)
+    cut_points = interpolate(coords, distances, cumulative)
+
+    # Every piece keeps the line's own vertices that lie strictly between its ends
+    first_vertices = np.searchsorted(cumulative, distances, side = 'right')
+    last_vertices = np.searchsorted(cumulative, distances, side = 'left')
+    pieces = []
+    for index in range(len(distances) - 1):
+        interior = coords[first_vertices[index] : last_vertices[index + 1]]
+        pieces.append(np.vstack([cut_points[index : index + 1], interior, cut_points[index + 1 : index + 2]]))
+    return pieces
+
+# Find the pieces covered by each traversal (start, end) of a line that is split into
+# pieces at the sorted boundary distances. Piece i covers the interval (boundaries[i - 1],
+# boundaries[i]], and the last piece covers everything after the last boundary.
+def assign_pieces(boundaries, starts, ends):
+    starts = np.asarray(starts, dtype = np.float64)
+    ends = np.asarray(ends, dtype = np.float64)
+    if len(boundaries) == 0:
+        return [np.zeros(1, dtype = np.int64) for start in starts]
+
+    # Traversals may run against the direction of the line
+    starts, ends = np.minimum(starts, ends), np.maximum(starts, ends)
+    first_pieces = np.searchsorted(boundaries, starts, side = 'right')
+    last_pieces = np.searchsorted(boundaries, ends, side = 'right')
+    last_pieces[ends > boundaries[-1]] = len(boundaries) + 1
+    return [np.arange(first, last) for first, last in zip(first_pieces, last_pieces)]
@@ -0,0 +1,180 @@
+"""
+
+This program encodes and decodes polylines (Google's Encoded Polyline
+Algorithm Format) in bulk using NumPy. It gives exactly the same results as
+the polyline package, including its rounding, but works on many polylines
+at once instead of one coordinate at a time:
+
+encode_many: Encodes a list of coordinate arrays into a list of polylines.
+             Rounding, deltas and the packing of each delta into 5-bit
+             chunks are done for every coordinate at once.
+
+decode_many: Decodes a list of polylines into a single flat array of
+             coordinates, plus an array of offsets where offsets[i] is the
+             index of the first coordinate of polyline i, so that polyline
+             i is coords[offsets[i]:offsets[i + 1]].
+
+concatenate_many: Joins groups of polylines end to end without decoding
+             them into coordinates. Only the first delta of each appended
+             polyline is re-encoded, relative to the last point of the
+             polyline before it; the rest of its characters are copied.
+
+encode and decode work on a single polyline and return/accept the same
+lists of (lat, lon) tuples as the polyline package.
+
+As in the polyline package, coordinates are in (lat, lon) order unless
+geojson = True, in which case they are in (lon, lat) order.
+
+"""
+
+import numpy as np
+
+# Round half away from zero, as the polyline algorithm uses Python 2 rounding
+def round_half_away(values):
+    return np.copysign(np.floor(np.abs(values) + 0.5), values).astype(np.int64)
+
+# Pack signed integer values into polyline characters; returns the text and the number of characters per value
+def pack_values(values):
+
+    # Zigzag encode the signed values, then split them into 5-bit chunks (at least one per value)
+    zigzag = np.where(values < 0, ~(values << 1), values << 1)
+    chunk_counts = np.ones(len(zigzag), dtype = np.int64)
+    remainder = zigzag >> 5
+    while remainder.any():
+        chunk_counts += remainder > 0
+        remainder >>= 5
+
+    # Write every chunk into one buffer; all chunks but the last of each value get the continuation bit
+    chunk_starts = np.cumsum(chunk_counts) - chunk_counts
+    buffer = np.empty(chunk_counts.sum(), dtype = np.uint8)
+    for chunk in range(chunk_counts.max() if len(chunk_counts) > 0 else 0):
+        has_chunk = chunk_counts > chunk
+        bits = (zigzag[has_chunk] >> (5 * chunk)) & 0x1f
+        bits |= np.where(chunk_counts[has_chunk] > chunk + 1, 0x20, 0)
+        buffer[chunk_starts[has_chunk] + chunk] = bits + 63
+
+    return buffer.tobytes().decode('ascii'), chunk_counts
+
+# Unpack polyline characters into signed integer values; returns the values and the index of the last character of each
+def unpack_values(text):
+    buffer = np.frombuffer(text.encode('ascii'), dtype = np.uint8).astype(np.int64) - 63
+
+    # A chunk without the continuation bit ends a value; find the value and position of each chunk
+    value_ends = np.flatnonzero(buffer < 0x20)
+    value_starts = np.concatenate([[0], value_ends[:-1] + 1])
+    value_ids = np.repeat(np.arange(len(value_ends)), value_ends - value_starts + 1)
+    positions = np.arange(len(buffer)) - value_starts[value_ids]
+
+    # Reassemble and zigzag decode each value
+    zigzag = np.bitwise_or.reduceat((buffer & 0x1f) << (5 * positions), value_starts)
+    return np.where(zigzag & 1, ~(zigzag >> 1), zigzag >> 1), value_ends
+
+# Encode a list of coordinate arrays (or lists of tuples) into a list of polylines
+def encode_many(coord_arrays, precision = 5, geojson = False):
+    factor = int(10 ** precision)
+
+    lengths = np.array([len(coords) for coords in coord_arrays], dtype = np.int64)
+    if lengths.sum() == 0:
+        return [''] * len(coord_arrays)
+    coords = np.concatenate([np.asarray(coords, dtype = np.float64).reshape(-1, 2) for coords in coord_arrays])
+    if geojson:
+        coords = coords[:, ::-1]
+
+    # Round each coordinate, then take differences from the previous point of the same polyline
+    values = round_half_away(coords * factor)
+    deltas = np.empty_like(values)
+    deltas[0] = values[0]
+    deltas[1:] = values[1:] - values[:-1]
+    starts = np.cumsum(lengths) - lengths
+    first_points = starts[lengths > 0]
+    deltas[first_points] = values[first_points]
+    deltas = deltas.ravel()
+
+    # Split the packed text back into one string per polyline
+    text, chunk_counts = pack_values(deltas)
+    value_ends = np.cumsum(lengths) * 2
+    char_ends = np.concatenate([[0], np.cumsum(chunk_counts)])[value_ends]
+    char_starts = np.concatenate([[0], char_ends[:-1]])
+    return [text[start : end] for start, end in zip(char_starts, char_ends)]
+
+# Decode a list of polylines into one flat array of coordinates plus offsets for each polyline
+def decode_many(expressions, precision = 5, geojson = False):
+    factor = float(10 ** precision)
+
+    char_counts = np.array([len(expression) for expression in expressions], dtype = np.int64)
+    if char_counts.sum() == 0:
+        return np.empty((0, 2)), np.zeros(len(expressions) + 1, dtype = np.int64)
+    deltas, value_ends = unpack_values(''.join(expressions))
+    deltas = deltas.reshape(-1, 2)
+
+    # Sum the deltas within each polyline to get the coordinates
+    char_ends = np.cumsum(char_counts)
+    offsets = np.concatenate([[0], np.searchsorted(value_ends, char_ends - 1, side = 'right') // 2])
+    totals = np.cumsum(deltas, axis = 0)
+    lengths = np.diff(offsets)
+    before = np.zeros((len(expressions), 2), dtype = np.int64)
+    has_points = offsets[:-1] > 0
+    before[has_points] = totals[offsets[:-1][has_points] - 1]
+    coords = (totals - np.repeat(before, lengths, axis = 0)) / factor
+
+    if geojson:
+        coords = coords[:, ::-1]
+    return coords, offsets
+
+# Join each group of polylines end to end into one polyline, as if their coordinates had been
+# decoded, concatenated and encoded again. All polylines must have the same precision.
+def concatenate_many(groups):
+    parts = [expression for group in groups for expression in group if len(expression) > 0]
+    group_sizes = [sum(1 for expression in group if len(expression) > 0) for group in groups]
+    if len(parts) == 0:
+        return [''] * len(groups)
+
+    # Find the first point and the sum of all deltas (i.e. the last point) of every polyline
+    text = ''.join(parts)
+    deltas, value_ends = unpack_values(text)
+    deltas = deltas.reshape(-1, 2)
+    char_ends = np.cumsum([len(part) for part in parts])
+    offsets = np.concatenate([[0], np.searchsorted(value_ends, char_ends - 1, side = 'right') // 2])
+    last_points = np.add.reduceat(deltas, offsets[:-1], axis = 0)
+    first_points = deltas[offsets[:-1]]
+
+    # Re-encode the first point of every appended polyline as a delta from the last point before it
+    appended = np.ones(len(parts), dtype = bool)
+    appended[np.cumsum([0] + group_sizes[:-1])[np.array(group_sizes) > 0]] = False
+    new_deltas = first_points[1:] - last_points[:-1]
+    heads, head_counts = pack_values(new_deltas[appended[1:]].ravel())
+    head_ends = np.cumsum(head_counts)[1::2]
+    head_starts = np.concatenate([[0], head_ends[:-1]])
+
+    # Copy the rest of each appended polyline after its first point
+    rest_starts = value_ends[offsets[:-1] * 2 + 1] + 1
+
+    joined = []
+    part = 0
+    head = 0
+    for size in group_sizes:
+        pieces = []
+        for index in range(part, part + size):
+            if appended[index]:
+                pieces.append(heads[head_starts[head] : head_ends[head]])
+                pieces.append(text[rest_starts[index] : char_ends[index]])
+                head += 1
+            else:
+                pieces.append(parts[index])
+        joined.append(''.join(pieces))
+        part += size
+
+    return joined
+
+# Join polylines end to end into one polyline
+def concatenate(expressions):
+    return concatenate_many([expressions])[0]
+
+# Encode a single polyline
+def encode(coordinates, precision = 5, geojson = False):
+    return encode_many([coordinates], precision, geojson)[0]
+
+# Decode a single polyline into a list of coordinate tuples
+def decode(expression, precision = 5, geojson = False):
+    coords, offsets = decode_many([expression], precision, geojson)
+    return [tuple(point) for point in coords.tolist()]
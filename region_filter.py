@@ -0,0 +1,60 @@
+"""
+
+This program limits a run to a region of interest, such as a neighborhood or
+a corridor, so that a focused study doesn't have to process the whole
+network. The region is a Shapely polygon in longitude and latitude, or a
+bounding box (min_lon, min_lat, max_lon, max_lat).
+
+Each stage of the pipeline drops the work outside the region:
+
+1) Shape generation skips the patterns whose stops (or shapes, with
+   gtfs_shapes) don't reach the region, before any of them are matched
+2) Edge decomposition skips the segments that don't intersect the region.
+   Segments that cross its border are kept whole, so that no stop pair is
+   cut in two
+3) Only the ways around the matched edges are read from the road network
+4) compare_edges only compares the pieces that intersect the region
+
+The run report counts the patterns and segments that were skipped.
+
+"""
+
+import numpy as np
+import polyline_codec
+from shapely.geometry import box, LineString, Point
+from shapely.prepared import prep
+
+class Region: # A region of interest, prepared for fast intersection tests
+    def __init__(self, geometry):
+        self.geometry = geometry
+        self.prepared = prep(geometry)
+
+    def intersects(self, geometry):
+        return self.prepared.intersects(geometry)
+
+    # Check whether the line through a list of (lon, lat) points reaches the region
+    def intersects_points(self, points):
+        if len(points) == 0:
+            return False
+        if len(points) == 1:
+            return self.intersects(Point(points[0]))
+        return self.intersects(LineString(points))
+
+    # Get the mask of the rows of a segment table whose encoded polylines intersect the region
+    def segment_mask(self, segments):
+        coords, offsets = polyline_codec.decode_many(segments['geometry'].tolist(), precision = 6, geojson = True)
+        return np.array([self.intersects_points(coords[start : end]) for start, end in zip(offsets[:-1], offsets[1:])],
+                        dtype = bool)
+
+# Convert a polygon or bounding box into a Region (None for no region)
+def as_region(region):
+    if region is None or isinstance(region, Region):
+        return region
+    if isinstance(region, (tuple, list)):
+        region = box(*region)
+    return Region(region)
+
+# Get the bounding box of a list of (lon, lat) points, grown by a margin in degrees
+def points_bbox(points, margin = 0.001):
+    points = np.asarray(points, dtype = np.float64).reshape(-1, 2)
+    return tuple(np.concatenate([points.min(axis = 0) - margin, points.max(axis = 0) + margin]).tolist())
@@ -0,0 +1,200 @@
+"""
+
+This program defines the request policy shared by every call site that sends
+requests to the Valhalla map matching engine. The policy replaces the retry
+loops that were previously written out at each call site and provides:
+
+1) Classification of Valhalla responses into successes, permanent errors
+   (e.g. no path or no suitable edges found, which are never retried) and
+   retryable errors (server errors and transport failures)
+2) Exponential backoff with full jitter between retries
+3) A retry budget shared by every request in a run
+4) A circuit breaker that fails fast while Valhalla is down, and lets a
+   single trial request through once a cooldown has passed
+5) Search-radius escalation for requests that Valhalla could not match,
+   either one radius at a time or speculatively, with several larger radii
+   requested at once. Either way the smallest radius that succeeds is used.
+
+Valhalla error responses contain an 'error_code' and an HTTP 'status_code'.
+Codes below 500 describe a problem with the request itself (bad options,
+no road near a location, no path between locations) and are permanent.
+Codes of 500 and above, and HTTP 5xx/429 status codes, are retryable.
+
+"""
+
+import random
+import threading
+import time
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import get_report
+
+class ValhallaError(Exception): # An error response returned by Valhalla
+    def __init__(self, result):
+        self.result = result
+        self.error_code = result.get('error_code')
+        self.status_code = result.get('status_code')
+        Exception.__init__(self, 'Valhalla error ' + str(self.error_code) + ': ' + str(result.get('error')))
+
+class PermanentValhallaError(ValhallaError): # The request can never succeed as sent, e.g. no path found
+    pass
+
+class RetryableValhallaError(ValhallaError): # The request may succeed if sent again
+    pass
+
+class ValhallaUnavailable(Exception): # Retries, the retry budget or the circuit breaker ran out
+    pass
+
+# Check a Valhalla response and return the matching error, or None for a successful response
+def classify_response(result):
+    if not isinstance(result, dict) or 'error_code' not in result:
+        return None
+
+    error_code = result.get('error_code') or 0
+    status_code = result.get('status_code') or 0
+    if status_code == 429 or status_code >= 500 or error_code >= 500:
+        return RetryableValhallaError(result)
+    return PermanentValhallaError(result)
+
+class RequestPolicy: # Retry, backoff and circuit breaker settings shared by all requests in a run
+    def __init__(self, max_attempts = 4, base_delay = 0.5, max_delay = 30, retry_budget = 500,
+                 breaker_threshold = 5, breaker_cooldown = 30):
+        self.max_attempts = max_attempts # Attempts per request, including the first
+        self.base_delay = base_delay # Backoff before the first retry (seconds), doubled for each retry
+        self.max_delay = max_delay # Upper limit on the backoff (seconds)
+        self.retry_budget = retry_budget # Retries allowed across all requests in the run
+        self.breaker_threshold = breaker_threshold # Consecutive failures before the circuit opens
+        self.breaker_cooldown = breaker_cooldown # Time before a trial request is let through (seconds)
+
+        self.lock = threading.Lock()
+        self.retries_used = 0
+        self.consecutive_failures = 0
+        self.open_until = None
+        self.trial_in_flight = False
+
+    # Send a request using the policy; returns the response or raises a typed error
+    def send(self, transport, action, request_data, timeout):
+        report = get_report()
+        attempt = 0
+        while True:
+            self.check_circuit()
+            attempt += 1
+
+            try:
+                result = transport.post(action, request_data, timeout)
+                error = classify_response(result)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                if isinstance(e, requests.exceptions.Timeout):
+                    report.increment('valhalla_timeouts')
+                error = e
+                result = None
+            except BaseException:
+                # Any other error from the transport (e.g. from the in-process bindings) is raised as it is, but
+                # still counts as a failure, so that a trial request can't leave the circuit breaker stuck open
+                self.record_failure()
+                raise
+
+            # Permanent errors mean Valhalla is up, so they count as a success for the circuit breaker
+            if error is None or isinstance(error, PermanentValhallaError):
+                self.record_success()
+                if error is not None:
+                    report.increment('valhalla_permanent_errors')
+                    raise error
+                return result
+
+            self.record_failure()
+            if attempt >= self.max_attempts:
+                raise ValhallaUnavailable(action + ' request failed after ' + str(attempt) + ' attempts: ' + str(error))
+            self.use_retry(action)
+            report.increment('valhalla_retries')
+            time.sleep(self.backoff(attempt))
+
+    # Full jitter: wait a random time up to the exponential backoff limit
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def use_retry(self, action):
+        with self.lock:
+            if self.retries_used >= self.retry_budget:
+                raise ValhallaUnavailable('Retry budget of ' + str(self.retry_budget) + ' exhausted sending ' + action + ' request')
+            self.retries_used += 1
+
+    def check_circuit(self):
+        with self.lock:
+            if self.open_until is None:
+                return
+            if time.time() < self.open_until or self.trial_in_flight:
+                raise ValhallaUnavailable('Circuit breaker open: Valhalla is not responding')
+
+            # Cooldown has passed: let a single trial request through
+            self.trial_in_flight = True
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.open_until = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.trial_in_flight or self.consecutive_failures >= self.breaker_threshold:
+                if self.open_until is None or self.trial_in_flight:
+                    get_report().increment('circuit_breaker_trips')
+                self.open_until = time.time() + self.breaker_cooldown
+                self.trial_in_flight = False
+
+# Try a request with each search radius in order and return (radius, result) for the smallest
+# radius that succeeds, or (None, None) if Valhalla finds no match for any of them.
+# send(radius) must return a response or raise PermanentValhallaError when nothing is matched.
+# With width > 1, the radii after the first are requested up to width at a time; requests for
+# larger radii are cancelled (or their responses discarded) once the result is known.
+def escalate_radius(send, radii, width = 1, executor = None):
+    report = get_report()
+
+    # The first radius is always sent alone, since most requests succeed with it
+    for index, radius in enumerate(radii[:1] if width > 1 else radii):
+        try:
+            result = send(radius)
+            report.increment('radius_escalations', index)
+            return radius, result
+        except PermanentValhallaError:
+            continue
+    if width <= 1 or len(radii) <= 1:
+        report.increment('radius_escalations', max(len(radii) - 1, 0))
+        return None, None
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers = width)
+
+    pending = deque()
+    next_index = 1
+    try:
+        while next_index < len(radii) or len(pending) > 0:
+
+            # Keep up to width requests in flight, always including the smallest untried radius
+            while next_index < len(radii) and len(pending) < width:
+                pending.append((next_index, executor.submit(send, radii[next_index])))
+                next_index += 1
+                if len(pending) > 1:
+                    report.increment('speculative_radius_requests')
+
+            index, future = pending.popleft()
+            try:
+                result = future.result()
+            except PermanentValhallaError:
+                continue
+
+            report.increment('radius_escalations', index)
+            return radii[index], result
+
+        report.increment('radius_escalations', len(radii) - 1)
+        return None, None
+
+    finally:
+        for index, future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait = False)
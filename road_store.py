@@ -0,0 +1,110 @@
+"""
+
+This program converts the road network shapefile into a compact binary store
+that can be memory-mapped, so that the way geometries are read straight from
+the page cache instead of being loaded as Shapely objects by every process
+that needs them.
+
+A store is a directory containing three NumPy arrays:
+
+way_ids.npy: The OSM way IDs, sorted (int64)
+coords.npy:  The coordinates of every way, one way after another (float64, n x 2)
+offsets.npy: The index of the first coordinate of each way in coords.npy, plus
+             the total number of coordinates at the end (int64)
+
+The store only has to be built once for each road network:
+
+    build_road_store('data/boston_roads.shp', 'data/boston_roads_store')
+
+Ways stored as MultiLineStrings are merged into single lines where their
+parts join end to end. Ways that can't be merged, or have no line geometry,
+are skipped with a warning. Reading the shapefile directly does the same
+(see way_lines), so both kinds of road network path give the same results.
+
+The store directory can then be used in place of the shapefile as the road
+network path. Looking up a way returns a read-only view of its coordinates,
+so any number of worker processes share a single copy of the road network.
+
+"""
+
+import os
+import logging
+import numpy as np
+import geopandas as gpd
+from shapely.ops import linemerge
+
+logger = logging.getLogger(__name__)
+
+# Check whether a path is a road store rather than a shapefile
+def is_road_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'way_ids.npy'))
+
+# Get a dictionary of the line of each way in a road network GeoDataFrame, keeping the last geometry for any
+# repeated way ID. Multi-part ways are merged into one line; ways that can't be merged are left out.
+def way_lines(shapefile):
+    ways = dict(zip(shapefile['osm_id'], shapefile['geometry']))
+    not_lines = (shapefile.geometry.geom_type != 'LineString').to_numpy()
+    for osm_id, geometry in zip(shapefile['osm_id'][not_lines], shapefile['geometry'][not_lines]):
+        if ways.get(osm_id) is not geometry: # Replaced by a later row with the same way ID
+            continue
+        if geometry is not None and geometry.geom_type == 'MultiLineString':
+            geometry = linemerge(geometry)
+        if geometry is None or geometry.is_empty:
+            logger.warning('Skipping way %s without a line geometry', osm_id)
+            del ways[osm_id]
+        elif geometry.geom_type != 'LineString':
+            logger.warning('Skipping way %s: its %s parts do not join into one line', osm_id, geometry.geom_type)
+            del ways[osm_id]
+        else:
+            ways[osm_id] = geometry
+    return ways
+
+# Convert a road network shapefile into a road store
+def build_road_store(road_inpath, store_path):
+
+    shapefile = gpd.read_file(road_inpath, crs='EPSG:4326')
+    ways = {int(osm_id): line for osm_id, line in way_lines(shapefile).items()}
+    shapefile = None
+
+    way_ids = np.array(sorted(ways), dtype = np.int64)
+    coord_list = [np.asarray(ways[way_id].coords, dtype = np.float64)[:, :2] for way_id in way_ids]
+    offsets = np.zeros(len(way_ids) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum([len(coords) for coords in coord_list])
+    coords = np.concatenate(coord_list) if len(coord_list) > 0 else np.empty((0, 2))
+
+    os.makedirs(store_path, exist_ok = True)
+    np.save(os.path.join(store_path, 'coords.npy'), coords)
+    np.save(os.path.join(store_path, 'offsets.npy'), offsets)
+    np.save(os.path.join(store_path, 'way_ids.npy'), way_ids) # Written last, since it marks the store as complete
+
+    logger.info('Road store with %d ways written to %s', len(way_ids), store_path)
+
+class RoadStore: # Memory-mapped road network; maps way IDs to arrays of way coordinates
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.way_ids = np.load(os.path.join(store_path, 'way_ids.npy'), mmap_mode = 'r')
+        self.coords = np.load(os.path.join(store_path, 'coords.npy'), mmap_mode = 'r')
+        self.offsets = np.load(os.path.join(store_path, 'offsets.npy'), mmap_mode = 'r')
+
+    # Find the position of a way in the store, or None if it is not there
+    def find(self, way_id):
+        try:
+            way_id = int(way_id)
+        except (TypeError, ValueError):
+            return None
+        index = int(np.searchsorted(self.way_ids, way_id))
+        if index < len(self.way_ids) and self.way_ids[index] == way_id:
+            return index
+        return None
+
+    def __contains__(self, way_id):
+        return self.find(way_id) is not None
+
+    def __getitem__(self, way_id):
+        index = self.find(way_id)
+        if index is None:
+            raise KeyError(way_id)
+        return self.coords[self.offsets[index] : self.offsets[index + 1]]
+
+    def __len__(self):
+        return len(self.way_ids)
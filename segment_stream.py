@@ -0,0 +1,116 @@
+"""
+
+This program runs shape generation and edge decomposition as a stream. Shape
+generation runs in a background thread and yields the segments of each
+pattern as soon as they are ready; edge decomposition reads them from a
+bounded queue and starts matching edges straight away.
+
+When the queue is full, shape generation waits for edge decomposition to
+catch up, so only a few patterns' segments are held in memory at a time
+however large the feed is. The segments arrive in the same order as the
+full segment table, so the output is the same as running the stages one
+after the other.
+
+The run report counts the batches passed through the queue, and the number
+of times either side had to wait for the other:
+
+stream_batches:        Batches passed from shape generation to edge decomposition
+stream_producer_waits: Times shape generation found the queue full
+stream_consumer_waits: Times edge decomposition found the queue empty
+
+"""
+
+import queue
+import threading
+import logging
+from instrumentation import get_report
+
+logger = logging.getLogger(__name__)
+
+class SegmentStream: # Iterates over the batches from a producer running in a background thread
+    def __init__(self, produce, maxsize = 4, stage = None):
+        self.produce = produce
+        self.stage = stage
+        self.queue = queue.Queue(maxsize = maxsize)
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    # Put the producer's batches on the queue, followed by a marker for the end of the stream or its error.
+    # The marker is put however the producer stops, so that the consumer never waits for it forever.
+    def run(self):
+        report = get_report()
+        span = report.start_stage(self.stage) if self.stage != None else None
+        batches = None
+        marker = ('end', None)
+        try:
+            batches = self.produce()
+            for batch in batches:
+                if not self.put(('batch', batch)):
+                    marker = None # Closed by the consumer
+                    return
+        except Exception as error:
+            logger.error('Segment stream stopped: %s', error)
+            marker = ('error', error)
+        except BaseException as error: # e.g. SystemExit, which is raised in the consumer as an ordinary error
+            logger.error('Segment stream stopped: %r', error)
+            marker = ('error', RuntimeError('Segment stream stopped by ' + repr(error)))
+        finally:
+            # Close the producer's generator straight away, so that it can clean up (e.g. shut down its executors)
+            if hasattr(batches, 'close'):
+                batches.close()
+            if span is not None:
+                report.end_stage(span)
+            if marker is not None:
+                self.put(marker)
+
+    # Wait for space in the queue; gives up if the stream was closed by the consumer
+    def put(self, item):
+        report = get_report()
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            report.increment('stream_producer_waits')
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        report = get_report()
+        try:
+            while True:
+                try:
+                    kind, item = self.queue.get_nowait()
+                except queue.Empty:
+                    report.increment('stream_consumer_waits')
+                    kind, item = self.wait()
+                if kind == 'error':
+                    raise item
+                if kind == 'end':
+                    return
+                report.increment('stream_batches')
+                yield item
+        finally:
+            self.close()
+
+    # Wait for the next item, failing if the producer thread has stopped without leaving one
+    def wait(self):
+        while True:
+            try:
+                return self.queue.get(timeout = 0.1)
+            except queue.Empty:
+                if self.thread.is_alive():
+                    continue
+            try:
+                return self.queue.get_nowait() # Put just before the thread stopped
+            except queue.Empty:
+                raise RuntimeError('Segment stream producer stopped without finishing the stream')
+
+    # Stop the producer, e.g. if the consumer fails part way through the stream
+    def close(self):
+        self.closed.set()
@@ -0,0 +1,125 @@
+"""
+
+This program counts the trips on each segment (the section of a route between
+two consecutive stops, keyed 'route-stop-stop' as in the 'indices' of each
+piece) in each period of the day, so that peak and off-peak service can be
+compared piece by piece rather than as a single daily count.
+
+Periods are given as a dictionary of (start hour, end hour) by name, in hours
+of the service day. GTFS times past 24:00:00 are kept as they are, so trips
+running after midnight fall in a late-night period such as (24, 30) rather
+than in the early morning. Periods can't overlap, and trips outside every
+period are not counted.
+
+Each trip counts in the period of its departure time from the first stop of
+the segment. Stops without times take the time of the stop before them in
+the trip (or after them, before the first timed stop).
+
+Each pair of consecutive stop events of a trip is counted, as for the daily
+metric of compare_edges (see counted_pairs), so that where the periods cover every
+departure, as the default and hourly periods do, the 'metric_<period>'
+columns of a comparison add up to its 'metric' column. Otherwise they add up
+to less, by the trips that depart outside every period or have no times.
+
+The counts are found in one pass over the stop events of the feed: each counted
+pair of consecutive stop events is given a segment code and a period code, and
+the pairs are counted with a single bincount. Counts are rolled up to pieces
+with an Incidence matrix (see incidence.py).
+
+"""
+
+import logging
+import partridge as ptg
+import numpy as np
+import pandas as pd
+import gtfs_io
+
+logger = logging.getLogger(__name__)
+
+# Default periods of the service day, in hours
+default_periods = {'early': (0, 6),
+                   'am_peak': (6, 9),
+                   'midday': (9, 15),
+                   'pm_peak': (15, 19),
+                   'evening': (19, 24),
+                   'night': (24, 30)}
+
+# One period per hour of the service day, named by the hour ('h00', 'h01', ...)
+def hourly_periods(first_hour = 0, last_hour = 30):
+    return {'h%02d' % hour: (hour, hour + 1) for hour in range(first_hour, last_hour)}
+
+# Get the period code of each time in seconds (-1 outside every period), using a table of the period of each minute
+def period_codes(times, periods):
+    bounds = [(int(round(start * 60)), int(round(end * 60))) for start, end in periods.values()]
+    minute_codes = np.full(max([end for start, end in bounds] + [0]), -1, dtype = np.int32)
+    for code, (start, end) in enumerate(bounds):
+        if np.any(minute_codes[start : end] >= 0):
+            raise ValueError('Periods must not overlap')
+        minute_codes[start : end] = code
+
+    minutes = times // 60
+    inside = (times >= 0) & (minutes < len(minute_codes))
+    codes = np.full(len(times), -1, dtype = np.int32)
+    codes[inside] = minute_codes[minutes[inside]]
+    return codes
+
+# Fill the stop events without a time with the time of the stop before them in the trip (or after, at the start)
+def fill_times(stop_times):
+    times = pd.Series(np.where(stop_times.times >= 0, stop_times.times, np.nan))
+    if not times.isna().any():
+        return stop_times.times
+    times = times.groupby(stop_times.trip_codes).ffill()
+    times = times.groupby(stop_times.trip_codes).bfill()
+    return times.fillna(-1).to_numpy(dtype = np.int64)
+
+# Get the index of the first stop event of each pair of stop events counted as a trip on a segment: every pair
+# of consecutive stop events of the same trip, from the first stop of the trip on. compare_edges counts the same
+# pairs for the daily metric.
+def counted_pairs(stop_times):
+    trip_codes = np.asarray(stop_times.trip_codes)
+    return np.flatnonzero(trip_codes[:-1] == trip_codes[1:])
+
+# Count the trips on each segment of a GTFS feed in each period (default_periods if None). Only bus routes
+# are counted, and only trips running on the service date if one is given. Returns the segment keys and
+# an array of the counts with a row for each segment and a column for each period.
+def trips_by_period(inpath, periods = None, service_date = None):
+    if periods is None:
+        periods = default_periods
+
+    # Import GTFS feed and filter down to normal bus routes only (running on the service date, if given)
+    view = {'routes.txt': {'route_type': ['3']}}
+    if service_date != None:
+        view['trips.txt'] = {'service_id': gtfs_io.service_ids(inpath, service_date)}
+    feed = ptg.load_feed(inpath, view)
+
+    # Segments are keyed by route_short_name, as in the decomposition outputs
+    route_names = dict(zip(feed.routes['route_id'], feed.routes['route_short_name']))
+    trip_routes = dict(zip(feed.trips['trip_id'], [route_names[route] for route in feed.trips['route_id']]))
+    feed_stops = gtfs_io.read_table(inpath, 'stops.txt', ['stop_id'])
+    stop_times = gtfs_io.read_stop_times(inpath, trip_ids = feed.trips['trip_id'], stop_ids = feed_stops['stop_id'], times = True)
+    route_codes, route_list = pd.factorize(pd.Series([trip_routes[trip] for trip in stop_times.trip_ids], dtype = object))
+    route_codes = route_codes.astype(np.int64)
+
+    # The pairs of stop events of each trip, with the period of the departure from the first stop
+    trip_codes = stop_times.trip_codes
+    first = counted_pairs(stop_times)
+    period = period_codes(fill_times(stop_times)[first], periods)
+    counted = period >= 0
+    if not counted.all():
+        logger.info('%d trips on segments of %s depart outside every period and are not counted by period',
+                    np.count_nonzero(~counted), inpath)
+    first, period = first[counted], period[counted]
+
+    # Code each segment by its route and stops, and count the trips by segment and period
+    stop_count = np.int64(len(stop_times.stop_ids))
+    keys = ((route_codes[trip_codes[first]] * stop_count + stop_times.stop_codes[first]) * stop_count
+            + stop_times.stop_codes[first + 1])
+    segment_codes, segments = np.unique(keys, return_inverse = True)
+    counts = np.bincount(segments.reshape(-1) * len(periods) + period, minlength = len(segment_codes) * len(periods))
+    counts = counts.reshape(len(segment_codes), len(periods))
+
+    stop_ids = stop_times.stop_ids
+    segment_keys = [str(route_list[code // (stop_count * stop_count)]) + '-' + stop_ids[(code // stop_count) % stop_count]
+                    + '-' + stop_ids[code % stop_count] for code in segment_codes.tolist()]
+    logger.info('Counted trips on %d segments in %d periods for %s', len(segment_keys), len(periods), inpath)
+    return segment_keys, counts
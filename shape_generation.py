@@ -29,19 +29,31 @@ Three dictionaries are constructed:
 """
 
 import math
+import logging
 import partridge as ptg
 import geopandas as gpd
 import pandas as pd
 import numpy as np
-import requests
-import polyline
-import json
+import polyline_codec
 import time
+from valhalla_transport import HttpTransport
+from request_policy import RequestPolicy, PermanentValhallaError, ValhallaUnavailable, escalate_radius
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import get_report
+import gtfs_io
+import region_filter
 from shapely.ops import nearest_points
 from shapely.geometry import LineString, Point
 from tqdm import tqdm
 from math import radians, cos, sin, asin, sqrt
 
+logger = logging.getLogger(__name__)
+
+# Columns of the segment tables passed to edge decomposition
+segment_columns = ['route_id', 'stop_pair', 'direction', 'pattern', 'distance', 'seg_index', 'timepoint_index', 'mode', 'geometry']
+geometry_columns = ['geometry', 'route_id', 'direction', 'seg_index', 'stop_pair', 'distance', 'pattern', 'mode', 'timepoint_index', 'geometry_id']
+link_columns = ['route_id', 'direction', 'pattern', 'sequence', 'seg_index', 'stop_pair', 'timepoint_index', 'geometry_id']
+
 # Function to get distance (in m) from a pair of lat, long coord tuples
 def get_distance(start, end):
     R = 6372800 # earth radius in m
@@ -144,32 +156,173 @@ def get_pattern_index(patterns):
     patterns['pattern_index'] = index
     return patterns   
 
-def get_skipped_segments(coords, request_data):
-    # If request times out, try twice more and then raise an error
-    to_count = 1
-    while to_count < 4:
-        try:
-            # Use Valhalla map matching engine to snap shapes to the road network
-            request_data['shape'] = coords
-            req = requests.post('http://localhost:8002/trace_attributes',
-                                data = json.dumps(request_data),
-                                timeout = 100)
-            to_count = 10
-        except:
-            print("Timeout #", to_count)
-            to_count += 1
-        if to_count == 4:
-            raise Exception('Request timed out 3x')
-
-    # Extract Valhalla response
-    return req.json()
+# Raises PermanentValhallaError if no match is found, or ValhallaUnavailable if retries run out
+def get_skipped_segments(coords, request_data, transport, policy):
+    # Use Valhalla map matching engine to snap shapes to the road network
+    request_data['shape'] = coords
+    return policy.send(transport, 'trace_attributes', request_data, timeout = 100)
  
 def store_geometry_and_distance(result, leg):
     geometry = result['trip']['legs'][leg]['shape']
     distance = result['trip']['legs'][leg]['summary']['length']      
     return Segment(geometry, distance)
 
-def match_segs_to_edges(pair_list, pair_dict, request_parameters):
+# Match the points of a pattern (or a window of it) to the road network with trace_route, sending the
+# rest of the points again whenever the response stops short. Returns the matched segments and the points
+# of the skipped segments, both by segment number.
+def trace_pattern(pattern, coords, coordinate_types, pattern_segs, request_parameters, transport, policy, trace_radius_limit):
+    report = get_report()
+    segment_dict = {}
+    skipped_segs = {}
+    pattern_legs = 0
+    start_point = 0
+    
+    # Send multiple requests to Valhalla if the response is cut off
+    while pattern_legs < pattern_segs:
+        try:
+            # Use Valhalla map matching engine to snap shapes to the road network
+            request_data = request_parameters.copy()
+            request_data['shape'] = coords[start_point:]
+            result = policy.send(transport, 'trace_route', request_data, timeout = 60)
+        except PermanentValhallaError:
+            # No path found - widen the search radius and try again, unless it is already too large
+            if max([int(coord['radius']) for coord in coords]) <= trace_radius_limit:
+                report.increment('radius_escalations')
+                for coord in coords:
+                    coord['radius'] = str(int(coord['radius']) + 10)
+                continue
+            logger.warning("No path found for Pattern %s", pattern)
+            result = None
+        except ValhallaUnavailable as e:
+            logger.warning("Valhalla request failed for Pattern %s: %s", pattern, str(e))
+            result = None
+                
+        if result is None:
+            # Add all segments to skipped_segments
+            input_points = [i - start_point for i, x in enumerate(coordinate_types) if(x == 1 and i >= start_point)]
+            for point_idx, point in enumerate(input_points[:-1]):
+                skipped_segs[point_idx] = coords[point:input_points[point_idx+1]]
+            break
+              
+        # Extract encoded polyline from Valhalla response
+        result_legs = len(result['trip']['legs'])
+            
+        # Check that the result 'matched points' match the input break points
+        matched_points = [location['original_index'] for location in result['trip']['locations']]
+        input_points = [i - start_point for i, x in enumerate(coordinate_types) if(x == 1 and i >= start_point)]
+            
+        # If no points were matched, skip to the next one
+        if len(matched_points) == 0:
+            last_point = input_points[0] + start_point
+            start_point += input_points[1]
+            skipped_segs[pattern_legs] = coords[last_point:start_point+1]
+            pattern_legs += 1
+            continue
+            
+        internal_missed = []
+            
+        # If they are not identical, there are 2 possible cases:
+        # 1) Break points were skipped and 2) Response stopped short
+        if matched_points != input_points:
+    
+            # Get missing points
+            missing = np.setdiff1d(input_points,matched_points)
+                
+            # If the first coord is missing, skip first segment (2)
+            if np.any(missing == 0):
+                last_point = input_points[0] + start_point
+                start_point += input_points[1]
+                skipped_segs[pattern_legs] = coords[last_point:start_point+1]
+                pattern_legs += 1
+                continue
+                
+            # If some inputs were skipped over (1)
+            if min(missing) < max(matched_points):
+                    
+                # Get skipped inputs
+                internal_missed = [i for i in missing if i < max(matched_points)]
+                previous_match = 0
+                skip_count = 0
+                    
+                for missed_point in internal_missed:
+                    input_index = input_points.index(missed_point)
+                    previous_input = input_points[input_index - 1]
+                    next_input = input_points[input_index + 1]
+                        
+                    # Add segments on both sides of skipped stop to skipped list
+                    skipped_segs[pattern_legs + input_index - 1] = coords[previous_input:missed_point + 1]
+                    skipped_segs[pattern_legs + input_index] = coords[missed_point:next_input + 1]
+    
+                    # Find leg before skipped point
+                    last_good_match = max([matched_points.index(i) for i in input_points[:input_index] if i in matched_points])
+                    next_good_match = min([matched_points.index(i) for i in input_points[input_index:] if i in matched_points])
+    
+                    # Store geometry, distance for segments preceding skipped point
+                    for leg in range(previous_match, last_good_match):
+                        segment_dict[pattern_legs + leg + skip_count] = store_geometry_and_distance(result, leg)
+                        
+                    skip_count += 1
+                    previous_match = next_good_match
+                    
+                rem_count = 0
+                # Store geometry, distance for segments after last skipped point
+                for leg in range(next_good_match, result_legs):
+                    segment_dict[input_index + pattern_legs + 1 + rem_count] = store_geometry_and_distance(result, leg)
+                    rem_count += 1
+                    
+                # Start next matching at latest matched point
+                start_point += max([i for i in input_points if i in matched_points])
+                    
+            # If all missing inputs are after last matched point (2)
+            elif len(missing) > 0 and min(missing) > max(matched_points):
+                    
+                # Next request should start from first missing point
+                prev_stop = input_points[input_points.index(min(missing))-1] + start_point
+                start_point += min(missing)
+                    
+                # Determine whether cutoff happened at a stop or in between
+                if max(matched_points) not in input_points:
+                    del_last_seg = 1  
+                else:
+                    del_last_seg = 0
+                    
+                # Add segment between last matched point and missing point to skip list
+                skipped_segs[pattern_legs+result_legs-del_last_seg] = coords[prev_stop:start_point+1]
+                        
+                # Store geometry, distance for segments preceding skipped point
+                for leg in range(result_legs - del_last_seg):  
+                    segment_dict[pattern_legs + leg] = store_geometry_and_distance(result, leg)
+            
+                # If we keep last segment, we need to add 1 to pattern legs
+                pattern_legs += (1 - del_last_seg)
+            
+        # Store distance and geometry        
+        else:
+            for leg in range(result_legs):
+                segment_dict[pattern_legs + leg] = store_geometry_and_distance(result, leg)                        
+            
+        pattern_legs += result_legs + len(internal_missed)
+
+    return segment_dict, skipped_segs
+
+# Split the points of a pattern into windows of at most max_breaks break points, where each window starts
+# at the last break point of the one before. Returns the number of the first segment, and the first and
+# last point, of each window.
+def split_windows(coordinate_types, max_breaks):
+    if max_breaks < 2:
+        raise ValueError('Windows need at least 2 break points')
+    break_points = [i for i, x in enumerate(coordinate_types) if x == 1]
+    windows = []
+    for first_break in range(0, len(break_points) - 1, max_breaks - 1):
+        last_break = min(first_break + max_breaks - 1, len(break_points) - 1)
+        windows.append((first_break, break_points[first_break], break_points[last_break]))
+    return windows
+
+def match_segs_to_edges(pair_list, pair_dict, request_parameters, transport = None, policy = None):
+    if transport is None:
+        transport = HttpTransport()
+    if policy is None:
+        policy = RequestPolicy()
     cm_count = 0 
     start_time = time.time()
    
@@ -178,29 +331,23 @@ def match_segs_to_edges(pair_list, pair_dict, request_parameters):
         pair_index = pair[0]
         
         if pair_index in pair_dict: # If edges already identified, skip
+            get_report().cache_hit('segment_edge_ids')
             cm_count += 1 
             continue
         else:
+            get_report().cache_miss('segment_edge_ids')
             
-            # If request times out, try twice more and then raise an error
-            to_count = 1
-            while to_count < 4:
-                try:
-                    # Use Valhalla map matching engine to snap shapes to the road network
-                    request_data = request_parameters.copy()
-                    request_data['shape'] = geometry
-                    req = requests.post('http://localhost:8002/trace_attributes',
-                                        data = json.dumps(request_data),
-                                        timeout = 100)
-                    to_count = 10
-                except:
-                    print("Timeout #", to_count)
-                    to_count += 1
-                if to_count == 4:
-                    raise Exception('Request ', cm_count,' timed out 3x')
+            # Use Valhalla map matching engine to snap shapes to the road network
+            request_data = request_parameters.copy()
+            request_data['shape'] = geometry
+            try:
+                result = policy.send(transport, 'trace_attributes', request_data, timeout = 100)
+            except PermanentValhallaError as e:
+                logger.warning("No edges found for %s: %s", str(pair_index), str(e))
+                cm_count += 1
+                continue
         
             # Extract Valhalla response and store as pair object attribute
-            result = req.json()
             edges = []
             for edge in result['edges']:
                 edges.append(edge['id'])
@@ -209,8 +356,7 @@ def match_segs_to_edges(pair_list, pair_dict, request_parameters):
         cm_count += 1
         if cm_count % 100 == 0:
             elapsed_time = time.time() - start_time
-            print(cm_count, "of", len(pair_list), "edge ids identified.",
-                  "Elapsed time:", round(elapsed_time,0))
+            logger.info("%d of %d edge ids identified. Elapsed time: %d", cm_count, len(pair_list), round(elapsed_time,0))
             start_time = time.time()
     
     return pair_dict
@@ -307,7 +453,7 @@ def aggregate_shape_by_timepoint(df):    # Group by timepoint id for timepoint s
     agg_df = df.groupby(['timepoint_index'])['route_id', 'stop_pair', 'direction', 'pattern', 'distance', 'seg_index', 'timepoint_index', 'mode', 'geometry'].agg(list)
     
     # Apply aggregation to different fields
-    t_route, t_pair, t_direction, t_pattern, t_distance, t_tindex, t_mode, t_geom = [], [], [], [], [], [], [], []
+    t_route, t_pair, t_direction, t_pattern, t_distance, t_tindex, t_mode = [], [], [], [], [], [], []
     for tp in agg_df.values.tolist():
         t_route.append(tp[0][0]) # All the same, just keep the first one
         t_pair.append(tuple([tp[1][0][0], tp[1][-1][-1]])) # Keep first and last as new pair
@@ -316,16 +462,9 @@ def aggregate_shape_by_timepoint(df):    # Group by timepoint id for timepoint s
         t_distance.append(sum(tp[4])) # Sum all segment distances
         t_tindex.append(tp[6][0]) # All the same, just keep the first one
         t_mode.append(tp[7][0]) # All the same, just keep the first one
-        
-        # For geometry, we need to decode all polylines and then recode
-        poly_list = tp[8]
-        t_coords = []
-        for line in poly_list:
-            coords = polyline.decode(line, precision = 6)
-            for i in coords:
-                t_coords.append(i)
-            
-        t_geom.append(polyline.encode(t_coords, precision = 6))
+    
+    # For geometry, join the segment polylines of each timepoint without decoding them
+    t_geom = polyline_codec.concatenate_many(agg_df['geometry'].tolist())
     
     t_segindex = ["NA"] * len(agg_df) # Add N/A in seg index column to preserve column number
     
@@ -335,12 +474,44 @@ def aggregate_shape_by_timepoint(df):    # Group by timepoint id for timepoint s
     return tp_df
 
 
-def map_matching(inpath, route_ids = None):
-    
+# Join segment batches into one segment table, in the order they were produced
+def concat_batches(batches, columns = segment_columns):
+    batches = list(batches)
+    if len(batches) == 0:
+        return pd.DataFrame([], columns = columns)
+    return pd.concat(batches, ignore_index = True)
+
+# Returns the table of matched segments for every pattern
+def map_matching(inpath, route_ids = None, port = 8002, transport = None, policy = None, speculative_radii = 1,
+                 window_breaks = None, window_workers = 4, service_date = None, region = None):
+    return concat_batches(map_matching_batches(inpath, route_ids, port, transport, policy, speculative_radii,
+                                               window_breaks, window_workers, service_date, region))
+
+# Yields the matched segments of each pattern as a table as soon as the pattern is matched. Stop pairs
+# already matched for the route in an earlier pattern are left out, so the batches joined together
+# form the same table as map_matching.
+# speculative_radii: number of search radii to request at once when Valhalla finds no match (1 = one at a time)
+# window_breaks: split each pattern into overlapping windows of at most this many stops, matched in parallel
+# by window_workers threads (None = send the whole pattern, then the rest of it if the response is cut off)
+# service_date: only match trips running on this date, 'busiest' or day type (None = every trip in the feed)
+# region: only match patterns whose stops reach this polygon or bounding box (see region_filter.py)
+def map_matching_batches(inpath, route_ids = None, port = 8002, transport = None, policy = None, speculative_radii = 1,
+                         window_breaks = None, window_workers = 4, service_date = None, region = None):
+    
+    # Requests go to the Valhalla server on the given port unless another transport is provided
+    if transport is None:
+        transport = HttpTransport(port = port)
+    if policy is None:
+        policy = RequestPolicy()
+    report = get_report()
+    span = report.start_stage('prepare_patterns')
+
     route_type = ['3']
     view = {'routes.txt': {'route_type': route_type}}
     if route_ids != None:
         view['routes.txt']['route_id'] = route_ids
+    if service_date != None:
+        view['trips.txt'] = {'service_id': gtfs_io.service_ids(inpath, service_date)}
     feed = ptg.load_feed(inpath, view)
 
     turn_penalty_factor = 100000 # Penalizes turns in Valhalla routes. Range 0 - 100,000.
@@ -348,6 +519,9 @@ def map_matching(inpath, route_ids = None):
     intermediate_radius = 100 # Radius used to search when matching intermediate coordinates (meters)
     
     stop_distance_threshold  = 1000 # Stop-to-stop distance threshold for including intermediate coordinates (meters)
+    trace_radius_limit = 500 # Largest search radius to widen to when no path is found for a pattern (meters)
+    skipped_radius_limit = 150 # Largest search radius to widen to when no match is found for a skipped segment (meters)
+    radius_step = 10 # Increase in search radius for each new attempt (meters)
     maneuver_penalty = 43200 # Penalty when a route includes a change from one road to another (seconds). Range 0 - 43,200. 
     
     # Initialize Valhalla input dictionary with some empty values
@@ -383,32 +557,18 @@ def map_matching(inpath, route_ids = None):
     except (KeyError, ValueError):
         has_shapes = False
     
-    # Check if timepoints included in GTFS feed
-    try:
-        feed_stop_events = feed.stop_times[['trip_id', 'stop_id', 'stop_sequence', 'checkpoint_id']]
-        has_timepoints = True
-    except (KeyError, ValueError):
-        feed_stop_events = feed.stop_times[['trip_id', 'stop_id', 'stop_sequence']]
-        has_timepoints = False
-    
-    # Get relevant tables from GTFS feed: trips, routes and stop sequences
+    # Get relevant tables from GTFS feed: trips, routes and stop sequences. stop_times is read in
+    # compact chunks rather than through partridge, as it is by far the largest table in the feed
     feed_trips = convert_route_ids(feed.trips[['route_id','trip_id','direction_id']], feed)
-    all_stops = pd.merge(feed_trips, feed_stop_events, on='trip_id', how='inner')
-    all_stops = all_stops.sort_values(by=['trip_id', 'stop_sequence'])
-    stops_dict = all_stops.groupby('trip_id')['stop_id'].agg(list).to_dict()
+    feed_stops = gtfs_io.read_table(inpath, 'stops.txt', ['stop_id','stop_lat','stop_lon'])
+    stop_times = gtfs_io.read_stop_times(inpath, trip_ids = feed_trips['trip_id'], stop_ids = feed_stops['stop_id'],
+                                         checkpoints = True)
+    stops_dict = stop_times.stops_by_trip()
     
-    # Get timepoints and change timepoints from binary to increasing count
+    # Get timepoints as an increasing count, if timepoints are included in the GTFS feed
+    has_timepoints = stop_times.checkpoints is not None
     if has_timepoints == True:
-        tp_dict = all_stops.groupby('trip_id')['checkpoint_id'].agg(list).to_dict()
-        for trip in tp_dict:
-            tp_list = tp_dict[trip]
-            new_list = []
-            tp_count = 0
-            for stop in tp_list:
-                if type(stop) == str:
-                    tp_count += 1
-                new_list.append(tp_count)
-            tp_dict[trip] = new_list
+        tp_dict = stop_times.timepoints_by_trip()
             
     else:
         # Enter zeros
@@ -417,13 +577,9 @@ def map_matching(inpath, route_ids = None):
             tp_dict[trip] = [0] * len(stops_dict[trip])
             
     # Get coordinates for each stop from gtfs
-    feed_stops = feed.stops[['stop_id','stop_lat','stop_lon']].copy()
-    stop_coordinates = list(zip(feed_stops.stop_lat, feed_stops.stop_lon))
-    feed_stops['coords'] = stop_coordinates.copy()
-    feed_stops = feed_stops[['stop_id','coords']].drop_duplicates()
-    stop_df = pd.merge(all_stops, feed_stops, on='stop_id', how='inner')
-    stop_df = stop_df.sort_values(by=['trip_id', 'stop_sequence'])
-    coords_dict = stop_df.groupby('trip_id')['coords'].agg(list).to_dict()
+    stop_coordinates = zip(pd.to_numeric(feed_stops.stop_lat), pd.to_numeric(feed_stops.stop_lon))
+    coord_dict = dict(zip(feed_stops.stop_id, stop_coordinates))
+    coords_dict = {trip: [coord_dict[stop] for stop in stops] for trip, stops in stops_dict.items()}
     
     # Find the unique sequences of stops (patterns)
     hashes = {}
@@ -479,6 +635,14 @@ def map_matching(inpath, route_ids = None):
             
         pattern_dict[index] = Pattern(route, direction, stops, trips, stop_coords, shape, timepoints)
     
+    # Skip the patterns whose stops don't reach the region of interest
+    region = region_filter.as_region(region)
+    if region is not None:
+        region_patterns = [pattern for pattern in pattern_list
+                           if region.intersects_points([(lon, lat) for lat, lon in pattern_dict[pattern].stop_coords])]
+        report.increment('region_skipped_patterns', len(pattern_list) - len(region_patterns))
+        pattern_list = region_patterns
+    
     # If there are no shapes in GTFS, default to the stop coordinates
     if has_shapes == False:
         for pattern in pattern_list:
@@ -499,19 +663,31 @@ def map_matching(inpath, route_ids = None):
     else:
         feed_shapes = feed.shapes[['shape_id', 'shape_pt_lat', 'shape_pt_lon']]
         count = 0
+        
+        # Patterns with the same shape and stops (e.g. on different routes) share the same coordinates
+        located_stops = {}
+        shape_points = {}
         for pattern in pattern_list:
             shape = pattern_dict[pattern].shape
             stop_coords = pattern_dict[pattern].stop_coords
-            shape_coords = feed_shapes.loc[feed_shapes['shape_id']==shape][['shape_pt_lat', 'shape_pt_lon']]
             
-            coordinate_type, coordinate_list, radii = locate_stops_in_shapes(shape_coords, stop_coords, stop_radius, intermediate_radius, stop_distance_threshold)
+            memo_key = (shape, tuple(pattern_dict[pattern].stops))
+            if memo_key in located_stops:
+                report.cache_hit('located_stops')
+            else:
+                report.cache_miss('located_stops')
+                if shape not in shape_points:
+                    shape_points[shape] = feed_shapes.loc[feed_shapes['shape_id']==shape][['shape_pt_lat', 'shape_pt_lon']]
+                located_stops[memo_key] = locate_stops_in_shapes(shape_points[shape], stop_coords, stop_radius, intermediate_radius, stop_distance_threshold)
+            
+            coordinate_type, coordinate_list, radii = located_stops[memo_key]
             pattern_dict[pattern].coord_types = coordinate_type
             pattern_dict[pattern].radii = radii
               
             # Unrelated, but we'll need this dictionary later
             pattern_dict[pattern].shape_coords = coordinate_list
             count +=1 
-            if count % 100 == 0: print('Coordinates prepared for', count, 'of', len(pattern_list), 'patterns')
+            if count % 100 == 0: logger.info('Coordinates prepared for %d of %d patterns', count, len(pattern_list))
     
         # Check that the number of 'break's is equal to number of stops in the pattern
         for pattern in pattern_list:
@@ -521,7 +697,7 @@ def map_matching(inpath, route_ids = None):
             num_stops = len(pattern_dict[pattern].stops)
             num_breaks = coord_types.count(1)
             if num_breaks - num_stops != 0:
-                print("Error: Breaks - Stops =", num_breaks - num_stops,"for Pattern", pattern)
+                logger.warning("Error: Breaks - Stops = %d for Pattern %s", num_breaks - num_stops, pattern)
               
             coords = pattern_dict[pattern].shape_coords
             coord_list = []
@@ -543,283 +719,195 @@ def map_matching(inpath, route_ids = None):
                 
             pattern_dict[pattern].v_input = coord_list
     
-    # Use map matching to convert the GTFS polylines to matched, encoded polylines
+    # Use map matching to convert the GTFS polylines to matched, encoded polylines, one pattern at a time
+    report.end_stage(span)
     mm_count = 0
-    segment_dict = {}
-    skipped_segs = {}
     start_time = time.time()
+    executor = ThreadPoolExecutor(max_workers = speculative_radii) if speculative_radii > 1 else None
+    window_executor = ThreadPoolExecutor(max_workers = window_workers) if window_breaks is not None else None
+    pair_dict = {}
+    pair_geom = {}
+    route_dict = {}
+    used_route_pairs = set()
     
-    for pattern in pattern_list:
-        coords = pattern_dict[pattern].v_input
-        coordinate_types = pattern_dict[pattern].coord_types
-        pattern_segs = len(pattern_dict[pattern].stops)-1
-        pattern_legs = 0
-        start_point = 0
+    # The executors are shut down however the generator ends, including when a stream is closed early
+    try:
+        for pattern in pattern_list:
+            span = report.start_stage('trace_route')
+            segment_dict = {}
+            skipped_segs = {}
+            coords = pattern_dict[pattern].v_input
+            coordinate_types = pattern_dict[pattern].coord_types
+            pattern_segs = len(pattern_dict[pattern].stops)-1
+            pattern_legs = 0
+            start_point = 0
         
-        # Send multiple requests to Valhalla if the response is cut off
-        while pattern_legs < pattern_segs:
-            # If request times out, try twice more and then raise an error
-            to_count = 1
-            while to_count < 6:
-                try:
-                    # Use Valhalla map matching engine to snap shapes to the road network
-                    request_data = request_parameters.copy()
-                    request_data['shape'] = coords[start_point:]
-                    req = requests.post('http://localhost:8002/trace_route',
-                                        data = json.dumps(request_data),
-                                        timeout = 60)
-                    to_count = 10
-                except:
-                    print("Timeout #", to_count)
-                    to_count += 1
-                    
-                if to_count == 6:
-                    # Add all segments to skipped_segments
-                    coords = pattern_dict[pattern].v_input
-                    input_points = [i - start_point for i, x in enumerate(coordinate_types) if(x == 1 and i >= start_point)]
-                    for point_idx, point in enumerate(input_points[:-1]):
-                        skipped_segs[(pattern, point_idx)] = coords[point:input_points[point_idx+1]]
-                    break
-           
-            if to_count == 6:
-                mm_count += 1
-                break
-              
-            # Extract encoded polyline from Valhalla response
-            result = req.json()
-            try: 
-                result_legs = len(result['trip']['legs'])
-            except:
-                # Assume timeout caused by high turn penalty - temporarily set lower
-                for coord in coords:
-                    radius = int(coord['radius'])
-                    coord['radius'] = str(radius + 10)
-                    if radius > 500:
-                        raise Exception('No path found')
-                continue
-            
-            # Check that the result 'matched points' match the input break points
-            matched_points = [location['original_index'] for location in result['trip']['locations']]
-            input_points = [i - start_point for i, x in enumerate(coordinate_types) if(x == 1 and i >= start_point)]
-            
-            # If no points were matched, skip to the next one
-            if len(matched_points) == 0:
-                last_point = input_points[0] + start_point
-                start_point += input_points[1]
-                skipped_segs[(pattern, pattern_legs)] = coords[last_point:start_point+1]
-                pattern_legs += 1
-                continue
-            
-            internal_missed = []
-            
-            # If they are not identical, there are 2 possible cases:
-            # 1) Break points were skipped and 2) Response stopped short
-            if matched_points != input_points:
-    
-                # Get missing points
-                missing = np.setdiff1d(input_points,matched_points)
-                
-                # If the first coord is missing, skip first segment (2)
-                if np.any(missing == 0):
-                    last_point = input_points[0] + start_point
-                    start_point += input_points[1]
-                    skipped_segs[(pattern, pattern_legs)] = coords[last_point:start_point+1]
-                    pattern_legs += 1
-                    continue
-                
-                # If some inputs were skipped over (1)
-                if min(missing) < max(matched_points):
-                    
-                    # Get skipped inputs
-                    internal_missed = [i for i in missing if i < max(matched_points)]
-                    previous_match = 0
-                    skip_count = 0
-                    
-                    for missed_point in internal_missed:
-                        input_index = input_points.index(missed_point)
-                        previous_input = input_points[input_index - 1]
-                        next_input = input_points[input_index + 1]
-                        
-                        # Add segments on both sides of skipped stop to skipped list
-                        skipped_segs[(pattern, pattern_legs + input_index - 1)] = coords[previous_input:missed_point + 1]
-                        skipped_segs[(pattern, pattern_legs + input_index)] = coords[missed_point:next_input + 1]
-    
-                        # Find leg before skipped point
-                        last_good_match = max([matched_points.index(i) for i in input_points[:input_index] if i in matched_points])
-                        next_good_match = min([matched_points.index(i) for i in input_points[input_index:] if i in matched_points])
-    
-                        # Store geometry, distance for segments preceding skipped point
-                        for leg in range(previous_match, last_good_match):
-                            segment_dict[(pattern, pattern_legs + leg + skip_count)] = store_geometry_and_distance(result, leg)
-                        
-                        skip_count += 1
-                        previous_match = next_good_match
-                    
-                    rem_count = 0
-                    # Store geometry, distance for segments after last skipped point
-                    for leg in range(next_good_match, result_legs):
-                        segment_dict[(pattern, input_index + pattern_legs + 1 + rem_count)] = store_geometry_and_distance(result, leg)
-                        rem_count += 1
-                    
-                    # Start next matching at latest matched point
-                    start_point += max([i for i in input_points if i in matched_points])
-                    
-                # If all missing inputs are after last matched point (2)
-                elif len(missing) > 0 and min(missing) > max(matched_points):
-                    
-                    # Next request should start from first missing point
-                    prev_stop = input_points[input_points.index(min(missing))-1] + start_point
-                    start_point += min(missing)
-                    
-                    # Determine whether cutoff happened at a stop or in between
-                    if max(matched_points) not in input_points:
-                        del_last_seg = 1  
-                    else:
-                        del_last_seg = 0
-                    
-                    # Add segment between last matched point and missing point to skip list
-                    skipped_segs[(pattern, pattern_legs+result_legs-del_last_seg)] = coords[prev_stop:start_point+1]
-                        
-                    # Store geometry, distance for segments preceding skipped point
-                    for leg in range(result_legs - del_last_seg):  
-                        segment_dict[(pattern, pattern_legs + leg)] = store_geometry_and_distance(result, leg)
-            
-                    # If we keep last segment, we need to add 1 to pattern legs
-                    pattern_legs += (1 - del_last_seg)
-            
-            # Store distance and geometry        
+            if window_breaks is None:
+                segment_dict, skipped_segs = trace_pattern(pattern, coords, coordinate_types, pattern_segs, request_parameters,
+                                                           transport, policy, trace_radius_limit)
+        
+            # Match overlapping windows of the pattern in parallel, then number their segments from the start of the pattern
             else:
-                for leg in range(result_legs):
-                    segment_dict[(pattern, pattern_legs + leg)] = store_geometry_and_distance(result, leg)                        
-            
-            pattern_legs += result_legs + len(internal_missed)
-    
-        mm_count += 1
-        if mm_count % 100 == 0:
-            elapsed_time = time.time() - start_time
-            print(mm_count, "of", len(pattern_list), "patterns snapped to road network.", "Elapsed time:", round(elapsed_time,0))
-            start_time = time.time()
-    
-    # Run a check that all segments are either in the matched segments or skipped segments
-    for pattern in pattern_list:
-        pattern_segs = len(pattern_dict[pattern].stops) - 1
-        for segment in range(pattern_segs):
-            if (pattern, segment) not in segment_dict and (pattern, segment) not in skipped_segs:
-                print("Error: Pattern " + pattern + ", Seg " + str(segment) + " not assigned.")
-    
-    # Run a check that the number of segments in each pattern is less than (#stops - 1)
-    for key in segment_dict:
-        pattern = key[0]
-        segment = key[1]
-        if segment > len(pattern_dict[pattern].stops) - 1:
-            print("Error: Too many segments assigned to pattern " + pattern)
-    
-    # Run the skipped shapes through trace_attributes to get shapes and distance
-    pair_dict = {}
-    pair_geom = {}
-    for seg in skipped_segs:
-        pattern = seg[0]
-        sequence = seg[1]
-        pair = tuple(pattern_dict[pattern].stops[sequence:sequence+2])
+                windows = split_windows(coordinate_types, window_breaks)
+                report.increment('trace_windows', len(windows))
+                futures = []
+                for first_segment, first_point, last_point in windows:
+                    window_coords = [coord.copy() for coord in coords[first_point:last_point + 1]] # Windows share their end points
+                    window_types = coordinate_types[first_point:last_point + 1]
+                    futures.append(window_executor.submit(trace_pattern, pattern, window_coords, window_types, window_types.count(1) - 1,
+                                                          request_parameters, transport, policy, trace_radius_limit))
+                for (first_segment, first_point, last_point), future in zip(windows, futures):
+                    window_segments, window_skipped = future.result()
+                    for segment in window_segments:
+                        segment_dict[first_segment + segment] = window_segments[segment]
+                    for segment in window_skipped:
+                        skipped_segs[first_segment + segment] = window_skipped[segment]
         
-        # If this pair has already been matched as part of another pattern
-        if pair in pair_geom: 
-            segment_dict[seg] = Segment(pair_geom[pair][0], pair_geom[pair][1])   
-            continue
+            segment_dict = {(pattern, segment): segment_dict[segment] for segment in segment_dict}
+            skipped_segs = {(pattern, segment): skipped_segs[segment] for segment in skipped_segs}
+    
+            mm_count += 1
+            if mm_count % 100 == 0:
+                elapsed_time = time.time() - start_time
+                logger.info("%d of %d patterns snapped to road network. Elapsed time: %d", mm_count, len(pattern_list), round(elapsed_time,0))
+                start_time = time.time()
+    
+            # Run a check that all segments are either in the matched segments or skipped segments
+            pattern_segs = len(pattern_dict[pattern].stops) - 1
+            for segment in range(pattern_segs):
+                if (pattern, segment) not in segment_dict and (pattern, segment) not in skipped_segs:
+                    logger.warning("Error: Pattern %s, Seg %d not assigned.", pattern, segment)
         
-        coords = skipped_segs[seg].copy()
-        result = get_skipped_segments(coords, request_parameters)
-        no_match = False
-        while len(result) == 4: # A result with length 4 indicates an error message from Valhalla: No match found
-            for coord in coords:
-                point_radius = int(coord['radius']) # Convert to int because stored as str for Valhalla input
-                coord['radius'] = point_radius + 10 # Increase search radius to find nearby road segments if needed
-            result = get_skipped_segments(coords, request_parameters)
-            if point_radius > 150: # If search radius becomes too large, there is no roadway nearby and abort matching
-                no_match = True
-                break
-            
-        if no_match:
-            continue
+            # Run a check that the number of segments in each pattern is less than (#stops - 1)
+            for key in segment_dict:
+                segment = key[1]
+                if segment > len(pattern_dict[pattern].stops) - 1:
+                    logger.warning("Error: Too many segments assigned to pattern %s", pattern)
+        
+            # Run the skipped shapes through trace_attributes to get shapes and distance
+            report.end_stage(span)
+            span = report.start_stage('skipped_segments')
+            for seg in skipped_segs:
+                pattern = seg[0]
+                sequence = seg[1]
+                pair = tuple(pattern_dict[pattern].stops[sequence:sequence+2])
+        
+                # If this pair has already been matched as part of another pattern
+                if pair in pair_geom: 
+                    segment_dict[seg] = Segment(pair_geom[pair][0], pair_geom[pair][1])   
+                    report.cache_hit('skipped_segment_pairs')
+                    continue
+                report.cache_miss('skipped_segment_pairs')
+        
+                # Increase search radius to find nearby road segments if needed, until it becomes too large
+                # (then there is no roadway nearby and matching is aborted)
+                point_radius = int(skipped_segs[seg][-1]['radius']) # Convert to int because stored as str for Valhalla input
+                offsets = [0]
+                while point_radius + offsets[-1] <= skipped_radius_limit:
+                    offsets.append(offsets[-1] + radius_step)
+        
+                # Copy the points for each request so that widening the radius doesn't change neighbouring segments
+                def send(offset, seg = seg):
+                    coords = [coord.copy() for coord in skipped_segs[seg]]
+                    if offset > 0:
+                        for coord in coords:
+                            coord['radius'] = int(coord['radius']) + offset
+                    return get_skipped_segments(coords, request_parameters.copy(), transport, policy)
+        
+                offset, result = escalate_radius(send, offsets, speculative_radii, executor)
+                if result is None:
+                    continue
             
-        seg_length = 0
-        edge_ids = []
-        for edge in result['edges']:
-            seg_length += edge['length']
-            edge_ids.append(edge['id'])
-        segment_dict[seg] = Segment(result['shape'], seg_length)      
+                seg_length = 0
+                edge_ids = []
+                for edge in result['edges']:
+                    seg_length += edge['length']
+                    edge_ids.append(edge['id'])
+                segment_dict[seg] = Segment(result['shape'], seg_length)      
         
-        # Store edge ids to avoid any duplicate requests
-        pair_geom[pair] = [result['shape'], seg_length]
-        pair_dict[pair] = edge_ids
-    
-    # Construct a dataframe sorted by pattern, sequence with encoded polylines
-    route_dict = {}
-    used_route_pairs = set()
-    df_route, df_pair, df_dir, df_pattern, df_dist, df_index, df_tp, df_encodedline = [], [], [], [], [], [], [], [] 
+                # Store edge ids to avoid any duplicate requests
+                pair_geom[pair] = [result['shape'], seg_length]
+                pair_dict[pair] = edge_ids
     
-    for pattern in pattern_list:
-        route = pattern_dict[pattern].route
-        direction = pattern_dict[pattern].direction
-        stops = pattern_dict[pattern].stops
-        timepoints = pattern_dict[pattern].timepoints
-        for stop in range(len(stops)-1):
-            pair = (stops[stop], stops[stop+1])
-            tp = timepoints[stop]
-            if (pair + (route,)) not in used_route_pairs:
-                if (pattern, stop) not in segment_dict:
-                    continue
+            report.end_stage(span)
+        
+            # Construct a dataframe for the pattern sorted by sequence with encoded polylines
+            df_route, df_pair, df_dir, df_pattern, df_dist, df_index, df_tp, df_encodedline = [], [], [], [], [], [], [], [] 
+            route = pattern_dict[pattern].route
+            direction = pattern_dict[pattern].direction
+            stops = pattern_dict[pattern].stops
+            timepoints = pattern_dict[pattern].timepoints
+            for stop in range(len(stops)-1):
+                pair = (stops[stop], stops[stop+1])
+                tp = timepoints[stop]
+                if (pair + (route,)) not in used_route_pairs:
+                    if (pattern, stop) not in segment_dict:
+                        continue
                     
-                df_route.append(route)                
-                df_pair.append(pair)
-                df_dir.append(direction)
-                df_pattern.append(pattern)
-                df_encodedline.append(segment_dict[(pattern, stop)].geometry)
-                df_dist.append(segment_dict[(pattern, stop)].distance)
-                df_index.append(str(route) + '-' + str(pair[0]) + '-' + str(pair[1]))
-                df_tp.append(pattern + '-' + str(tp))
-                used_route_pairs.add((pair + (route,)))
+                    df_route.append(route)                
+                    df_pair.append(pair)
+                    df_dir.append(direction)
+                    df_pattern.append(pattern)
+                    df_encodedline.append(segment_dict[(pattern, stop)].geometry)
+                    df_dist.append(segment_dict[(pattern, stop)].distance)
+                    df_index.append(str(route) + '-' + str(pair[0]) + '-' + str(pair[1]))
+                    df_tp.append(pattern + '-' + str(tp))
+                    used_route_pairs.add((pair + (route,)))
             
-                if pair in route_dict:
+                    if pair in route_dict:
                     
-                    route_dict[pair].append(route)
-                else:
-                    route_dict[pair] = list([route])
-    
-    df_mode = ['bus'] * len(df_route)
-    df = pd.DataFrame(list(zip(df_route, df_pair, df_dir, df_pattern, df_dist, df_index, df_tp, df_mode, df_encodedline)), 
-                      columns = ['route_id', 'stop_pair', 'direction', 'pattern', 'distance', 'seg_index', 'timepoint_index', 'mode', 'geometry'])
+                        route_dict[pair].append(route)
+                    else:
+                        route_dict[pair] = list([route])
+        
+            # Patterns whose segments were all matched for the same route before have nothing new
+            if len(df_route) > 0:
+                df_mode = ['bus'] * len(df_route)
+                yield pd.DataFrame(list(zip(df_route, df_pair, df_dir, df_pattern, df_dist, df_index, df_tp, df_mode, df_encodedline)), 
+                                   columns = segment_columns)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait = False)
+        if window_executor is not None:
+            window_executor.shutdown(wait = False)
 
-    # Return the dataframe and the correspondence dictionary
-    return df
 
+# Returns a table of unique segment geometries, plus (with return_links) a table linking
+# each stop pair of each pattern to its geometry by geometry_id
+def shape_matching(inpath, route_ids = None, return_links = False, service_date = None, region = None):
+    links = [] if return_links else None
+    df = concat_batches(shape_matching_batches(inpath, route_ids, links, service_date, region), geometry_columns)
+    if return_links:
+        return df, pd.DataFrame(links, columns = link_columns)
+    return df
 
-def shape_matching(inpath, route_ids = None):
+# Yields the unique segment geometries that each pattern adds to the geometry table, as soon as
+# the pattern's shape is split. If a links list is given, the link rows of every pattern are added to it.
+def shape_matching_batches(inpath, route_ids = None, links = None, service_date = None, region = None):
     
+    report = get_report()
+    span = report.start_stage('prepare_patterns')
+
     route_type = ['3']
     view = {'routes.txt': {'route_type': route_type}}
     if route_ids != None:
         view['routes.txt']['route_id'] = route_ids
+    if service_date != None:
+        view['trips.txt'] = {'service_id': gtfs_io.service_ids(inpath, service_date)}
     feed = ptg.load_geo_feed(inpath, view)
     
-    # Check if timepoints included in GTFS feed
-    try:
-        feed_stop_events = feed.stop_times[['trip_id', 'stop_id', 'stop_sequence', 'checkpoint_id']]
-        has_timepoints = True
-    except:
-        feed_stop_events = feed.stop_times[['trip_id', 'stop_id', 'stop_sequence']]
-        has_timepoints = False
-    
-    feed_stops = feed.stops[['stop_id','geometry']]
-    
-    # Get relevant tables from GTFS feed: trips, routes and stop sequences
+    # Get relevant tables from GTFS feed: trips, routes and stop sequences. stop_times is read in
+    # compact chunks rather than through partridge, as it is by far the largest table in the feed
     feed_trips = convert_route_ids(feed.trips[['route_id','trip_id','direction_id', 'shape_id']], feed)
-    all_stops = pd.merge(feed_trips, feed_stop_events, on='trip_id', how='inner')
-    all_stops = all_stops.sort_values(by=['trip_id', 'stop_sequence'])
-    stops_dict = all_stops.groupby('trip_id')['stop_id'].agg(list).to_dict()
+    feed_stops = gtfs_io.read_table(inpath, 'stops.txt', ['stop_id','stop_lat','stop_lon'])
+    stop_times = gtfs_io.read_stop_times(inpath, trip_ids = feed_trips['trip_id'], stop_ids = feed_stops['stop_id'],
+                                         checkpoints = True)
+    stops_dict = stop_times.stops_by_trip()
+    has_timepoints = stop_times.checkpoints is not None
     
     # Get Point object for each stop from gtfs feed
-    stop_coord_dict = dict(zip(feed_stops.stop_id, feed_stops.geometry))
+    stop_points = [Point(lon, lat) for lon, lat in zip(pd.to_numeric(feed_stops.stop_lon), pd.to_numeric(feed_stops.stop_lat))]
+    stop_coord_dict = dict(zip(feed_stops.stop_id, stop_points))
     
     # Find the unique shapes
     shapes = feed.shapes
@@ -830,27 +918,15 @@ def shape_matching(inpath, route_ids = None):
     route_dict = all_trips.groupby(['shape_id'])['route_id'].agg(list).to_dict()
     dir_dict = all_trips.groupby(['shape_id'])['direction_id'].agg(list).to_dict()
     
-    # Add route and stop sequence information to the shapes dataframe
-    trip_list = [trip_dict[shape][0] for shape in list(shapes['shape_id'])]
+    # Add route information to the shapes dataframe
     route_list = [route_dict[shape][0] for shape in list(shapes['shape_id'])]
     direction_list = [dir_dict[shape][0] for shape in list(shapes['shape_id'])]
-    sequences = [stops_dict[trip] for trip in trip_list]
     shapes['direction_id'] = direction_list
     shapes['route_id'] = route_list
-    shapes['stops'] = sequences
     
     # Get timepoints and change timepoints from binary to increasing count
     if has_timepoints == True:
-        tp_dict = all_stops.groupby('trip_id')['checkpoint_id'].agg(list).to_dict()
-        for trip in tp_dict:
-            tp_list = tp_dict[trip]
-            new_list = []
-            tp_count = 0
-            for stop in tp_list:
-                if type(stop) == str:
-                    tp_count += 1
-                new_list.append(tp_count)
-            tp_dict[trip] = new_list
+        tp_dict = stop_times.timepoints_by_trip()
             
     else:
         # Enter zeros
@@ -883,92 +959,125 @@ def shape_matching(inpath, route_ids = None):
     for trip in list(pattern_counts['trip_id']):
         tp_list.append(tp_dict[trip])  
     pattern_counts['timepoints'] = tp_list
-    pattern_counts = pattern_counts[['shape_id', 'pattern_index', 'timepoints']]
+    
+    # Each pattern keeps its own stop sequence, since patterns such as short-turns can share a shape
+    pattern_counts['stops'] = [stops_dict[trip] for trip in pattern_counts['trip_id']]
+    pattern_counts = pattern_counts[['shape_id', 'pattern_index', 'timepoints', 'stops']]
     shapes = pd.merge(pattern_counts, shapes, on=['shape_id'])
     
-    # Organize shapes dataframe
-    shapes = shapes.sort_values(by= ['route_id', 'direction_id'])
-    shapes = shapes[['route_id', 'direction_id', 'stops', 'geometry', 'pattern_index', 'timepoints']]
+    # Organize shapes dataframe, with the patterns in the order of the geometry table
+    shapes = shapes.sort_values(by= ['route_id', 'direction_id', 'pattern_index'])
+    shapes = shapes[['route_id', 'direction_id', 'stops', 'geometry', 'pattern_index', 'timepoints', 'shape_id']]
+    
+    # Skip the patterns whose shapes don't reach the region of interest
+    region = region_filter.as_region(region)
+    if region is not None:
+        in_region = [region.intersects(line) for line in shapes['geometry']]
+        report.increment('region_skipped_patterns', len(in_region) - sum(in_region))
+        shapes = shapes[in_region]
+    report.end_stage(span)
     
     # Now split shapes at stops and store the segment geometry
-    segment_geom = []
-    segment_id = []
-    segment_route = []
-    segment_stoppair = []
-    segment_pattern = []
-    segment_seq = []
-    segment_direction = []
-    segment_polyline = []
-    segment_length = []
-    segment_tp = []
+    geometry_ids = {}
+    
+    # Patterns that share a shape reuse its segments: whole sequences if they have the same stops,
+    # otherwise the segments for any stop pairs they have in common
+    shape_segments = {}
+    stop_pair_segments = {}
     
     for shape in tqdm(shapes.values.tolist()):
+        span = report.start_stage('split_shapes')
         route = shape[0]
         direction = shape[1]
         stops = shape[2]
         line = shape[3]
         pattern = shape[4]
         timepoints = shape[5]
-        sequence = 0
-        for pair in range(1, len(stops)):
-            
-            first_stop = stops[pair - 1]
-            second_stop = stops[pair]
-            first_point = stop_coord_dict[first_stop]
-            second_point = stop_coord_dict[second_stop]
+        shape_id = shape[6]
         
-            first_cut = cut(line, first_point)
-            
-            if len(first_cut) == 1: # If the return is a single item list (ie. first segment), use it
-                line_after_first_cut = first_cut[0]
-            else: # Otherwise use the second return item, which is the line remaining after the first cut
-                line_after_first_cut = first_cut[1]
+        memo_key = (shape_id, tuple(stops))
+        if memo_key in shape_segments:
+            report.cache_hit('shape_segments')
+        else:
+            report.cache_miss('shape_segments')
+            shape_segments[memo_key] = []
+            for pair in range(1, len(stops)):
+                
+                first_stop = stops[pair - 1]
+                second_stop = stops[pair]
                 
-            second_cut = cut(line_after_first_cut, second_point)
+                # The last segment of a pattern is cut differently, so it is kept separately
+                pair_key = (shape_id, first_stop, second_stop, pair < len(stops)-1)
+                if pair_key in stop_pair_segments:
+                    report.cache_hit('stop_pair_segments')
+                    shape_segments[memo_key].append(stop_pair_segments[pair_key])
+                    continue
+                report.cache_miss('stop_pair_segments')
+                
+                first_point = stop_coord_dict[first_stop]
+                second_point = stop_coord_dict[second_stop]
             
-            # Handle issues with looping where distance projection in cut() doesn't work well
-            if second_cut[0] == line_after_first_cut and pair < len(stops)-1: 
-                try:
-                    segment = cut(first_cut[0], second_point)[1] 
-                except IndexError: # If there is no second portion of the loop, revert to original process
+                first_cut = cut(line, first_point)
+                
+                if len(first_cut) == 1: # If the return is a single item list (ie. first segment), use it
+                    line_after_first_cut = first_cut[0]
+                else: # Otherwise use the second return item, which is the line remaining after the first cut
+                    line_after_first_cut = first_cut[1]
+                    
+                second_cut = cut(line_after_first_cut, second_point)
+                
+                # Handle issues with looping where distance projection in cut() doesn't work well
+                if second_cut[0] == line_after_first_cut and pair < len(stops)-1: 
+                    try:
+                        segment = cut(first_cut[0], second_point)[1] 
+                    except IndexError: # If there is no second portion of the loop, revert to original process
+                        segment = second_cut[0]
+                else:
                     segment = second_cut[0]
+                
+                stop_pair_segments[pair_key] = segment
+                shape_segments[memo_key].append(segment)
+        
+        # Identical geometries for the same stop pair (e.g. on different routes) are only kept once,
+        # with the route and pattern of the first link that uses them
+        new_rows = []
+        new_geom = []
+        for sequence, segment in enumerate(shape_segments[memo_key]):
+            first_stop = stops[sequence]
+            second_stop = stops[sequence + 1]
+            
+            geometry_key = (str(first_stop), str(second_stop), segment.wkb)
+            if geometry_key in geometry_ids:
+                report.cache_hit('segment_geometries')
+                is_new = False
             else:
-                segment = second_cut[0]
-    
+                report.cache_miss('segment_geometries')
+                geometry_ids[geometry_key] = len(geometry_ids)
+                is_new = True
+            
+            link = (route, direction, pattern, sequence, str(route) + '-' + str(first_stop) + '-' + str(second_stop),
+                    [str(first_stop),str(second_stop)], pattern+ '-' + str(timepoints[sequence + 1]), geometry_ids[geometry_key])
+            if links is not None:
+                links.append(link)
+            if is_new:
+                new_rows.append(link)
+                new_geom.append(segment)
+        
+        segment_length = []
+        for segment in new_geom:
             seg_length = 0
             coords = list(segment.coords)
             for index in range(len(coords)-1):
                 seg_length += get_distance(coords[index], coords[index+1])
-    
-            segment_geom.append(segment)
-            segment_id.append(str(route) + '-' + str(first_stop) + '-' + str(second_stop))
-            segment_stoppair.append([str(first_stop),str(second_stop)])
-            segment_pattern.append(pattern)
-            segment_tp.append(pattern+ '-' + str(timepoints[pair]))
-            segment_route.append(route)
-            segment_seq.append(sequence)
-            segment_direction.append(direction)
-            segment_polyline.append(polyline.encode(segment.coords, 6, geojson=True))
             segment_length.append(round(seg_length/1000,3)) # Divide by 1000 to get units of km
-            sequence += 1
+        report.end_stage(span)
         
-    # Build geodataframe from segment info
-    gdf = gpd.GeoDataFrame(geometry = segment_geom)
-    gdf['route_id'] = segment_route
-    gdf['direction'] = segment_direction
-    gdf['sequence'] = segment_seq
-    gdf['seg_index'] = segment_id
-    gdf['stop_pair'] = segment_stoppair
-    gdf['distance'] = segment_length
-    gdf['pattern'] = segment_pattern
-    gdf['mode'] = 'bus'
-    gdf['timepoint_index'] = segment_tp
-    gdf = gdf.sort_values(by = ['route_id', 'direction', 'pattern', 'sequence'])
-    gdf = gdf.drop(columns=['sequence'])
-    df = pd.DataFrame(gdf)
-    df['geometry'] = segment_polyline
-    
-    return df
+        if len(new_rows) > 0:
+            df = pd.DataFrame(new_rows, columns = link_columns).drop(columns = ['sequence'])
+            df['distance'] = segment_length
+            df['mode'] = 'bus'
+            df['geometry'] = polyline_codec.encode_many([segment.coords for segment in new_geom], 6, geojson=True)
+            yield df[geometry_columns]
 
 
 # Function to convert route_id from GTFS into route_short_name from GTFS, which is useful in some applications
@@ -0,0 +1,222 @@
+"""
+
+This program answers quick questions about the outputs of a run, such as
+"which routes and stop pairs use this block" or "what changed inside this
+polygon", without reading the whole output into GeoPandas for each one.
+
+An output file (from edge_decomposition or compare_edges) is read once into
+an OutputIndex, which keeps its features with:
+
+1) A spatial index (an STR tree) of the pieces, for bounding box, polygon
+   and point-radius queries
+2) An index of the pieces of each edge
+3) An index of the pieces used by each route. Decomposition outputs name
+   the routes of each piece in 'route_id'; for comparison outputs they are
+   found from the 'route-stop-stop' keys of the base and comparison segments,
+   which are matched against a set of known route IDs (route_short_name),
+   since route and stop IDs can both contain '-'. A key belongs to the
+   longest known route ID that it starts with, followed by a '-'
+
+Each query returns the matching features, as GeoJSON features in the order
+of the output file. Spatial queries can be limited to the pieces that
+changed between the base and comparison networks (comparison outputs only).
+
+serve() answers the same queries over HTTP for any number of outputs, for
+dashboards that should not read the files themselves:
+
+    GET  /<name>/bbox?bbox=min_lon,min_lat,max_lon,max_lat[&changed=1]
+    GET  /<name>/near?lon=...&lat=...&radius=<meters>[&changed=1]
+    POST /<name>/polygon[?changed=1]    (a GeoJSON polygon as the body)
+    GET  /<name>/edge/<edge>
+    GET  /<name>/route/<route_id>
+
+Each response is a GeoJSON FeatureCollection. Comparison outputs served
+without route IDs use the routes of the decomposition outputs served with
+them.
+
+"""
+
+import ast
+import json
+import math
+import logging
+import threading
+import geopandas as gpd
+from shapely.geometry import box, shape, Point
+from shapely.affinity import scale
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Meters per degree of latitude
+meters_per_degree = 111320
+
+class OutputIndex: # The features of an output file, indexed by location, edge and route
+    def __init__(self, inpath, route_ids = None):
+        with open(inpath) as infile:
+            self.features = json.load(infile)['features']
+
+        # Dictionaries may have been written as JSON objects or as strings, depending on the GeoJSON driver
+        for feature in self.features:
+            properties = feature['properties']
+            for key in ['route_id', 'segments', 'indices']:
+                if isinstance(properties.get(key), str) and properties[key][:1] == '{':
+                    properties[key] = ast.literal_eval(properties[key])
+            if isinstance(properties.get('segments'), dict): # The segments of each network may be strings as well
+                properties['segments'] = {network: ast.literal_eval(keys) if isinstance(keys, str) and keys[:1] == '{' else keys
+                                          for network, keys in properties['segments'].items()}
+
+        self.lines = [shape(feature['geometry']) for feature in self.features]
+        self.tree = gpd.GeoSeries(self.lines).sindex if len(self.lines) > 0 else None
+        self.edges = {}
+        for position, feature in enumerate(self.features):
+            self.edges.setdefault(feature['properties'].get('edge'), []).append(position)
+        self.comparison = any(not isinstance(feature['properties'].get('route_id'), dict) for feature in self.features)
+        self.index_routes(route_ids)
+        logger.info('Indexed %d pieces on %d edges from %s', len(self.features), len(self.edges), inpath)
+
+    # Index the pieces used by each route. The routes of a comparison output are found with a set of known route IDs.
+    def index_routes(self, route_ids = None):
+        self.route_ids = set(str(route) for route in route_ids) if route_ids is not None else None
+        self.routes = {}
+        for position, feature in enumerate(self.features):
+            for route in feature_routes(feature['properties'], self.route_ids or set()):
+                self.routes.setdefault(route, set()).add(position)
+
+    # Get the features at a list of positions, in file order, keeping the pieces that changed only if changed = True
+    def select(self, positions, changed = False):
+        features = [self.features[position] for position in sorted(positions)]
+        if changed:
+            features = [feature for feature in features if has_changed(feature['properties'])]
+        return features
+
+    # The pieces that intersect a geometry (in longitude and latitude)
+    def intersecting(self, geometry, changed = False):
+        if self.tree is None:
+            return []
+        return self.select(self.tree.query(geometry, predicate = 'intersects').tolist(), changed)
+
+    def bbox(self, min_lon, min_lat, max_lon, max_lat, changed = False):
+        return self.intersecting(box(min_lon, min_lat, max_lon, max_lat), changed)
+
+    def polygon(self, polygon, changed = False):
+        return self.intersecting(polygon, changed)
+
+    # The pieces within radius meters of a point. Distances are measured on a local equirectangular projection.
+    def near(self, lon, lat, radius, changed = False):
+        if self.tree is None:
+            return []
+        lon_scale = meters_per_degree * math.cos(math.radians(lat))
+        margin = box(lon - radius / lon_scale, lat - radius / meters_per_degree,
+                     lon + radius / lon_scale, lat + radius / meters_per_degree)
+        point = Point(lon * lon_scale, lat * meters_per_degree)
+        positions = [position for position in self.tree.query(margin).tolist()
+                     if scale(self.lines[position], lon_scale, meters_per_degree, origin = (0, 0)).distance(point) <= radius]
+        return self.select(positions, changed)
+
+    def edge(self, edge):
+        return self.select(self.edges.get(edge, []))
+
+    def route(self, route_id):
+        if self.comparison and self.route_ids is None:
+            logger.warning('No route IDs were given for this comparison output, so its pieces are not indexed by route')
+        return self.select(self.routes.get(route_id, []))
+
+# Get the routes that use a piece. For comparison outputs, the route of each 'route-stop-stop' key is found
+# from the set of known route IDs.
+def feature_routes(properties, route_ids):
+    routes = properties.get('route_id')
+    if isinstance(routes, dict):
+        return set(str(route) for route in routes.values())
+
+    found = set()
+    for network in (properties.get('segments') or {}).values():
+        for key in (network or {}).values():
+            route = key_route(str(key), route_ids)
+            if route is not None:
+                found.add(route)
+    return found
+
+# Get the route of a 'route-stop-stop' key: the longest known route ID that the key starts with, followed by
+# a '-' and at least two more parts (None if there isn't one)
+def key_route(key, route_ids):
+    parts = key.split('-')
+    for end in range(len(parts) - 2, 0, -1):
+        route = '-'.join(parts[:end])
+        if route in route_ids:
+            return route
+    return None
+
+# Whether a piece of a comparison output changed: service was added or dropped, or the metric changed
+def has_changed(properties):
+    return properties.get('service_indicator') != 2 or any(value != 0 for key, value in properties.items()
+                                                          if key == 'metric' or key.startswith('metric_'))
+
+""" HTTP endpoint """
+
+class QueryHandler(BaseHTTPRequestHandler): # Answers queries for the outputs in self.server.indexes
+    def do_GET(self):
+        self.answer()
+
+    def do_POST(self):
+        self.answer()
+
+    def answer(self):
+        url = urlparse(self.path)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        changed = query.get('changed', '0') in ['1', 'true']
+        try:
+            index = self.server.indexes.get(parts[0])
+            if index is None:
+                return self.respond(404, {'error': 'No output named ' + parts[0]})
+            if parts[1:] == ['bbox']:
+                features = index.bbox(*[float(value) for value in query['bbox'].split(',')], changed = changed)
+            elif parts[1:] == ['near']:
+                features = index.near(float(query['lon']), float(query['lat']), float(query['radius']), changed = changed)
+            elif parts[1:] == ['polygon'] and self.command == 'POST':
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                features = index.polygon(shape(body.get('geometry', body)), changed = changed)
+            elif len(parts) == 3 and parts[1] == 'edge':
+                features = index.edge(int(parts[2]))
+            elif len(parts) == 3 and parts[1] == 'route':
+                features = index.route(parts[2])
+            else:
+                return self.respond(404, {'error': 'Unknown query ' + url.path})
+        except (KeyError, ValueError, TypeError, AttributeError) as error:
+            return self.respond(400, {'error': 'Bad query: ' + repr(error)})
+        self.respond(200, {'type': 'FeatureCollection', 'features': features})
+
+    def respond(self, status, content):
+        data = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+# Serve queries on a dictionary of outputs ({name: path or OutputIndex}) until interrupted. Comparison outputs
+# are indexed by route with route_ids, or else with the routes of the decomposition outputs served with them.
+# With block = False, the server is returned after it starts in a background thread; call shutdown() to stop it.
+def serve(outputs, host = '127.0.0.1', port = 8010, block = True, route_ids = None):
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.indexes = {name: output if isinstance(output, OutputIndex) else OutputIndex(output, route_ids)
+                      for name, output in outputs.items()}
+    if route_ids is None:
+        route_ids = set(route for index in server.indexes.values() if not index.comparison for route in index.routes)
+    for index in server.indexes.values():
+        if index.comparison and index.route_ids is None and len(route_ids) > 0:
+            index.index_routes(route_ids)
+    logger.info('Serving queries on %s for %s', 'http://%s:%d' % server.server_address[:2], ', '.join(server.indexes))
+    if not block:
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        return server
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
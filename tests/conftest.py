@@ -0,0 +1,16 @@
+import os
+import sys
+import pytest
+
+# The modules are at the root of the repository, and the test helpers next to the tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import Network
+
+# A synthetic network, with the working directory set so that the outputs are written inside it
+@pytest.fixture
+def network(tmp_path, monkeypatch):
+    network = Network(str(tmp_path))
+    monkeypatch.chdir(os.path.join(network.root, 'work'))
+    return network
@@ -0,0 +1,201 @@
+"""
+
+Synthetic feeds, road network and Valhalla server for the tests: a grid of
+roads with a vertex every 0.001 degrees and a way every 0.01 degrees, bus
+routes that follow it, and a fake Valhalla that matches any request to the
+grid.
+
+"""
+
+import csv
+import io
+import os
+import json
+import zipfile
+import polyline_codec
+import geopandas as gpd
+from shapely.geometry import LineString
+
+origin_lon, origin_lat, step = -71.1, 42.3, 0.001
+
+def to_lonlat(x, y):
+    return (round(origin_lon + x * step, 6), round(origin_lat + y * step, 6))
+
+def to_grid(lon, lat):
+    return (round((lon - origin_lon) / step), round((lat - origin_lat) / step))
+
+# Path along the grid between two vertices, following the road the start is on first
+def grid_path(start, end):
+    (x, y), (end_x, end_y) = start, end
+    points = [(x, y)]
+    for axis in ('xy' if y % 10 == 0 else 'yx'):
+        if axis == 'x':
+            while x != end_x:
+                x += 1 if end_x > x else -1
+                points.append((x, y))
+        else:
+            while y != end_y:
+                y += 1 if end_y > y else -1
+                points.append((x, y))
+    return points
+
+def route_path(waypoints):
+    points = [waypoints[0]]
+    for start, end in zip(waypoints[:-1], waypoints[1:]):
+        points += grid_path(start, end)[1:]
+    return points
+
+# Way and edge IDs of a step along the grid: each block of a way is an edge in each direction
+def edge_of(start, end):
+    (x0, y0), (x1, y1) = start, end
+    if y0 == y1:
+        way, block, forward = 1000 + y0 // 10, min(x0, x1) // 10, x1 > x0
+    else:
+        way, block, forward = 2000 + x0 // 10, min(y0, y1) // 10, y1 > y0
+    return way, int(str(way) + str(block).zfill(3) + str(int(forward)))
+
+class FakeValhalla: # Answers trace_route and trace_attributes requests by following the grid
+    def __init__(self):
+        self.calls = 0
+
+    def post(self, action, request_data, timeout):
+        self.calls += 1
+        request_data = json.loads(json.dumps(request_data))
+        if 'encoded_polyline' in request_data:
+            points = [to_grid(lon, lat) for lat, lon in polyline_codec.decode(request_data['encoded_polyline'], 6)]
+            breaks = None
+        else:
+            points = [to_grid(float(point['lon']), float(point['lat'])) for point in request_data['shape']]
+            breaks = [index for index, point in enumerate(request_data['shape']) if point['type'] == 'break_through']
+        path = [points[0]]
+        input_positions = [0]
+        for start, end in zip(points[:-1], points[1:]):
+            path += grid_path(start, end)[1:]
+            input_positions.append(len(path) - 1)
+
+        if action == 'trace_route':
+            legs = []
+            for start, end in zip(breaks[:-1], breaks[1:]):
+                leg = path[input_positions[start] : input_positions[end] + 1]
+                legs.append({'shape': polyline_codec.encode([to_lonlat(*point)[::-1] for point in leg], 6),
+                             'summary': {'length': round((len(leg) - 1) * 0.09, 3)}})
+            return {'trip': {'locations': [{'original_index': index} for index in breaks], 'legs': legs}}
+
+        edges = []
+        for index, (start, end) in enumerate(zip(path[:-1], path[1:])):
+            if start == end:
+                continue
+            way, edge = edge_of(start, end)
+            if len(edges) > 0 and edges[-1]['id'] == edge:
+                edges[-1]['end_shape_index'] = index + 1
+            else:
+                edges.append({'id': edge, 'way_id': way, 'begin_shape_index': index, 'end_shape_index': index + 1})
+        for edge in edges:
+            edge['length'] = round((edge['end_shape_index'] - edge['begin_shape_index']) * 0.09, 3)
+        result = {'edges': edges, 'shape': polyline_codec.encode([to_lonlat(*point)[::-1] for point in path], 6),
+                  'units': 'km', 'osm_changeset': 1}
+
+        # Locate each input point on the matched edges, as requested for pattern batches
+        if 'matched.edge_index' in (request_data.get('filters') or {}).get('attributes', []):
+            matched = []
+            for position in input_positions:
+                for edge_index, edge in enumerate(edges):
+                    if edge['begin_shape_index'] <= position <= edge['end_shape_index'] and (position > edge['begin_shape_index'] or position == 0):
+                        break
+                fraction = (position - edge['begin_shape_index']) / (edge['end_shape_index'] - edge['begin_shape_index'])
+                lon, lat = to_lonlat(*path[position])
+                matched.append({'type': 'matched', 'lat': lat, 'lon': lon, 'edge_index': edge_index, 'distance_along_edge': fraction})
+            result['matched_points'] = matched
+        if breaks is not None:
+            result['admins'] = []
+        return result
+
+    def close(self):
+        pass
+
+def write_roads(path):
+    lines, way_ids = [], []
+    for index in range(0, 11):
+        lines.append(LineString([to_lonlat(x, index * 10) for x in range(0, 101)]))
+        way_ids.append(str(1000 + index))
+        lines.append(LineString([to_lonlat(index * 10, y) for y in range(0, 101)]))
+        way_ids.append(str(2000 + index))
+    gpd.GeoDataFrame({'osm_id': way_ids}, geometry = lines, crs = 'EPSG:4326').to_file(path)
+
+base_routes = {'R1': [(0, 0), (40, 0), (40, 50), (90, 50)],
+               'R2': [(10, 0), (40, 0), (40, 30), (0, 30)],
+               'R3': [(0, 70), (100, 70)],
+               'R4': [(50, 100), (50, 0), (80, 0)]}
+
+comp_routes = {'R1': [(0, 0), (40, 0), (40, 50), (90, 50)],
+               'R3': [(0, 70), (60, 70), (60, 90)],
+               'R4': [(50, 100), (50, 0), (80, 0)],
+               'R5': [(20, 0), (20, 100)]}
+
+# Write a GTFS feed with a full and a short-turn pattern in each direction of each route, with stops every
+# 7 vertices (many of them mid-block). The first trip of each pattern runs after midnight (past 24:00:00).
+def write_feed(path, routes, stop_format = 'S%d_%d', offset = 0):
+    stops, shapes, trips, stop_times = {}, [], [], []
+    for route, waypoints in routes.items():
+        for direction in (0, 1):
+            points = route_path(waypoints if direction == 0 else waypoints[::-1])
+            stop_positions = sorted(set([0, len(points) - 1] + list(range(0, len(points), 7))))
+            patterns = [stop_positions, stop_positions[:max(2, len(stop_positions) // 2)]]
+            for pattern, (positions, trip_count) in enumerate(zip(patterns, [6, 3])):
+                shape_id = '%s_%d_%d' % (route, direction, pattern)
+                for sequence, point in enumerate(points[:positions[-1] + 1]):
+                    lon, lat = to_lonlat(*point)
+                    shapes.append((shape_id, lat, lon, sequence + 1))
+                for trip in range(trip_count):
+                    trip_id = '%s_%d_%d_%d' % (route, direction, pattern, trip)
+                    trips.append((route, 'WK' if trip % 3 else 'SA', trip_id, direction, shape_id))
+                    start = 6 * 3600 + trip * 1800 + pattern * 600 + offset + (trip == 0) * 20 * 3600
+                    for sequence, position in enumerate(positions):
+                        seconds = start + sequence * 90
+                        time = '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+                        stop_id = stop_format % points[position]
+                        stops[stop_id] = to_lonlat(*points[position])
+                        stop_times.append((trip_id, time, time, stop_id, sequence + 1, 'TP' if sequence % 3 == 0 else ''))
+
+    def write(feed_zip, name, header, rows):
+        text = io.StringIO()
+        writer = csv.writer(text)
+        writer.writerow(header)
+        writer.writerows(rows)
+        feed_zip.writestr(name, text.getvalue())
+
+    with zipfile.ZipFile(path, 'w') as feed_zip:
+        write(feed_zip, 'agency.txt', ['agency_id', 'agency_name', 'agency_url', 'agency_timezone'],
+              [('A', 'A', 'http://a', 'America/New_York')])
+        write(feed_zip, 'routes.txt', ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_type'],
+              [(route, 'A', route.lower(), route, 3) for route in routes])
+        write(feed_zip, 'calendar.txt', ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday',
+                                         'sunday', 'start_date', 'end_date'],
+              [('WK', 1, 1, 1, 1, 1, 0, 0, '20200101', '20201231'), ('SA', 0, 0, 0, 0, 0, 1, 0, '20200101', '20201231')])
+        write(feed_zip, 'trips.txt', ['route_id', 'service_id', 'trip_id', 'direction_id', 'shape_id'], trips)
+        write(feed_zip, 'stops.txt', ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'],
+              [(stop_id, stop_id, lat, lon) for stop_id, (lon, lat) in stops.items()])
+        write(feed_zip, 'stop_times.txt', ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence',
+                                           'checkpoint_id'], stop_times)
+        write(feed_zip, 'shapes.txt', ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'], shapes)
+
+class Network: # Paths of a synthetic run: feeds in work/data, comparison outputs in output (as '../output')
+    def __init__(self, root):
+        self.root = root
+        self.data = os.path.join(root, 'work', 'data')
+        os.makedirs(self.data)
+        os.makedirs(os.path.join(root, 'output'))
+        self.roads = os.path.join(root, 'roads.shp')
+        write_roads(self.roads)
+
+    def feed(self, name, routes, **options):
+        path = os.path.join('data', name + '.zip')
+        write_feed(os.path.join(self.data, name + '.zip'), routes, **options)
+        return path
+
+    def comparison(self, base_path, comp_path):
+        return '../output/' + os.path.basename(base_path)[:-4] + '_vs_' + os.path.basename(comp_path)[:-4] + '.geojson'
+
+def read_text(path):
+    with open(path) as infile:
+        return infile.read()
@@ -0,0 +1,85 @@
+import pytest
+import concurrent.futures
+import edge_decomposition
+import polyline_codec
+from shape_generation import map_matching
+from synthetic import FakeValhalla, base_routes
+
+class BrokenValhalla(FakeValhalla): # Fails every edge matching request with an unexpected error
+    def post(self, action, request_data, timeout):
+        if action == 'trace_attributes':
+            raise RuntimeError('Valhalla crashed')
+        return super().post(action, request_data, timeout)
+
+class RecordingExecutor(concurrent.futures.ThreadPoolExecutor): # Records the executors that were shut down
+    created = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.closed = False
+        RecordingExecutor.created.append(self)
+
+    def shutdown(self, *args, **kwargs):
+        self.closed = True
+        super().shutdown(*args, **kwargs)
+
+def test_speculative_executor_is_shut_down_when_matching_fails(network, monkeypatch):
+    base_path = network.feed('base', {'R1': base_routes['R1']})
+    segments = map_matching(base_path, transport = FakeValhalla())
+    monkeypatch.setattr(edge_decomposition, 'ThreadPoolExecutor', RecordingExecutor)
+    RecordingExecutor.created = []
+    with pytest.raises(RuntimeError):
+        edge_decomposition.edge_decomposition(segments, network.roads, base_path[:-4], transport = BrokenValhalla(),
+                                              speculative_radii = 3)
+    assert len(RecordingExecutor.created) == 1 and RecordingExecutor.created[0].closed
+
+# The segments of the first pattern of one route
+@pytest.fixture
+def pattern(network):
+    segments = map_matching(network.feed('base', {'R1': base_routes['R1']}), transport = FakeValhalla())
+    return segments[segments['pattern'] == segments['pattern'].iloc[0]].reset_index(drop = True)
+
+# A trace_attributes request for a whole pattern batch, locating each input point on the matched edges
+def batch_request(coords):
+    return {'encoded_polyline': polyline_codec.encode(coords, precision = 6),
+            'filters': {'attributes': ['edge.id', 'edge.way_id'] + edge_decomposition.batch_attributes}}
+
+# The ends of each matched edge of a trace_attributes result, which are the break points that it adds to the edge
+def edge_ends(result):
+    shape = polyline_codec.decode(result['shape'], precision = 6)
+    return [(shape[edge['begin_shape_index']], shape[edge['end_shape_index']]) for edge in result['edges']]
+
+def test_pattern_batches_stop_at_matched_pairs_and_point_limits(pattern):
+    positions, coords, boundaries = edge_decomposition.find_pattern_batch(pattern, 0, {}, 100000)
+    assert positions == list(range(len(pattern)))
+    assert len(boundaries) == len(pattern) + 1 and boundaries[-1] == len(coords) - 1
+    for position in positions: # Each segment's shape is the part of the batch between its boundaries
+        assert coords[boundaries[position] : boundaries[position + 1] + 1] == \
+               polyline_codec.decode(pattern['geometry'].iloc[position], precision = 6)
+
+    matched = {tuple(pattern['stop_pair'].iloc[3][:2]): None}
+    assert edge_decomposition.find_pattern_batch(pattern, 1, matched, 100000)[0] == [1, 2]
+    limited = edge_decomposition.find_pattern_batch(pattern, 0, {}, boundaries[2] + 1)[0]
+    assert limited == [0, 1]
+
+def test_split_pattern_batch_matches_each_segment_alone(pattern):
+    transport = FakeValhalla()
+    positions, coords, boundaries = edge_decomposition.find_pattern_batch(pattern, 0, {}, 100000)
+    result = transport.post('trace_attributes', batch_request(coords), 30)
+    seg_results = edge_decomposition.split_pattern_batch(result, boundaries)
+
+    assert len(seg_results) == len(positions) and None not in seg_results
+    for position, seg_result in zip(positions, seg_results):
+        alone = transport.post('trace_attributes', {'encoded_polyline': pattern['geometry'].iloc[position]}, 30)
+        assert [edge['id'] for edge in seg_result['edges']] == [edge['id'] for edge in alone['edges']]
+        assert edge_ends(seg_result) == edge_ends(alone)
+
+def test_split_pattern_batch_leaves_ambiguous_segments_to_match_alone(pattern):
+    positions, coords, boundaries = edge_decomposition.find_pattern_batch(pattern, 0, {}, 100000)
+    result = FakeValhalla().post('trace_attributes', batch_request(coords), 30)
+    result['matched_points'][boundaries[2]] = {'type': 'unmatched'}
+    seg_results = edge_decomposition.split_pattern_batch(result, boundaries)
+    assert [position for position, seg_result in enumerate(seg_results) if seg_result is None] == [1, 2]
+
+    result['matched_points'] = result['matched_points'][:boundaries[-1]] # Too few points to place every boundary
+    assert edge_decomposition.split_pattern_batch(result, boundaries) == [None] * len(positions)
@@ -0,0 +1,54 @@
+import os
+import numpy as np
+import pytest
+import geopandas as gpd
+from busdecomp import busdecomp_gtfs
+from incidence import Incidence, incidence_path
+from synthetic import FakeValhalla, base_routes, comp_routes, read_text
+
+@pytest.fixture
+def outputs(network):
+    base_path = network.feed('base', base_routes)
+    comp_path = network.feed('comp', comp_routes)
+    busdecomp_gtfs(base_path, comp_path, network.roads, metrics = True, transport = FakeValhalla())
+    return base_path, comp_path
+
+def test_saved_matrix_matches_the_output(outputs):
+    inpath = outputs[0][:-4] + '.geojson'
+    gdf = gpd.read_file(inpath)
+    saved = Incidence.load(incidence_path(inpath))
+    built = Incidence.from_pieces(gdf)
+    assert saved.segment_keys == built.segment_keys
+    assert np.array_equal(saved.edges, built.edges)
+    assert (saved.matrix != built.matrix).nnz == 0
+
+def test_saved_matrix_is_used_only_when_it_matches(outputs, monkeypatch):
+    inpath = outputs[0][:-4] + '.geojson'
+    gdf = gpd.read_file(inpath)
+    from_pieces = Incidence.from_pieces
+    built = []
+    monkeypatch.setattr(Incidence, 'from_pieces', classmethod(lambda cls, pieces: built.append(len(pieces)) or from_pieces(pieces)))
+
+    assert Incidence.for_output(inpath, gdf).matrix.shape[0] == len(gdf) and built == []
+    assert Incidence.for_output(inpath, gdf.iloc[1:]).matrix.shape[0] == len(gdf) - 1 and built == [len(gdf) - 1]
+    reordered = gdf.iloc[::-1]
+    if not np.array_equal(reordered['edge'], gdf['edge']):
+        Incidence.for_output(inpath, reordered)
+        assert built[-1] == len(gdf)
+
+    # A matrix older than its output is not used
+    os.utime(incidence_path(inpath), (0, 0))
+    Incidence.for_output(inpath, gdf)
+    assert len(built) == 3
+
+def test_comparison_uses_the_saved_matrices(network, outputs, monkeypatch):
+    base_path, comp_path = outputs
+    expected = read_text(network.comparison(base_path, comp_path))
+    from_pieces = Incidence.from_pieces
+    built = []
+    monkeypatch.setattr(Incidence, 'from_pieces', classmethod(lambda cls, pieces: built.append(len(pieces)) or from_pieces(pieces)))
+    busdecomp_gtfs(base_path, comp_path, network.roads, metrics = True, transport = FakeValhalla())
+
+    # Only the decomposition of each network builds its matrix
+    assert len(built) == 2
+    assert read_text(network.comparison(base_path, comp_path)) == expected
@@ -0,0 +1,30 @@
+from instrumentation import Histogram, RunReport, LATENCY_BUCKETS
+
+def test_histogram_keeps_counts_only():
+    histogram = Histogram()
+    for index in range(10000):
+        histogram.observe((index % 100) / 1000)
+    summary = histogram.summary()
+    assert summary['count'] == 10000
+    assert sum(summary['buckets'].values()) == 10000
+    assert summary['max'] == 0.099
+    assert not hasattr(histogram, 'samples')
+
+def test_histogram_quantiles_stay_in_their_bucket():
+    histogram = Histogram()
+    for seconds in [0.001] * 50 + [0.2] * 49 + [45]:
+        histogram.observe(seconds)
+    assert 0 < histogram.quantile(0.5) <= LATENCY_BUCKETS[0]
+    assert LATENCY_BUCKETS[4] < histogram.quantile(0.9) <= LATENCY_BUCKETS[5]
+    assert histogram.quantile(1) == 45
+    assert Histogram().quantile(0.5) is None
+
+def test_peak_is_only_reset_outside_other_stages(monkeypatch):
+    resets = []
+    monkeypatch.setattr('instrumentation.reset_peak_rss', lambda: resets.append(True))
+    report = RunReport()
+    with report.stage('outer'):
+        with report.stage('inner'):
+            pass
+    assert len(resets) == 1
+    assert set(report.to_dict()['stages']) == {'outer', 'outer/inner'}
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from shapely.geometry import LineString, Point
+from shapely.ops import substring
+import linear_referencing
+
+# Random lines (some with repeated vertices, which give zero-length segments) and random points around them
+def random_cases(seed, count = 30):
+    generator = np.random.default_rng(seed)
+    for case in range(count):
+        coords = np.cumsum(generator.normal(0, 0.001, (int(generator.integers(2, 12)), 2)), axis = 0) + [-71.1, 42.3]
+        if case % 3 == 0:
+            coords = np.insert(coords, 1, coords[1], axis = 0)
+        points = coords.mean(axis = 0) + generator.normal(0, 0.002, (20, 2))
+        yield coords, points, generator
+
+def test_project_matches_shapely():
+    for coords, points, generator in random_cases(1):
+        line = LineString(coords)
+        expected = [line.project(Point(point)) for point in points.tolist() + coords.tolist()]
+        assert np.allclose(linear_referencing.project(coords, np.vstack([points, coords])), expected, rtol = 0, atol = 1e-12)
+
+def test_interpolate_matches_shapely():
+    for coords, points, generator in random_cases(2):
+        line = LineString(coords)
+        distances = np.concatenate([generator.uniform(-0.1, 1.1, 20) * line.length, [0, line.length]])
+        expected = [line.interpolate(distance).coords[0] for distance in np.clip(distances, 0, line.length)]
+        assert np.allclose(linear_referencing.interpolate(coords, distances), expected, rtol = 0, atol = 1e-12)
+
+def test_split_matches_shapely_substrings():
+    for coords, points, generator in random_cases(3):
+        line = LineString(coords)
+        cumulative = linear_referencing.cumulative_lengths(coords)
+        distances = np.sort(np.concatenate([[0, line.length], generator.uniform(0, line.length, 4), cumulative[1:2]]))
+        pieces = linear_referencing.split(coords, distances, cumulative)
+        assert len(pieces) == len(distances) - 1
+        for piece, start, end in zip(pieces, distances[:-1], distances[1:]):
+            expected = substring(line, start, end)
+            assert np.allclose(piece[0], expected.coords[0], atol = 1e-12)
+            assert np.allclose(piece[-1], expected.coords[-1], atol = 1e-12)
+            assert LineString(piece).length == pytest.approx(end - start, abs = 1e-12)
+            assert LineString(piece).hausdorff_distance(expected) < 1e-12
+
+def test_traversals_cover_the_pieces_between_their_ends():
+    boundaries = np.array([0.25, 0.5, 0.75])
+    ranges = linear_referencing.assign_pieces(boundaries, [0, 0.5, 0.9, 0.6, 0.3], [1, 0.75, 0.6, 0.6, 0.3])
+    assert [piece_range.tolist() for piece_range in ranges] == [[0, 1, 2, 3], [2], [2, 3], [], []]
+    assert [piece_range.tolist() for piece_range in linear_referencing.assign_pieces(np.zeros(0), [0.2], [0.4])] == [[0]]
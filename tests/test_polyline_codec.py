@@ -0,0 +1,48 @@
+import numpy as np
+import polyline
+import pytest
+import polyline_codec
+
+# Random lines of random lengths, with some points exactly half way between two rounded values
+def random_lines(seed, precision):
+    generator = np.random.default_rng(seed)
+    lines = []
+    for length in generator.integers(1, 40, size = 50).tolist():
+        coords = np.column_stack([generator.uniform(-89, 89, length), generator.uniform(-179, 179, length)])
+        halves = generator.random(length) < 0.2
+        coords[halves] = (np.round(coords[halves] * 10 ** precision) + 0.5) / 10 ** precision
+        lines.append([tuple(point) for point in coords.tolist()])
+    return lines
+
+@pytest.mark.parametrize('precision', [5, 6])
+@pytest.mark.parametrize('geojson', [False, True])
+def test_codec_matches_the_polyline_package(precision, geojson):
+    lines = random_lines(precision, precision) + [[(0.0, 0.0)], [(-0.000004, 179.999996), (0.0000049, -180.0)]]
+    expected = [polyline.encode(line, precision, geojson) for line in lines]
+    assert polyline_codec.encode_many(lines, precision, geojson) == expected
+    assert polyline_codec.encode_many([np.array(line) for line in lines], precision, geojson) == expected
+    assert [polyline_codec.encode(line, precision, geojson) for line in lines] == expected
+
+    coords, offsets = polyline_codec.decode_many(expected, precision, geojson)
+    assert offsets.tolist() == np.cumsum([0] + [len(line) for line in lines]).tolist()
+    for position, expression in enumerate(expected):
+        decoded = polyline.decode(expression, precision, geojson)
+        assert [tuple(point) for point in coords[offsets[position] : offsets[position + 1]].tolist()] == decoded
+        assert polyline_codec.decode(expression, precision, geojson) == decoded
+
+def test_empty_inputs():
+    assert polyline_codec.encode_many([], 6) == []
+    assert polyline_codec.encode([], 6) == ''
+    coords, offsets = polyline_codec.decode_many(['', polyline.encode([(1.0, 2.0)], 6), ''], 6)
+    assert coords.tolist() == [[1.0, 2.0]] and offsets.tolist() == [0, 0, 1, 1]
+
+@pytest.mark.parametrize('precision', [5, 6])
+def test_concatenation_matches_decoding_and_encoding_again(precision):
+    lines = random_lines(10 + precision, precision)
+    expressions = [polyline.encode(line, precision) for line in lines]
+    groups = [expressions[start : start + size] for start, size in zip(range(0, 50, 5), [1, 5, 3, 0, 5, 2, 4, 5, 5, 5])]
+    groups.append(['', expressions[0], ''])
+    expected = [polyline.encode([point for expression in group for point in polyline.decode(expression, precision)], precision)
+                if len(''.join(group)) > 0 else '' for group in groups]
+    assert polyline_codec.concatenate_many(groups) == expected
+    assert [polyline_codec.concatenate(group) for group in groups] == expected
@@ -0,0 +1,69 @@
+import time
+import pytest
+import requests
+from request_policy import RequestPolicy, PermanentValhallaError, ValhallaUnavailable
+
+class FakeTransport: # Returns or raises the given outcomes in order, repeating the last one
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def post(self, action, request_data, timeout):
+        outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+        self.calls += 1
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+def make_policy():
+    return RequestPolicy(max_attempts = 1, base_delay = 0, breaker_threshold = 2, breaker_cooldown = 0.05)
+
+def open_circuit(policy):
+    transport = FakeTransport([requests.exceptions.ConnectionError('down')])
+    for attempt in range(2):
+        with pytest.raises(ValhallaUnavailable):
+            policy.send(transport, 'trace_attributes', {}, 1)
+    assert policy.open_until is not None
+
+def test_open_circuit_fails_fast_until_cooldown():
+    policy = make_policy()
+    open_circuit(policy)
+    transport = FakeTransport([{'edges': []}])
+    with pytest.raises(ValhallaUnavailable, match = 'Circuit breaker open'):
+        policy.send(transport, 'trace_attributes', {}, 1)
+    assert transport.calls == 0
+
+    # After the cooldown a single trial is let through, and its success closes the circuit
+    time.sleep(0.06)
+    assert policy.send(transport, 'trace_attributes', {}, 1) == {'edges': []}
+    assert policy.open_until is None and not policy.trial_in_flight
+
+def test_failed_trial_reopens_circuit():
+    policy = make_policy()
+    open_circuit(policy)
+    time.sleep(0.06)
+    with pytest.raises(ValhallaUnavailable):
+        policy.send(FakeTransport([requests.exceptions.Timeout('slow')]), 'trace_attributes', {}, 1)
+    assert policy.open_until > time.time() and not policy.trial_in_flight
+
+def test_unexpected_trial_error_does_not_leave_circuit_stuck():
+    policy = make_policy()
+    open_circuit(policy)
+    time.sleep(0.06)
+    with pytest.raises(RuntimeError):
+        policy.send(FakeTransport([RuntimeError('bindings failed')]), 'trace_attributes', {}, 1)
+    assert not policy.trial_in_flight
+
+    # The next trial after the cooldown goes through
+    time.sleep(0.06)
+    transport = FakeTransport([{'edges': []}])
+    assert policy.send(transport, 'trace_attributes', {}, 1) == {'edges': []}
+    assert transport.calls == 1
+
+def test_permanent_errors_count_as_success():
+    policy = make_policy()
+    transport = FakeTransport([{'error_code': 171, 'status_code': 400, 'error': 'No suitable edges'}])
+    for attempt in range(3):
+        with pytest.raises(PermanentValhallaError):
+            policy.send(transport, 'trace_attributes', {}, 1)
+    assert policy.open_until is None and policy.consecutive_failures == 0
@@ -0,0 +1,36 @@
+import numpy as np
+import geopandas as gpd
+from pyproj import Geod
+from shapely.geometry import LineString, MultiLineString
+from road_store import way_lines, build_road_store, RoadStore
+from edge_decomposition import load_way_geometries
+
+def road_network():
+    return gpd.GeoDataFrame({'osm_id': ['1', '2', '3', '4']},
+                            geometry = [LineString([(-71.1, 42.3), (-71.09, 42.3)]),
+                                        MultiLineString([[(-71.1, 42.31), (-71.095, 42.31)], [(-71.095, 42.31), (-71.09, 42.31)]]),
+                                        MultiLineString([[(-71.1, 42.32), (-71.095, 42.32)], [(-71.094, 42.32), (-71.09, 42.32)]]),
+                                        None],
+                            crs = 'EPSG:4326')
+
+def test_multi_part_ways_are_merged_or_skipped(caplog):
+    ways = way_lines(road_network())
+    assert sorted(ways) == ['1', '2']
+    assert ways['2'].geom_type == 'LineString'
+    assert list(ways['2'].coords) == [(-71.1, 42.31), (-71.095, 42.31), (-71.09, 42.31)]
+    assert 'Skipping way 3' in caplog.text and 'Skipping way 4' in caplog.text
+
+def test_store_matches_shapefile(tmp_path):
+    road_network().to_file(tmp_path / 'roads.shp')
+    build_road_store(str(tmp_path / 'roads.shp'), str(tmp_path / 'store'))
+    store = RoadStore(str(tmp_path / 'store'))
+    ways = way_lines(gpd.read_file(tmp_path / 'roads.shp'))
+    assert len(store) == len(ways)
+
+    geod = Geod(ellps = 'WGS84')
+    from_store = load_way_geometries(store, ['1', '2', '3'], geod)
+    from_shapefile = load_way_geometries(ways, ['1', '2', '3'], geod)
+    assert sorted(from_store) == sorted(from_shapefile) == ['1', '2']
+    for way_id in from_store:
+        np.testing.assert_allclose(from_store[way_id].coords, from_shapefile[way_id].coords)
+        assert abs(from_store[way_id].length_ft - from_shapefile[way_id].length_ft) < 1e-6
@@ -0,0 +1,51 @@
+import os
+import time
+import pytest
+from busdecomp import busdecomp_gtfs
+from segment_stream import SegmentStream
+from valhalla_transport import RecordingTransport, ReplayTransport
+from synthetic import FakeValhalla, base_routes, comp_routes, read_text
+
+def outputs(network, base_path, comp_path):
+    return [read_text(base_path[:-4] + '.geojson'), read_text(comp_path[:-4] + '.geojson'),
+            read_text(network.comparison(base_path, comp_path))]
+
+def test_streaming_output_equals_batch_output(network):
+    base_path = network.feed('base', base_routes)
+    comp_path = network.feed('comp', comp_routes)
+    archive = os.path.join(network.root, 'requests.jsonl.gz')
+    with RecordingTransport(FakeValhalla(), archive) as transport:
+        busdecomp_gtfs(base_path, comp_path, network.roads, metrics = True, transport = transport)
+    batch_outputs = outputs(network, base_path, comp_path)
+
+    # Every request of the streaming run must have been recorded by the batch run
+    busdecomp_gtfs(base_path, comp_path, network.roads, metrics = True, transport = ReplayTransport(archive),
+                   streaming = True, stream_buffer = 1)
+    assert outputs(network, base_path, comp_path) == batch_outputs
+
+def test_producer_stopped_by_base_exception_ends_stream():
+    def produce():
+        yield 1
+        raise SystemExit('stopped')
+
+    batches = []
+    with pytest.raises(RuntimeError, match = 'SystemExit'):
+        for batch in SegmentStream(produce, maxsize = 1):
+            batches.append(batch)
+    assert batches == [1]
+
+def test_closing_stream_closes_producer():
+    finished = []
+    def produce():
+        try:
+            for batch in range(100):
+                yield batch
+        finally:
+            finished.append(True)
+
+    stream = SegmentStream(produce, maxsize = 1)
+    for batch in stream:
+        break
+    stream.thread.join(timeout = 5)
+    assert not stream.thread.is_alive()
+    assert finished == [True]
@@ -0,0 +1,76 @@
+import io
+import csv
+import json
+import zipfile
+import collections
+import numpy as np
+from busdecomp import busdecomp_gtfs
+import gtfs_io
+import service_periods
+from synthetic import FakeValhalla, base_routes, comp_routes
+
+# Read the properties of each piece of an output
+def read_properties(path):
+    with open(path) as infile:
+        return [feature['properties'] for feature in json.load(infile)['features']]
+
+def test_periods_add_up_to_the_daily_metric(network):
+    base_path = network.feed('base', base_routes)
+    comp_path = network.feed('comp', comp_routes, offset = 3 * 3600)
+    busdecomp_gtfs(base_path, comp_path, network.roads, metrics = True, periods = 'default', transport = FakeValhalla())
+
+    pieces = read_properties(network.comparison(base_path, comp_path))
+    names = ['metric_' + period for period in service_periods.default_periods]
+    assert any(properties['metric'] != 0 for properties in pieces)
+    assert all(sum(properties[name] for name in names) == properties['metric'] for properties in pieces)
+
+    # Trips outside every period are not counted, so the periods add up to less than the daily metric
+    busdecomp_gtfs(base_path, comp_path, network.roads, metrics = True, periods = {'am_peak': (6, 9)},
+                   transport = FakeValhalla())
+    pieces = read_properties(network.comparison(base_path, comp_path))
+    assert any(properties['metric_am_peak'] != properties['metric'] for properties in pieces)
+
+def test_periods_count_the_daily_metric_pairs(network):
+    feed_path = network.feed('base', {'R1': base_routes['R1'], 'R2': base_routes['R2']})
+    segment_keys, counts = service_periods.trips_by_period(feed_path, service_periods.hourly_periods())
+
+    # Every pair of consecutive stop events of the same trip, as for the daily metric
+    stop_times = gtfs_io.read_stop_times(feed_path)
+    with zipfile.ZipFile(feed_path) as feed_zip:
+        trip_routes = dict((row['trip_id'], row['route_id'].lower())
+                           for row in csv.DictReader(io.TextIOWrapper(feed_zip.open('trips.txt'))))
+    expected = collections.Counter()
+    for index in range(len(stop_times) - 1):
+        if stop_times.trip_codes[index] == stop_times.trip_codes[index + 1]:
+            expected[trip_routes[stop_times.trip_ids[stop_times.trip_codes[index]]] + '-' +
+                     stop_times.stop_ids[stop_times.stop_codes[index]] + '-' +
+                     stop_times.stop_ids[stop_times.stop_codes[index + 1]]] += 1
+    assert dict(zip(segment_keys, counts.sum(axis = 1).tolist())) == dict(expected)
+    assert np.all(counts.sum(axis = 0)[[6, 7, 8, 26]] > 0)
+
+# A feed of one route with two trips, A over S1, S2, S3 and B over S4, S5
+def write_two_trip_feed(path):
+    tables = {'agency.txt': 'agency_id,agency_name,agency_url,agency_timezone\nA,A,http://a,America/New_York\n',
+              'routes.txt': 'route_id,agency_id,route_short_name,route_long_name,route_type\nR,A,r,R,3\n',
+              'calendar.txt': 'service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n'
+                              'WK,1,1,1,1,1,0,0,20200101,20201231\n',
+              'trips.txt': 'route_id,service_id,trip_id\nR,WK,A\nR,WK,B\n',
+              'stops.txt': 'stop_id,stop_name,stop_lat,stop_lon\n' + ''.join('S%d,S%d,42.3%d,-71.0%d\n' % (i, i, i, i) for i in range(1, 6)),
+              'stop_times.txt': 'trip_id,arrival_time,departure_time,stop_id,stop_sequence\n'
+                                'A,07:00:00,07:00:00,S1,1\nA,07:05:00,07:05:00,S2,2\nA,07:10:00,07:10:00,S3,3\n'
+                                'B,08:00:00,08:00:00,S4,1\nB,08:05:00,08:05:00,S5,2\n'}
+    with zipfile.ZipFile(path, 'w') as feed_zip:
+        for name, text in tables.items():
+            feed_zip.writestr(name, text)
+
+def test_only_pairs_within_a_trip_are_counted(tmp_path):
+    feed_path = str(tmp_path / 'two_trips.zip')
+    write_two_trip_feed(feed_path)
+    stop_times = gtfs_io.read_stop_times(feed_path)
+    pairs = [(stop_times.stop_ids[stop_times.stop_codes[index]], stop_times.stop_ids[stop_times.stop_codes[index + 1]])
+             for index in service_periods.counted_pairs(stop_times).tolist()]
+    assert pairs == [('S1', 'S2'), ('S2', 'S3'), ('S4', 'S5')]
+
+    # The first segment of each trip is counted, and the pair from the end of A to the start of B is not
+    segment_keys, counts = service_periods.trips_by_period(feed_path, {'day': (0, 24)})
+    assert dict(zip(segment_keys, counts[:, 0].tolist())) == {'r-S1-S2': 1, 'r-S2-S3': 1, 'r-S4-S5': 1}
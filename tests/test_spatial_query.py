@@ -0,0 +1,76 @@
+import json
+import urllib.request
+import pytest
+from shapely.geometry import box, shape
+from busdecomp import busdecomp_gtfs
+from spatial_query import OutputIndex, serve
+from synthetic import FakeValhalla, base_routes, comp_routes
+
+# Routes named 'r1' and 'r1-x', so that every key of 'r1-x' also starts with 'r1-'
+@pytest.fixture
+def outputs(network):
+    base_path = network.feed('base', {'R1': base_routes['R1'], 'R1-X': base_routes['R2'], 'R3': base_routes['R3']})
+    comp_path = network.feed('comp', {'R1': base_routes['R1'], 'R1-X': comp_routes['R5'], 'R3': comp_routes['R3']})
+    busdecomp_gtfs(base_path, comp_path, network.roads, metrics = True, transport = FakeValhalla())
+    return {'base': base_path[:-4] + '.geojson', 'comp': comp_path[:-4] + '.geojson',
+            'comparison': network.comparison(base_path, comp_path)}
+
+# The routes of the segment keys of a comparison piece, found from the decomposition outputs
+def decomposition_routes(outputs):
+    routes = {}
+    for name in ['base', 'comp']:
+        for feature in OutputIndex(outputs[name]).features:
+            properties = feature['properties']
+            for index, key in properties['indices'].items():
+                routes[key] = properties['route_id'][index]
+    return routes
+
+def test_routes_of_comparison_keys(outputs):
+    index = OutputIndex(outputs['comparison'], route_ids = ['r1', 'r1-x', 'r3'])
+    key_routes = decomposition_routes(outputs)
+    for route in ['r1', 'r1-x', 'r3']:
+        expected = [feature for feature in index.features
+                    if any(key_routes[key] == route for network in feature['properties']['segments'].values()
+                           for key in (network or {}).values())]
+        assert len(expected) > 0
+        assert index.route(route) == expected
+    assert index.route('r1') != index.route('r1-x')
+
+    # Decomposition outputs name their routes
+    base = OutputIndex(outputs['base'])
+    assert sorted(base.routes) == ['r1', 'r1-x', 'r3']
+    assert all('r1-x' in feature['properties']['route_id'].values() for feature in base.route('r1-x'))
+
+def test_spatial_and_edge_queries(outputs):
+    index = OutputIndex(outputs['comparison'], route_ids = ['r1', 'r1-x', 'r3'])
+    lines = [shape(feature['geometry']) for feature in index.features]
+    west, south, east, north = lines[0].bounds
+    area = box(west, south, (west + east) / 2, (south + north) / 2)
+    assert index.bbox(*area.bounds) == [feature for feature, line in zip(index.features, lines) if line.intersects(area)]
+    assert index.polygon(area) == index.bbox(*area.bounds)
+    assert len(index.bbox(-180, -90, 180, 90)) == len(index.features)
+    assert all(has_change for has_change in [feature['properties']['service_indicator'] != 2 or feature['properties']['metric'] != 0
+                                             for feature in index.bbox(-180, -90, 180, 90, changed = True)])
+
+    lon, lat = lines[0].coords[0]
+    assert index.features[0] in index.near(lon, lat, 1)
+    assert all(line.distance(shape({'type': 'Point', 'coordinates': [lon, lat]})) < 0.001
+               for line in [shape(feature['geometry']) for feature in index.near(lon, lat, 50)])
+
+    edge = index.features[0]['properties']['edge']
+    assert index.edge(edge) == [feature for feature in index.features if feature['properties']['edge'] == edge]
+    assert index.edge(-1) == []
+
+def test_serve_answers_a_query(outputs):
+    server = serve(outputs, port = 0, block = False)
+    try:
+        url = 'http://127.0.0.1:%d/comparison/route/r1-x' % server.server_address[1]
+        with urllib.request.urlopen(url, timeout = 10) as response:
+            collection = json.loads(response.read())
+    finally:
+        server.shutdown()
+        server.server_close()
+    expected = OutputIndex(outputs['comparison'], route_ids = ['r1', 'r1-x', 'r3']).route('r1-x')
+    assert collection['type'] == 'FeatureCollection'
+    assert len(collection['features']) == len(expected) > 0
+    assert [feature['properties']['edge'] for feature in collection['features']] == [feature['properties']['edge'] for feature in expected]
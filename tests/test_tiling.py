@@ -0,0 +1,67 @@
+import pytest
+import tiling
+import edge_decomposition as decomposition
+from instrumentation import get_report
+from shape_generation import map_matching
+from edge_decomposition import edge_decomposition
+from compare_edges import compare_edges
+import polyline_codec
+from synthetic import FakeValhalla, base_routes, comp_routes, read_text, to_grid
+
+class NoMatchValhalla(FakeValhalla): # Finds no match for any shape that only runs along the road at y = 70
+    def post(self, action, request_data, timeout):
+        if action == 'trace_attributes' and all(to_grid(lon, lat)[1] == 70 for lat, lon in
+                                                polyline_codec.decode(request_data['encoded_polyline'], 6)):
+            return {'error_code': 171, 'status_code': 400, 'error': 'No suitable edges near location'}
+        return super().post(action, request_data, timeout)
+
+@pytest.mark.parametrize('tile_size', [0.02, 0.035])
+def test_tiled_outputs_equal_untiled_outputs(network, tile_size):
+    transport = FakeValhalla()
+    base_path = network.feed('base', base_routes)
+    comp_path = network.feed('comp', comp_routes)
+    base_segments = map_matching(base_path, transport = transport)
+    comp_segments = map_matching(comp_path, transport = transport)
+
+    outputs = {}
+    get_report().reset()
+    for tiles in [None, tile_size]:
+        edge_decomposition(base_segments, network.roads, base_path[:-4], transport = transport, tile_size = tiles)
+        edge_decomposition(comp_segments, network.roads, comp_path[:-4], transport = transport, tile_size = tiles)
+        compare_edges(base_path, comp_path, base_path[:-4] + '.geojson', comp_path[:-4] + '.geojson', metrics = True,
+                      tile_size = tiles)
+        outputs[tiles] = [read_text(base_path[:-4] + '.geojson'), read_text(comp_path[:-4] + '.geojson'),
+                          read_text(network.comparison(base_path, comp_path))]
+
+    counters = get_report().to_dict()['counters']
+    assert counters['edge_tiles'] > 2 and counters['compare_tiles'] > 1
+    assert outputs[tile_size] == outputs[None]
+
+def test_failed_matches_are_reported_the_same_with_tiles(network):
+    base_path = network.feed('base', base_routes)
+    segments = map_matching(base_path, transport = FakeValhalla())
+    errors = {}
+    for tiles in [None, 0.02]:
+        get_report().reset()
+        edge_decomposition(segments, network.roads, base_path[:-4], transport = NoMatchValhalla(), tile_size = tiles)
+        errors[tiles] = get_report().to_dict()['counters'].get('edge_matching_errors', 0)
+    assert errors[None] == errors[0.02] > 0
+
+def test_tiles_only_read_the_ways_around_their_edges(network, monkeypatch):
+    base_path = network.feed('base', base_routes)
+    segments = map_matching(base_path, transport = FakeValhalla())
+    read_file = decomposition.gpd.read_file
+    bboxes = []
+    def recording_read_file(path, *args, **kwargs):
+        if path == network.roads:
+            bboxes.append(kwargs.get('bbox'))
+        return read_file(path, *args, **kwargs)
+    monkeypatch.setattr(decomposition.gpd, 'read_file', recording_read_file)
+    edge_decomposition(segments, network.roads, base_path[:-4], transport = FakeValhalla(), tile_size = 0.02)
+    assert len(bboxes) > 2 and None not in bboxes
+
+def test_items_belong_to_the_tile_of_their_first_point():
+    keys = tiling.tile_keys([(-71.1, 42.3), (-71.01, 42.39), (-71.099, 42.301)], 0.02)
+    groups = tiling.group_by_tile(keys)
+    assert len(groups) == 2
+    assert sorted(len(positions) for positions in groups.values()) == [1, 2]
@@ -0,0 +1,42 @@
+import ast
+import json
+from busdecomp import busdecomp_gtfs, busdecomp_routes
+from synthetic import FakeValhalla, base_routes, comp_routes
+
+# The rows of an output as a sorted list, since updated pieces are not in the same order as a full run's.
+# Polylines are left out, as pieces joined back together are encoded again from their lines.
+def output_rows(path):
+    with open(path) as infile:
+        features = json.load(infile)['features']
+    rows = []
+    for feature in features:
+        properties = dict(feature['properties'])
+        properties.pop('polyline', None)
+        for key, value in properties.items():
+            if isinstance(value, str) and value[:1] == '{':
+                value = ast.literal_eval(value)
+            if isinstance(value, dict):
+                value = sorted(repr(sorted(item.values()) if isinstance(item, dict) else item) for item in value.values())
+            properties[key] = value
+        coords = [[round(value, 6) for value in point] for point in feature['geometry']['coordinates']]
+        rows.append(repr(sorted(properties.items())) + repr(coords))
+    return sorted(rows)
+
+def test_updating_a_route_matches_a_full_run(network):
+    stop_format = 'S-%d-%d' # Stop IDs containing '-', as in many feeds
+    base_path = network.feed('base', base_routes, stop_format = stop_format)
+    comp_path = network.feed('comp', comp_routes, stop_format = stop_format)
+    busdecomp_gtfs(base_path, comp_path, network.roads, metrics = True, transport = FakeValhalla())
+
+    # Change the path of one route and update only that route
+    updated_routes = dict(comp_routes, R3 = [(0, 70), (60, 70), (60, 40)])
+    network.feed('comp', updated_routes, stop_format = stop_format)
+    busdecomp_routes(base_path, comp_path, network.roads, route_ids = [None, ['R3']], metrics = True,
+                     transport = FakeValhalla())
+    updated = [output_rows(comp_path[:-4] + '.geojson'), output_rows(network.comparison(base_path, comp_path))]
+
+    busdecomp_gtfs(base_path, comp_path, network.roads, metrics = True, transport = FakeValhalla())
+    full = [output_rows(comp_path[:-4] + '.geojson'), output_rows(network.comparison(base_path, comp_path))]
+    assert updated[0] == full[0]
+    assert updated[1] == full[1]
+    assert any("'S-" in row for row in full[0])
@@ -0,0 +1,79 @@
+import time
+import pytest
+import requests
+from instrumentation import get_report
+from valhalla_transport import PoolTransport
+
+class FakeServer: # Answers every request, or fails every request while down
+    def __init__(self, name):
+        self.name = name
+        self.down = False
+        self.calls = 0
+
+    def post(self, action, request_data, timeout):
+        self.calls += 1
+        if self.down:
+            raise requests.exceptions.ConnectionError(self.name + ' is down')
+        return {'edges': [], 'server': self.name}
+
+def make_pool(eject_time = 0.05):
+    pool = PoolTransport(['localhost:8002', 'localhost:8003'], eject_after = 2, eject_time = eject_time)
+    servers = []
+    for endpoint in pool.endpoints:
+        endpoint.transport = FakeServer(endpoint.name)
+        servers.append(endpoint.transport)
+    return pool, servers
+
+def send(pool):
+    try:
+        return pool.post('trace_attributes', {}, 1)['server']
+    except requests.exceptions.ConnectionError:
+        return None
+
+def test_requests_go_to_the_least_busy_server():
+    pool, servers = make_pool()
+    assert [send(pool) for request in range(4)] == ['localhost:8002', 'localhost:8003'] * 2
+
+    # A server with a request in flight is passed over
+    busy = pool.acquire()
+    assert [send(pool) for request in range(2)] == [servers[1 - pool.endpoints.index(busy)].name] * 2
+    pool.release(busy, False)
+
+def test_failing_server_is_ejected_then_probed():
+    get_report().reset()
+    pool, servers = make_pool()
+    servers[0].down = True
+    assert [send(pool) for request in range(4)] == [None, 'localhost:8003'] * 2
+    assert pool.endpoints[0].ejected_until is not None
+    assert get_report().to_dict()['counters']['endpoint_ejections'] == 1
+
+    # While ejected, every request goes to the healthy server
+    assert [send(pool) for request in range(3)] == ['localhost:8003'] * 3
+    assert servers[0].calls == 2
+
+    # Once the ejection time is up, one probe is sent; a failed probe ejects the server again
+    time.sleep(0.06)
+    assert send(pool) is None and servers[0].calls == 3
+    assert pool.endpoints[0].ejected_until > time.time()
+    assert get_report().to_dict()['counters']['endpoint_ejections'] == 1
+
+    # A successful probe brings the server back into the pool
+    servers[0].down = False
+    time.sleep(0.06)
+    assert send(pool) == 'localhost:8002'
+    assert pool.endpoints[0].ejected_until is None and pool.endpoints[0].consecutive_failures == 0
+    assert sorted(send(pool) for request in range(2)) == ['localhost:8002', 'localhost:8003']
+
+    # Each server's requests and failures are reported
+    endpoints = get_report().to_dict()['valhalla_endpoints']
+    assert [(endpoints[server.name]['requests'], endpoints[server.name]['failures']) for server in servers] == [(5, 3), (6, 0)]
+
+def test_pool_fails_fast_when_every_server_is_ejected():
+    pool, servers = make_pool(eject_time = 30)
+    for server in servers:
+        server.down = True
+    for request in range(4):
+        send(pool)
+    with pytest.raises(requests.exceptions.ConnectionError, match = 'All Valhalla endpoints are ejected'):
+        pool.post('trace_attributes', {}, 1)
+    assert sum(server.calls for server in servers) == 4
@@ -0,0 +1,170 @@
+import os
+import gzip
+import json
+import math
+import struct
+import sqlite3
+import vector_tiles
+
+# A minimal protocol buffer reader: the fields of a message as (number, value), with the bytes of
+# length-delimited fields, the integers of varint fields and the raw 8 bytes of 64-bit fields
+def read_varint(data, position):
+    value, shift = 0, 0
+    while True:
+        byte = data[position]
+        value |= (byte & 0x7F) << shift
+        position += 1
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+def read_fields(data):
+    fields = []
+    position = 0
+    while position < len(data):
+        tag, position = read_varint(data, position)
+        number, wire_type = tag >> 3, tag & 7
+        if wire_type == 0:
+            value, position = read_varint(data, position)
+        elif wire_type == 1:
+            value, position = data[position : position + 8], position + 8
+        elif wire_type == 2:
+            length, position = read_varint(data, position)
+            value, position = data[position : position + length], position + length
+        else:
+            raise ValueError('Unexpected wire type %d' % wire_type)
+        fields.append((number, value))
+    return fields
+
+def read_packed(data):
+    values = []
+    position = 0
+    while position < len(data):
+        value, position = read_varint(data, position)
+        values.append(value)
+    return values
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+def decode_value(data):
+    number, value = read_fields(data)[0]
+    if number == 1:
+        return value.decode('utf-8')
+    if number == 3:
+        return struct.unpack('<d', value)[0]
+    if number == 6:
+        return unzigzag(value)
+    if number == 7:
+        return bool(value)
+    raise ValueError('Unexpected value field %d' % number)
+
+# Decode a tile into {layer name: layer}, with the extent, version and features of each layer, and the
+# properties, raw geometry commands and decoded line parts of each feature
+def decode_tile(data):
+    layers = {}
+    for number, layer_data in read_fields(data):
+        assert number == 3
+        fields = read_fields(layer_data)
+        keys = [value.decode('utf-8') for number, value in fields if number == 3]
+        values = [decode_value(value) for number, value in fields if number == 4]
+        layer = {'version': [value for number, value in fields if number == 15][0],
+                 'extent': [value for number, value in fields if number == 5][0],
+                 'features': []}
+        for number, feature_data in fields:
+            if number != 2:
+                continue
+            feature = dict((number, value) for number, value in read_fields(feature_data))
+            tags = read_packed(feature[2])
+            commands = read_packed(feature[4])
+            layer['features'].append({'id': feature[1], 'type': feature[3], 'commands': commands,
+                                      'properties': {keys[tags[i]]: values[tags[i + 1]] for i in range(0, len(tags), 2)},
+                                      'parts': decode_geometry(commands)})
+        layers[[value for number, value in fields if number == 1][0].decode('utf-8')] = layer
+    return layers
+
+def decode_geometry(commands):
+    parts = []
+    x, y = 0, 0
+    position = 0
+    while position < len(commands):
+        command, count = commands[position] & 7, commands[position] >> 3
+        position += 1
+        if command == 1:
+            parts.append([])
+        for _ in range(count):
+            x += unzigzag(commands[position])
+            y += unzigzag(commands[position + 1])
+            position += 2
+            parts[-1].append((x, y))
+    return parts
+
+zoom = 14
+
+# Three points well inside one tile at the test zoom level, far enough apart to survive simplification
+def tile_line():
+    x, y = int(2 ** zoom * 0.3) + 0.25, int(2 ** zoom * 0.37) + 0.25
+    def lonlat(tile_x, tile_y):
+        lon = tile_x / 2 ** zoom * 360 - 180
+        lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / 2 ** zoom))))
+        return [lon, lat]
+    return [lonlat(x, y), lonlat(x + 0.5, y), lonlat(x + 0.5, y + 0.5)], (int(x), int(y))
+
+def write_geojson(path, coords, properties):
+    with open(path, 'w') as outfile:
+        json.dump({'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'properties': properties,
+                   'geometry': {'type': 'LineString', 'coordinates': coords}}]}, outfile)
+
+def test_tiles_decode_to_the_exported_pieces(tmp_path):
+    coords, (tile_x, tile_y) = tile_line()
+    comparison = str(tmp_path / 'comparison.geojson')
+    base = str(tmp_path / 'base.geojson')
+    write_geojson(comparison, coords, {'edge': 12, 'service_indicator': 2, 'metric': -1.5, 'metric_am_peak': 3,
+                                       'segments': "{'base': None, 'comp': None}"})
+    write_geojson(base, coords, {'edge': 12, 'route_id': "{0: 'r1', 1: 'r2', 2: 'r1'}"})
+    inpaths = {'comparison': comparison, 'base': base}
+    vector_tiles.export_tiles(str(tmp_path / 'tiles'), inpaths, min_zoom = zoom, max_zoom = zoom, workers = 1)
+    vector_tiles.export_tiles(str(tmp_path / 'tiles.mbtiles'), inpaths, min_zoom = zoom, max_zoom = zoom, workers = 1)
+
+    assert os.listdir(str(tmp_path / 'tiles' / str(zoom))) == [str(tile_x)]
+    assert os.listdir(str(tmp_path / 'tiles' / str(zoom) / str(tile_x))) == [str(tile_y) + '.pbf']
+    with open(str(tmp_path / 'tiles' / str(zoom) / str(tile_x) / (str(tile_y) + '.pbf')), 'rb') as infile:
+        data = infile.read()
+
+    layers = decode_tile(data)
+    assert sorted(layers) == ['base', 'comparison']
+    assert layers['base']['features'][0]['properties'] == {'edge': 12, 'routes': 'r1,r2'}
+    feature = layers['comparison']['features'][0]
+    assert layers['comparison']['extent'] == 4096 and layers['comparison']['version'] == 2
+    assert feature['type'] == 2 # LineString
+    assert feature['properties'] == {'edge': 12, 'service_indicator': 2, 'metric': -1.5, 'metric_am_peak': 3}
+
+    # One MoveTo of one point, then one LineTo of the other two points
+    assert feature['commands'][0] == 9
+    assert feature['commands'][3] == (2 | (2 << 3))
+    assert len(feature['commands']) == 8
+    expected = [(1024, 1024), (3072, 1024), (3072, 3072)] # Quarter and three quarters of the tile
+    assert all(abs(x - expected_x) <= 1 and abs(y - expected_y) <= 1
+               for (x, y), (expected_x, expected_y) in zip(feature['parts'][0], expected))
+
+    # The MBTiles file has the same tile, compressed, with its row numbered from the south
+    connection = sqlite3.connect(str(tmp_path / 'tiles.mbtiles'))
+    rows = connection.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles').fetchall()
+    metadata = dict(connection.execute('SELECT name, value FROM metadata').fetchall())
+    connection.close()
+    assert [row[:3] for row in rows] == [(zoom, tile_x, 2 ** zoom - 1 - tile_y)]
+    assert gzip.decompress(rows[0][3]) == data
+
+    fields = {layer['id']: layer['fields'] for layer in json.loads(metadata['json'])['vector_layers']}
+    assert fields == {'comparison': {'edge': 'Number', 'service_indicator': 'Number', 'metric': 'Number', 'metric_am_peak': 'Number'},
+                      'base': {'edge': 'Number', 'routes': 'String'}}
+
+class FakeLayer: # Just the properties that field_types reads
+    def __init__(self, properties):
+        self.properties = properties
+
+def test_field_types_come_from_every_value():
+    layer = FakeLayer([{'edge': 1, 'flag': True, 'mixed': 2, 'empty': None, 'later': None},
+                       {'edge': 2, 'flag': False, 'mixed': 'a', 'empty': None, 'later': 0.5}])
+    assert vector_tiles.field_types(layer) == {'edge': 'Number', 'flag': 'Boolean', 'mixed': 'String',
+                                               'empty': 'String', 'later': 'Number'}
@@ -0,0 +1,53 @@
+"""
+
+This program splits a network into a grid of square tiles so that the
+pipeline can work on one part of a large (e.g. state-wide) network at a time.
+Tiles are tile_size degrees of longitude and latitude across, and are
+identified by their (column, row) in the grid.
+
+Each item that is tiled (a stop pair, an edge or a piece) is assigned to
+exactly one tile, the tile containing its first point, so that it is only
+processed once. Items that reach across a tile border are still processed
+whole by their own tile; any work that depends on items in other tiles (e.g.
+splitting an edge at the break points of every segment that uses it) is
+reconciled by edge ID before the tiles are processed.
+
+Tiles are processed in parallel, and their results are returned in tile
+order so that they can be merged back into a single output.
+
+Tiling does not bound the memory of a run. It limits what is loaded for each
+tile: in edge decomposition each tile reads only the ways around its own
+edges from the road shapefile (a road store is memory-mapped instead), and
+drops them once its edges are split, and the Valhalla results are dropped
+once their edges are added. But the segment table, the matched edges and the
+pieces of the whole network are still held in one process until the output
+is written, and compare_edges reads both decomposition outputs whole before
+it splits them into tiles.
+
+Tiles run on threads in the same process. The Valhalla requests of different
+tiles overlap, but the splitting and comparison of pieces in Shapely is
+CPU-bound and holds the GIL, so those stages gain little from more workers.
+
+"""
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Get the tile containing each of a list of (lon, lat) points
+def tile_keys(points, tile_size):
+    points = np.asarray(points, dtype = np.float64).reshape(-1, 2)
+    cells = np.floor(points / tile_size).astype(np.int64)
+    return [tuple(cell) for cell in cells.tolist()]
+
+# Group the positions of items by tile, keeping their order; tiles are in order of their first item
+def group_by_tile(keys):
+    tiles = {}
+    for position, key in enumerate(keys):
+        tiles.setdefault(key, []).append(position)
+    return tiles
+
+# Run a function on the item positions of each tile in parallel; returns the results by tile, in tile order
+def map_tiles(function, tiles, workers = 4):
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = {key: executor.submit(function, positions) for key, positions in tiles.items()}
+        return {key: future.result() for key, future in futures.items()}
@@ -0,0 +1,292 @@
+"""
+
+This program provides the transport layer that sits underneath every request
+sent to the Valhalla map matching engine. Each transport exposes a single
+method, post(action, request_data, timeout), which sends a request to a
+Valhalla action (e.g. 'trace_route' or 'trace_attributes') and returns the
+decoded JSON response as a dictionary.
+
+Five transports are included:
+
+HttpTransport:      Sends requests to a running Valhalla server over HTTP.
+
+PoolTransport:      Spreads requests over several Valhalla servers (e.g. a
+                    few containers on one host), sending each request to the
+                    server with the fewest requests in flight. Servers that
+                    keep failing are ejected from the pool for a while, then
+                    probed with a single request before they are used again.
+
+ActorTransport:     Calls Valhalla in-process through its Python bindings
+                    (pip install pyvalhalla), reading the routing tiles named
+                    in a Valhalla config file. No Valhalla server is needed,
+                    and each worker process builds its own actor.
+
+RecordingTransport: Wraps another transport and writes every request/response
+                    pair to a gzip-compressed archive (one JSON record per line).
+
+ReplayTransport:    Serves responses from an archive written by a
+                    RecordingTransport, with optional simulated latency. No
+                    Valhalla server is needed.
+
+Every transport that talks to Valhalla (or simulates it) reports its request
+latencies to the run report in instrumentation.py.
+
+Recording a run once and replaying it makes performance runs of the whole
+pipeline exact, offline and repeatable:
+
+    with RecordingTransport(HttpTransport(port = 8002), 'run.jsonl.gz') as transport:
+        busdecomp_gtfs(base_path, comp_path, road_path, transport = transport)
+
+    busdecomp_gtfs(base_path, comp_path, road_path,
+                   transport = ReplayTransport('run.jsonl.gz'))
+
+"""
+
+import gzip
+import json
+import os
+import threading
+import time
+import logging
+import requests
+from instrumentation import get_report
+from request_policy import RetryableValhallaError, classify_response
+
+try:
+    import valhalla
+except ImportError: # Only needed for the in-process backend
+    valhalla = None
+
+logger = logging.getLogger(__name__)
+
+# Build the lookup key for a request: the action plus a canonical JSON payload
+def request_key(action, request_data):
+    return action + ' ' + json.dumps(request_data, sort_keys = True)
+
+class ReplayMissError(Exception): # Raised when a replayed run sends a request that was never recorded
+    pass
+
+class HttpTransport: # Sends requests to a Valhalla server over HTTP
+    def __init__(self, host = 'localhost', port = 8002):
+        self.host = host
+        self.port = port
+        self.url = 'http://' + host + ':' + str(port)
+
+    def post(self, action, request_data, timeout):
+        start_time = time.time()
+        try:
+            req = requests.post(self.url + '/' + action,
+                                data = json.dumps(request_data),
+                                timeout = timeout)
+            return req.json()
+        finally:
+            get_report().observe_latency(action, time.time() - start_time)
+
+    def close(self):
+        pass
+
+class Endpoint: # One Valhalla server in a pool, with its health and load
+    def __init__(self, name, transport):
+        self.name = name
+        self.transport = transport
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = None
+        self.probing = False
+
+class PoolTransport: # Sends each request to the least busy healthy server in a pool
+    def __init__(self, endpoints, eject_after = 3, eject_time = 30):
+
+        # endpoints: list of 'host:port' strings
+        self.eject_after = eject_after # Consecutive failures before a server is ejected
+        self.eject_time = eject_time # Time before an ejected server is probed again (seconds)
+        self.endpoints = []
+        for endpoint in endpoints:
+            host, port = endpoint.rsplit(':', 1)
+            self.endpoints.append(Endpoint(endpoint, HttpTransport(host = host, port = int(port))))
+        self.lock = threading.Lock()
+        self.next_index = 0
+
+    # Choose a server: an ejected one whose time is up gets a single probe request,
+    # otherwise the healthy server with the fewest requests in flight (taking turns on ties)
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            candidates = []
+            for offset in range(len(self.endpoints)):
+                endpoint = self.endpoints[(self.next_index + offset) % len(self.endpoints)]
+                if endpoint.ejected_until is None:
+                    candidates.append(endpoint)
+                elif not endpoint.probing and now >= endpoint.ejected_until:
+                    candidates = [endpoint]
+                    endpoint.probing = True
+                    break
+            if len(candidates) == 0:
+                raise requests.exceptions.ConnectionError('All Valhalla endpoints are ejected')
+
+            endpoint = min(candidates, key = lambda candidate: candidate.outstanding)
+            endpoint.outstanding += 1
+            self.next_index = (self.endpoints.index(endpoint) + 1) % len(self.endpoints)
+            return endpoint
+
+    def release(self, endpoint, failed):
+        with self.lock:
+            endpoint.outstanding -= 1
+            endpoint.probing = False
+            if not failed:
+                endpoint.consecutive_failures = 0
+                endpoint.ejected_until = None
+                return
+
+            endpoint.consecutive_failures += 1
+            if endpoint.ejected_until is not None or endpoint.consecutive_failures >= self.eject_after:
+                if endpoint.ejected_until is None:
+                    get_report().increment('endpoint_ejections')
+                    logger.warning('Ejecting Valhalla endpoint %s after %d failures', endpoint.name, endpoint.consecutive_failures)
+                endpoint.ejected_until = time.time() + self.eject_time
+
+    def post(self, action, request_data, timeout):
+        endpoint = self.acquire()
+        failed = True
+        start_time = time.time()
+        try:
+            result = endpoint.transport.post(action, request_data, timeout)
+            failed = isinstance(classify_response(result), RetryableValhallaError)
+            return result
+        finally:
+            self.release(endpoint, failed)
+            get_report().observe_endpoint(endpoint.name, time.time() - start_time, failed)
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.transport.close()
+
+class ActorTransport: # Calls Valhalla in-process through the Python bindings
+    def __init__(self, config_path):
+        if valhalla is None:
+            raise ImportError('ActorTransport requires the Valhalla Python bindings (pip install pyvalhalla)')
+        self.config_path = config_path
+        self.local = threading.local()
+
+    # Actors are built lazily, one per thread, and rebuilt in forked worker processes
+    def get_actor(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.actor = valhalla.Actor(self.config_path)
+            self.local.pid = os.getpid()
+        return self.local.actor
+
+    # The timeout is not used, since requests are not sent over the network
+    def post(self, action, request_data, timeout):
+        start_time = time.time()
+        try:
+            response = getattr(self.get_actor(), action)(json.dumps(request_data))
+        except RuntimeError as e:
+            # Valhalla errors are raised with the JSON error response as the message
+            try:
+                return json.loads(str(e))
+            except ValueError:
+                raise e
+        finally:
+            get_report().observe_latency(action, time.time() - start_time)
+
+        return json.loads(response) if isinstance(response, str) else response
+
+    def close(self):
+        self.local = threading.local()
+
+class RecordingTransport: # Records request/response pairs sent through another transport
+    def __init__(self, transport, archive_path):
+        self.transport = transport
+        self.archive_path = archive_path
+        self.archive = gzip.open(archive_path, 'wt', encoding = 'utf-8')
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def post(self, action, request_data, timeout):
+
+        # Serialize before sending, since callers mutate request dictionaries between retries
+        payload = json.loads(json.dumps(request_data))
+        record = {'action': action, 'request': payload}
+
+        start_time = time.time()
+        try:
+            result = self.transport.post(action, request_data, timeout)
+        except Exception as e:
+            # Failed requests are recorded too, so that retries replay exactly
+            record['latency'] = time.time() - start_time
+            record['error'] = type(e).__name__
+            self.write(record)
+            raise
+
+        record['latency'] = time.time() - start_time
+        record['response'] = result
+        self.write(record)
+
+        return result
+
+    def write(self, record):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.archive.write(line)
+            self.count += 1
+
+    def close(self):
+        if not self.archive.closed:
+            self.archive.close()
+        self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class ReplayTransport: # Serves recorded responses from an archive instead of Valhalla
+    def __init__(self, archive_path, latency = None):
+
+        # latency: None for no delay, 'recorded' to sleep for the recorded latency,
+        # or a number of seconds to sleep for every request
+        self.archive_path = archive_path
+        self.latency = latency
+        self.records = {}
+        self.served = {}
+        self.lock = threading.Lock()
+
+        # Keep every response for a key in order, so repeated requests (e.g. retries) replay in sequence
+        with gzip.open(archive_path, 'rt', encoding = 'utf-8') as archive:
+            for line in archive:
+                record = json.loads(line)
+                key = request_key(record['action'], record['request'])
+                if key in self.records:
+                    self.records[key].append(record)
+                else:
+                    self.records[key] = [record]
+
+    def post(self, action, request_data, timeout):
+        key = request_key(action, json.loads(json.dumps(request_data)))
+        if key not in self.records:
+            raise ReplayMissError('No recorded response for ' + action + ' request')
+
+        # Serve responses in recorded order, repeating the last one once exhausted
+        responses = self.records[key]
+        with self.lock:
+            position = self.served.get(key, 0)
+            self.served[key] = position + 1
+        record = responses[min(position, len(responses) - 1)]
+
+        start_time = time.time()
+        if self.latency == 'recorded':
+            time.sleep(record['latency'])
+        elif self.latency:
+            time.sleep(self.latency)
+        get_report().observe_latency(action, time.time() - start_time)
+
+        if 'error' in record:
+            if 'Timeout' in record['error']:
+                raise requests.exceptions.Timeout('Replayed ' + record['error'])
+            raise requests.exceptions.ConnectionError('Replayed ' + record['error'])
+
+        return record['response']
+
+    def close(self):
+        pass
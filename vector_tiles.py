@@ -0,0 +1,306 @@
+"""
+
+This program exports the comparison and decomposition outputs as a pyramid of
+Mapbox Vector Tiles, so that a web map only loads the tiles in view rather
+than a whole GeoJSON file. The tiles are written to an MBTiles file (a SQLite
+database) if the output path ends in '.mbtiles', or otherwise to a directory
+of z/x/y.pbf files. They are encoded here, without a vector tile library.
+
+Each input file becomes a layer of the tiles, with these properties:
+
+comparison: edge, service_indicator and metric (compare_edges output)
+base, comp: edge and routes, a comma-separated list of the routes using the
+            piece (edge_decomposition outputs)
+
+At each zoom level the pieces are clipped to each tile (plus a small buffer)
+and simplified to within a pixel, so that the tiles stay small at low zoom
+levels. Tiles are generated in parallel, in ranges of tiles at each zoom level.
+
+    export_tiles('../output/base_vs_comp.mbtiles', {'comparison': '../output/base_vs_comp.geojson',
+                                                    'base': 'data/base.geojson',
+                                                    'comp': 'data/comp.geojson'})
+
+"""
+
+import os
+import ast
+import gzip
+import json
+import math
+import struct
+import sqlite3
+import logging
+import numpy as np
+import geopandas as gpd
+from concurrent.futures import ThreadPoolExecutor
+from shapely.geometry import LineString, box
+from shapely.ops import clip_by_rect
+from instrumentation import get_report
+
+logger = logging.getLogger(__name__)
+
+extent = 4096 # Tile coordinates per tile side
+tile_buffer = 64 # Tile coordinates included beyond each tile edge, so that lines join up across tiles
+earth_radius = 6378137 # Web Mercator sphere radius (meters)
+world_size = 2 * math.pi * earth_radius
+tiles_per_task = 64 # Tiles generated by one task
+
+""" Protocol buffer encoding """
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def field_varint(number, value):
+    return varint(number << 3) + varint(value)
+
+def field_bytes(number, data):
+    return varint((number << 3) | 2) + varint(len(data)) + data
+
+def field_packed(number, values):
+    return field_bytes(number, b''.join(varint(value) for value in values))
+
+# Encode a property value as a vector tile Value message
+def encode_value(value):
+    if isinstance(value, (bool, np.bool_)):
+        return field_varint(7, int(value))
+    if isinstance(value, (int, np.integer)):
+        return field_varint(6, zigzag(int(value)))
+    if isinstance(value, (float, np.floating)):
+        return varint((3 << 3) | 1) + struct.pack('<d', float(value))
+    return field_bytes(1, str(value).encode('utf-8'))
+
+# Encode the parts of a line (lists of integer tile coordinates) as MoveTo and LineTo commands
+def encode_geometry(parts):
+    commands = []
+    x, y = 0, 0
+    for part in parts:
+        commands.append(1 | (1 << 3)) # MoveTo, one point
+        commands.extend([zigzag(part[0][0] - x), zigzag(part[0][1] - y)])
+        x, y = part[0]
+        commands.append(2 | ((len(part) - 1) << 3)) # LineTo, the rest of the points
+        for point_x, point_y in part[1:]:
+            commands.extend([zigzag(point_x - x), zigzag(point_y - y)])
+            x, y = point_x, point_y
+    return commands
+
+# Encode one layer of a tile from a list of (feature ID, properties, line parts)
+def encode_layer(name, features):
+    keys, values = {}, {}
+    encoded_features = []
+    for feature_id, properties, parts in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            value_key = (type(value).__name__, value)
+            tags.extend([keys.setdefault(key, len(keys)), values.setdefault(value_key, len(values))])
+        encoded_features.append(field_bytes(2, field_varint(1, feature_id) + field_packed(2, tags) +
+                                               field_varint(3, 2) + field_packed(4, encode_geometry(parts))))
+    return (field_varint(15, 2) + field_bytes(1, name.encode('utf-8')) + b''.join(encoded_features) +
+            b''.join(field_bytes(3, key.encode('utf-8')) for key in keys) +
+            b''.join(field_bytes(4, encode_value(value)) for value_type, value in values) +
+            field_varint(5, extent))
+
+""" Tile geometry """
+
+# Convert arrays of longitudes and latitudes to Web Mercator meters
+def to_mercator(lon, lat):
+    lat = np.clip(lat, -85.0511, 85.0511)
+    return np.radians(lon) * earth_radius, np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * earth_radius
+
+# Convert Web Mercator meters back to a longitude and latitude
+def from_mercator(x, y):
+    return math.degrees(x / earth_radius), math.degrees(2 * math.atan(math.exp(y / earth_radius)) - math.pi / 2)
+
+# Get the Web Mercator bounds of a tile (west, south, east, north)
+def tile_bounds(zoom, x, y):
+    size = world_size / 2 ** zoom
+    west = -world_size / 2 + x * size
+    north = world_size / 2 - y * size
+    return west, north - size, west + size, north
+
+# Get the range of tile columns and rows covering some Web Mercator bounds at a zoom level
+def tile_range(zoom, bounds):
+    size = world_size / 2 ** zoom
+    last = 2 ** zoom - 1
+    first_x = min(max(int((bounds[0] + world_size / 2) // size), 0), last)
+    last_x = min(max(int((bounds[2] + world_size / 2) // size), 0), last)
+    first_y = min(max(int((world_size / 2 - bounds[3]) // size), 0), last)
+    last_y = min(max(int((world_size / 2 - bounds[1]) // size), 0), last)
+    return first_x, first_y, last_x, last_y
+
+# Clip a line to a tile and convert it to a list of parts in integer tile coordinates, simplified to within
+# a pixel of the tile when it is displayed at 256 pixels across
+def tile_parts(line, zoom, x, y):
+    west, south, east, north = tile_bounds(zoom, x, y)
+    scale = extent / (east - west)
+    margin = tile_buffer / scale
+    clipped = clip_by_rect(line, west - margin, south - margin, east + margin, north + margin)
+    if clipped.is_empty:
+        return []
+
+    parts = []
+    for part in getattr(clipped, 'geoms', [clipped]):
+        if part.geom_type != 'LineString':
+            continue
+        coords = np.asarray(part.simplify(extent / 256 / scale).coords)
+        points = np.rint(np.column_stack([(coords[:, 0] - west) * scale, (north - coords[:, 1]) * scale])).astype(np.int64)
+        keep = np.concatenate([[True], np.any(points[1:] != points[:-1], axis = 1)]) # Drop repeated points
+        points = points[keep]
+        if len(points) > 1:
+            parts.append(points.tolist())
+    return parts
+
+""" Layers """
+
+class Layer: # The pieces of one input file, in Web Mercator, with their tile properties
+    def __init__(self, name, inpath):
+        self.name = name
+        with open(inpath) as infile:
+            features = json.load(infile)['features']
+        self.properties = [tile_properties(feature['properties']) for feature in features]
+        self.lines = []
+        for feature in features:
+            coords = np.asarray(feature['geometry']['coordinates'], dtype = np.float64)[:, :2]
+            mercator_x, mercator_y = to_mercator(coords[:, 0], coords[:, 1])
+            self.lines.append(LineString(np.column_stack([mercator_x, mercator_y])))
+        self.index = gpd.GeoSeries(self.lines).sindex if len(self.lines) > 0 else None
+
+    # Get the features of the layer in a tile, as (feature ID, properties, line parts)
+    def tile_features(self, zoom, x, y):
+        if self.index is None:
+            return []
+        west, south, east, north = tile_bounds(zoom, x, y)
+        margin = tile_buffer * (east - west) / extent
+        features = []
+        for position in sorted(self.index.query(box(west - margin, south - margin, east + margin, north + margin)).tolist()):
+            parts = tile_parts(self.lines[position], zoom, x, y)
+            if len(parts) > 0:
+                features.append((position + 1, self.properties[position], parts))
+        return features
+
+# Get the tile properties of a piece from its properties in the comparison or decomposition output
+def tile_properties(properties):
+    if 'service_indicator' in properties:
+        tile = {'edge': properties.get('edge'),
+                'service_indicator': properties.get('service_indicator'),
+                'metric': properties.get('metric')}
+        tile.update({key: value for key, value in properties.items() if key.startswith('metric_')}) # Metrics by period
+        return tile
+
+    routes = properties.get('route_id') or {}
+    if isinstance(routes, str):
+        routes = ast.literal_eval(routes)
+    return {'edge': properties.get('edge'),
+            'routes': ','.join(str(route) for route in dict.fromkeys(routes.values()))}
+
+""" Export """
+
+# Generate the tiles for a list of (zoom, x, y); returns the encoded tiles that have any features
+def generate_tiles(layers, tiles):
+    encoded = []
+    for zoom, x, y in tiles:
+        data = b''
+        for layer in layers:
+            features = layer.tile_features(zoom, x, y)
+            if len(features) > 0:
+                data += field_bytes(3, encode_layer(layer.name, features))
+        if len(data) > 0:
+            encoded.append((zoom, x, y, data))
+    return encoded
+
+# Get the field types of a layer (Number, Boolean or String) from the property values written to the tiles.
+# A field with values of more than one type, or only missing values, is given as a String.
+def field_types(layer):
+    types = {}
+    for properties in layer.properties:
+        for key, value in properties.items():
+            if value is None:
+                types.setdefault(key, set())
+                continue
+            if isinstance(value, (bool, np.bool_)):
+                value_type = 'Boolean'
+            elif isinstance(value, (int, float, np.integer, np.floating)):
+                value_type = 'Number'
+            else:
+                value_type = 'String'
+            types.setdefault(key, set()).add(value_type)
+    return {key: value_types.pop() if len(value_types) == 1 else 'String' for key, value_types in types.items()}
+
+# Write the metadata of an MBTiles file
+def write_metadata(connection, name, layers, min_zoom, max_zoom, bounds):
+    west, south, east, north = bounds
+    vector_layers = [{'id': layer.name, 'minzoom': min_zoom, 'maxzoom': max_zoom, 'fields': field_types(layer)}
+                     for layer in layers]
+    metadata = {'name': name, 'format': 'pbf', 'type': 'overlay', 'minzoom': str(min_zoom), 'maxzoom': str(max_zoom),
+                'bounds': '%f,%f,%f,%f' % (west, south, east, north),
+                'center': '%f,%f,%d' % ((west + east) / 2, (south + north) / 2, min_zoom),
+                'json': json.dumps({'vector_layers': vector_layers})}
+    connection.executemany('INSERT INTO metadata (name, value) VALUES (?, ?)', list(metadata.items()))
+
+# Export GeoJSON outputs ({layer name: path}) as vector tiles from min_zoom to max_zoom, generated by workers threads
+def export_tiles(outpath, inpaths, min_zoom = 10, max_zoom = 16, workers = 4):
+
+    report = get_report()
+    span = report.start_stage('export_tiles')
+    layers = [Layer(name, inpath) for name, inpath in inpaths.items()]
+    lines = [line for layer in layers for line in layer.lines]
+    if len(lines) == 0:
+        logger.warning('No pieces to export as vector tiles')
+        report.end_stage(span)
+        return
+
+    # Find the tiles that each piece's bounds reach at each zoom level, and split them into tasks
+    bounds = np.array([line.bounds for line in lines])
+    tasks = []
+    for zoom in range(min_zoom, max_zoom + 1):
+        margin = tile_buffer * world_size / 2 ** zoom / extent
+        tiles = set()
+        for west, south, east, north in bounds.tolist():
+            first_x, first_y, last_x, last_y = tile_range(zoom, (west - margin, south - margin, east + margin, north + margin))
+            tiles.update((zoom, x, y) for x in range(first_x, last_x + 1) for y in range(first_y, last_y + 1))
+        tiles = sorted(tiles)
+        tasks.extend(tiles[start : start + tiles_per_task] for start in range(0, len(tiles), tiles_per_task))
+
+    # Write the tiles of each task as they are generated, in order
+    mbtiles = outpath.endswith('.mbtiles')
+    if mbtiles:
+        if os.path.exists(outpath):
+            os.remove(outpath)
+        connection = sqlite3.connect(outpath)
+        connection.execute('CREATE TABLE metadata (name TEXT, value TEXT)')
+        connection.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+        connection.execute('CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)')
+        west, south = from_mercator(*bounds.min(axis = 0)[:2])
+        east, north = from_mercator(*bounds.max(axis = 0)[2:])
+        write_metadata(connection, os.path.basename(outpath)[:-8], layers, min_zoom, max_zoom, (west, south, east, north))
+
+    tile_count = 0
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        for encoded in executor.map(lambda tiles: generate_tiles(layers, tiles), tasks):
+            for zoom, x, y, data in encoded:
+                if mbtiles: # MBTiles numbers rows from the south, and stores the tiles compressed
+                    connection.execute('INSERT INTO tiles VALUES (?, ?, ?, ?)', (zoom, x, 2 ** zoom - 1 - y, gzip.compress(data)))
+                else:
+                    os.makedirs(os.path.join(outpath, str(zoom), str(x)), exist_ok = True)
+                    with open(os.path.join(outpath, str(zoom), str(x), str(y) + '.pbf'), 'wb') as outfile:
+                        outfile.write(data)
+                tile_count += 1
+
+    if mbtiles:
+        connection.commit()
+        connection.close()
+    report.increment('vector_tiles', tile_count)
+    elapsed = report.end_stage(span)
+    logger.info('Exported %d vector tiles (zoom %d to %d) to %s in %d seconds', tile_count, min_zoom, max_zoom, outpath, round(elapsed, 0))